@@ -1,34 +1,61 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g, has_request_context
 import os
-from datetime import datetime
-from math import radians, sin, cos, sqrt, atan2
+from datetime import datetime, timezone, timedelta
+from math import radians, sin, cos, asin, sqrt, atan2, floor, isfinite
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, create_engine, inspect
+from sqlalchemy import text, inspect, insert, select, update, func, cast, extract, Integer, or_, bindparam
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import csv
 import threading
-import requests
+import time
+import atexit
+import itertools
+import queue
+import sqlite3
+from collections import deque, OrderedDict
+import heapq
+from bisect import bisect_left
 import re
-import pandas as pd
+import numpy as np
 import io
-from flask import send_file
+import gzip
+import zlib
+import glob
+from flask import Response, stream_with_context
 import json
+import hashlib
+import functools
+import socket
+import click
+from contextlib import contextmanager
 
 # --- Application Setup ---
 app = Flask(__name__)  # create the Flask web application
 BASE_DIR = os.path.dirname(__file__)
-DATA_DIR = os.path.join(BASE_DIR, "data")
+DATA_DIR = os.environ.get("WQI_DATA_DIR") or os.path.join(BASE_DIR, "data")  # runtime files (db, caches, archive, metrics)
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.path.join(DATA_DIR, "wqi.db")
 CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
 CONFIG = {}
+WQI_MODEL = None  # compiled WQI model, rebuilt lazily after each config load
+WQI_FINGERPRINT = None  # fingerprint of the WQI inputs in CONFIG, stored next to each computed WaterSample.wqi
+STATUS_CLASSIFIER = None  # compiled status_thresholds, rebuilt lazily after each config load
+CONFIG_MTIME = None  # mtime of config.json when it was last loaded
 
 def load_config():
-    global CONFIG
+    global CONFIG, WQI_MODEL, WQI_FINGERPRINT, STATUS_CLASSIFIER, CONFIG_MTIME
     try:
+        CONFIG_MTIME = os.stat(CONFIG_PATH).st_mtime_ns
         with open(CONFIG_PATH, "r", encoding="utf-8") as f:  # open config.json from project root
             CONFIG = json.load(f) or {}  # parse JSON into a Python dict; default to empty if file is blank
     except Exception:
         CONFIG = {}  # if config fails to load, keep an empty dict so code can use safe defaults
+    WQI_MODEL = None  # weights depend on config, so force a recompile on next use
+    WQI_FINGERPRINT = None
+    STATUS_CLASSIFIER = None
 
 load_config()
 
@@ -36,54 +63,106 @@ load_config()
 sqlite_uri = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_DATABASE_URI"] = sqlite_uri
 
-# Check external DB if provided
+# Use the external DB if provided; connectivity is checked by `flask db-upgrade`, not on every import
 external_db_url = os.environ.get("DATABASE_URL")
 if external_db_url:
-    try:
-        # Test connection with a short timeout
-        test_engine = create_engine(external_db_url, connect_args={'connect_timeout': 3})
-        with test_engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-        app.config["SQLALCHEMY_DATABASE_URI"] = external_db_url
-        print("Using external database.")
-    except Exception as e:
-        print(f"External database connection failed: {e}. Falling back to SQLite.")
+    app.config["SQLALCHEMY_DATABASE_URI"] = external_db_url
+
+SQLITE_SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+def engine_options(uri):
+    """
+    Engine options for the configured backend, from the "database" section of config.json
+    (read once at startup; pool settings need a restart to change).
+    """
+    cfg_db = CONFIG.get("database", {})
+    if uri.startswith("sqlite"):
+        # one file shared by threads and workers: wait for a lock instead of failing with "database is locked"
+        return {"connect_args": {"timeout": float(cfg_db.get("sqlite_busy_timeout_ms", 5000)) / 1000.0}}
+    return {
+        "pool_size": int(cfg_db.get("pool_size", 5)),
+        "max_overflow": int(cfg_db.get("max_overflow", 10)),
+        "pool_recycle": int(cfg_db.get("pool_recycle_s", 1800)),  # below typical server/proxy idle cutoffs
+        "pool_pre_ping": bool(cfg_db.get("pool_pre_ping", True)),  # drop connections killed while idle
+        "pool_timeout": float(cfg_db.get("pool_timeout_s", 30)),
+    }
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer and, with synchronous=NORMAL,
+    # commits no longer fsync every time (only at checkpoints)
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cfg_db = CONFIG.get("database", {})
+    synchronous = str(cfg_db.get("sqlite_synchronous", "NORMAL")).upper()
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=" + ("WAL" if cfg_db.get("sqlite_wal", True) else "DELETE"))
+    cursor.execute("PRAGMA synchronous=" + (synchronous if synchronous in SQLITE_SYNCHRONOUS else "NORMAL"))
+    cursor.execute(f"PRAGMA busy_timeout={int(cfg_db.get('sqlite_busy_timeout_ms', 5000))}")
+    cursor.close()
+
+SQLITE_WRITE_LOCK = threading.Lock()
+
+@contextmanager
+def serialized_write():
+    """
+    Queues this process's writers for SQLite's single write lock on a Python lock, so waiting
+    threads wake as soon as it is free instead of sleeping in the busy handler (which can starve
+    one thread for the whole busy timeout under sustained ingest). No-op on other backends.
+    """
+    if db.engine.dialect.name != "sqlite":
+        yield
+        return
+    with SQLITE_WRITE_LOCK:
+        yield
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 db = SQLAlchemy(app)
-iot_lock = threading.Lock()
+iot_lock = threading.Lock()  # guards the IoT archive writer
 
 def seed_reference_locations():
-    # load static reference locations from JSON and insert into the database if missing
-    try:
-        static_path = os.path.join(DATA_DIR, "static_wb.json")
-        if not os.path.exists(static_path):
-            return
-        with open(static_path, "r", encoding="utf-8") as f:
-            items = json.load(f) or []
-        created = 0
-        for item in items:
-            name = item.get("name")
-            location = item.get("location")
-            exists = ReferenceLocation.query.filter_by(name=name, location=location).first()  # skip duplicates
-            if exists:
-                continue
-            rec = ReferenceLocation(
-                name=name,
-                location=location,
-                latitude=float(item.get("latitude")),
-                longitude=float(item.get("longitude")),
-                wqi=float(item.get("wqi")),
-                status=item.get("status"),
-                category=item.get("category")
-            )
-            db.session.add(rec)  # stage the new row for insert
-            created += 1
-        if created:
-            db.session.commit()  # write inserts to the database
-            print(f"Seeded {created} reference locations from static_wb.json")
-    except Exception as e:
-        print(f"Reference seed error: {e}")
+    """
+    Upserts the static reference locations from data/static_wb.json in one statement,
+    keyed on (name, location). Returns the number of JSON items.
+    """
+    static_path = os.path.join(BASE_DIR, "data", "static_wb.json")  # shipped with the code, not runtime data
+    if not os.path.exists(static_path):
+        return 0
+    with open(static_path, "r", encoding="utf-8") as f:
+        items = json.load(f) or []
+    rows = [{
+        "name": item.get("name"),
+        "location": item.get("location"),
+        "latitude": float(item.get("latitude")),
+        "longitude": float(item.get("longitude")),
+        "wqi": float(item.get("wqi")),
+        "status": item.get("status"),
+        "category": item.get("category"),
+    } for item in items]
+    if not rows:
+        return 0
+    dialect = db.engine.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(ReferenceLocation.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["name", "location"],
+            set_={col: stmt.excluded[col] for col in ("latitude", "longitude", "wqi", "status", "category")},
+        )
+        db.session.execute(stmt)
+    else:
+        # other backends: skip pairs that already exist, insert the rest in one executemany
+        existing = set(db.session.query(ReferenceLocation.name, ReferenceLocation.location))
+        missing = [row for row in rows if (row["name"], row["location"]) not in existing]
+        if missing:
+            db.session.execute(insert(ReferenceLocation.__table__), missing)
+    db.session.commit()
+    data_changed()
+    return len(rows)
 
 # --- ORM Models ---
 class Location(db.Model):
@@ -93,13 +172,17 @@ class Location(db.Model):
     latitude = db.Column(db.Float, nullable=False, index=True)
     longitude = db.Column(db.Float, nullable=False, index=True)
     name = db.Column(db.String(255), nullable=True)
-    samples = db.relationship("WaterSample", backref="location", lazy=True, cascade="all, delete-orphan")
+    # most recent sample for this location, maintained by the sample write routes
+    latest_sample_id = db.Column(db.Integer, db.ForeignKey("water_samples.id", use_alter=True, name="fk_locations_latest_sample"), nullable=True, index=True)
+    samples = db.relationship("WaterSample", backref="location", lazy=True, cascade="all, delete-orphan",
+                              foreign_keys="WaterSample.location_id")
+    latest_sample = db.relationship("WaterSample", foreign_keys=[latest_sample_id], post_update=True)
 
 class WaterSample(db.Model):
     __tablename__ = "water_samples"
     # stores one set of water readings for a location at a point in time
     id = db.Column(db.Integer, primary_key=True)
-    location_id = db.Column(db.Integer, db.ForeignKey("locations.id"), nullable=False, index=True)
+    location_id = db.Column(db.Integer, db.ForeignKey("locations.id"), nullable=False)  # leads ix_water_samples_location_timestamp
     ph = db.Column(db.Float, nullable=True)
     do = db.Column(db.Float, nullable=True)
     tds = db.Column(db.Float, nullable=True)
@@ -107,7 +190,16 @@ class WaterSample(db.Model):
     nitrate = db.Column(db.Float, nullable=True)
     temperature = db.Column(db.Float, nullable=True)
     wqi = db.Column(db.Float, nullable=True, index=True)
+    wqi_config = db.Column(db.String(16), nullable=True, index=True)  # config fingerprint the stored wqi was computed with
+    status = db.Column(db.String(64), nullable=True)  # get_status(wqi) under the same config
+    color = db.Column(db.String(16), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (
+        # latest/range per location, newest first; wqi makes the history signature index-only
+        db.Index("ix_water_samples_location_timestamp", "location_id", timestamp.desc(), id.desc(), "wqi"),
+        # map status filter: stored status of rows scored under the current config
+        db.Index("ix_water_samples_status_config", "status", "wqi_config"),
+    )
 
 class IoTReading(db.Model):
     __tablename__ = "iot_readings"
@@ -117,7 +209,34 @@ class IoTReading(db.Model):
     turbidity_percent = db.Column(db.Float, nullable=False)
     ph = db.Column(db.Float, nullable=True)
     turbidity_ntu = db.Column(db.Float, nullable=True)
+    device_id = db.Column(db.String(64), nullable=True)  # optional sender id; readings from older firmware have none
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (db.Index("ix_iot_readings_device_timestamp", "device_id", "timestamp"),)
+
+class IoTRollup(db.Model):
+    __tablename__ = "iot_rollups"
+    # per-minute/hour/day aggregates of iot_readings, updated as readings are stored
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.String(8), nullable=False)  # "1m", "1h" or "1d"
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    temperature_c_n = db.Column(db.Integer, nullable=False, default=0)
+    temperature_c_sum = db.Column(db.Float, nullable=True)
+    temperature_c_min = db.Column(db.Float, nullable=True)
+    temperature_c_max = db.Column(db.Float, nullable=True)
+    ph_n = db.Column(db.Integer, nullable=False, default=0)
+    ph_sum = db.Column(db.Float, nullable=True)
+    ph_min = db.Column(db.Float, nullable=True)
+    ph_max = db.Column(db.Float, nullable=True)
+    turbidity_n = db.Column(db.Integer, nullable=False, default=0)
+    turbidity_sum = db.Column(db.Float, nullable=True)
+    turbidity_min = db.Column(db.Float, nullable=True)
+    turbidity_max = db.Column(db.Float, nullable=True)
+    wqi_n = db.Column(db.Integer, nullable=False, default=0)
+    wqi_sum = db.Column(db.Float, nullable=True)
+    wqi_min = db.Column(db.Float, nullable=True)
+    wqi_max = db.Column(db.Float, nullable=True)
+    __table_args__ = (db.UniqueConstraint("resolution", "bucket_start", name="uq_iot_rollups_bucket"),)
 
 class ReferenceLocation(db.Model):
     __tablename__ = "reference_locations"
@@ -130,41 +249,185 @@ class ReferenceLocation(db.Model):
     wqi = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(64), nullable=False)
     category = db.Column(db.String(255), nullable=True)
+    __table_args__ = (db.Index("uq_reference_locations_name_location", "name", "location", unique=True),)
 
-with app.app_context():
-    try:
-        db.create_all()  # ensure tables exist
-        inspector = inspect(db.engine)
-        if inspector.has_table("water_samples"):
-            columns = [col['name'] for col in inspector.get_columns('water_samples')]
-            if 'temperature' not in columns:
-                print("Migrating: Adding 'temperature' column to water_samples table...")
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE water_samples ADD COLUMN temperature FLOAT"))
-                    conn.commit()
-                print("Migration successful.")
-        if inspector.has_table("iot_readings"):
-            iot_columns = [col['name'] for col in inspector.get_columns('iot_readings')]
-            with db.engine.connect() as conn:
-                if 'ph' not in iot_columns:
-                    try:
-                        print("Migrating: Adding 'ph' column to iot_readings table...")
-                        conn.execute(text("ALTER TABLE iot_readings ADD COLUMN ph FLOAT"))
-                        conn.commit()
-                        print("Migration successful.")
-                    except Exception as e:
-                        print(f"Migration warning (ph): {e}")
-                if 'turbidity_ntu' not in iot_columns:
-                    try:
-                        print("Migrating: Adding 'turbidity_ntu' column to iot_readings table...")
-                        conn.execute(text("ALTER TABLE iot_readings ADD COLUMN turbidity_ntu FLOAT"))
-                        conn.commit()
-                        print("Migration successful.")
-                    except Exception as e:
-                        print(f"Migration warning (turbidity_ntu): {e}")
-        seed_reference_locations()  # insert static locations from JSON
-    except Exception as e:
-        print(f"Error creating/migrating tables: {e}")
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_version"
+    # one row per applied entry of MIGRATIONS
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+class JobLease(db.Model):
+    __tablename__ = "job_leases"
+    # one row per background job; a process runs the job only while it holds an unexpired lease
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(128), nullable=False)  # "<host>:<pid>"
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+# Hot read statements, built once at import. Their cache keys are memoized on the statement,
+# so each execution goes straight to SQLAlchemy's compiled-SQL cache instead of rebuilding the query.
+LATEST_SAMPLE_PER_LOCATION = (select(Location, WaterSample)
+                              .outerjoin(WaterSample, WaterSample.id == Location.latest_sample_id)
+                              .order_by(Location.id))
+LATEST_IOT_READING = (select(IoTReading.id, IoTReading.temperature_c, IoTReading.ph, IoTReading.turbidity_ntu,
+                             IoTReading.turbidity_percent, IoTReading.timestamp)
+                      .order_by(IoTReading.timestamp.desc())
+                      .limit(1))
+LATEST_DEVICE_READING = LATEST_IOT_READING.where(IoTReading.device_id == bindparam("device_id"))
+
+def latest_sample_id_stmt(location_id):
+    # newest sample id for one location, read from ix_water_samples_location_timestamp alone
+    return (select(WaterSample.id)
+            .where(WaterSample.location_id == location_id)
+            .order_by(WaterSample.timestamp.desc(), WaterSample.id.desc())
+            .limit(1))
+
+def backfill_latest_samples():
+    # point every location at its most recent sample in one set-based UPDATE
+    with db.engine.connect() as conn:
+        conn.execute(text(
+            "UPDATE locations SET latest_sample_id = ("
+            " SELECT ws.id FROM water_samples ws WHERE ws.location_id = locations.id"
+            " ORDER BY ws.timestamp DESC, ws.id DESC LIMIT 1)"
+        ))
+        conn.commit()
+
+def refresh_latest_sample(location):
+    # recompute the latest-sample pointer for one location (call after flushing sample writes)
+    location.latest_sample_id = db.session.scalar(latest_sample_id_stmt(location.id))
+
+def locations_with_latest_sample():
+    """
+    Returns [(Location, WaterSample or None), ...] for every location using one joined query.
+    Samples whose stored WQI is missing or from an older config are scored in a single batch
+    for this response only; the rescoring job is what writes them back.
+    """
+    pairs = db.session.execute(LATEST_SAMPLE_PER_LOCATION).all()
+    fingerprint = get_wqi_fingerprint()
+    stale = [sample for _, sample in pairs if sample is not None and sample.wqi_config != fingerprint]
+    if stale:
+        scores = calculate_wqi_many([sample_payload(sample) for sample in stale])
+        for sample, score, (status, color) in zip(stale, scores, get_statuses(scores)):
+            set_committed_value(sample, "wqi", score)  # visible to the caller, never flushed
+            set_committed_value(sample, "status", status)
+            set_committed_value(sample, "color", color)
+    return pairs
+
+def sample_payload(sample):
+    # WQI inputs stored on a WaterSample row
+    return {"ph": sample.ph, "do": sample.do, "tds": sample.tds, "turbidity": sample.turbidity, "nitrate": sample.nitrate, "temperature": sample.temperature}
+
+# --- Schema migrations (run by `flask --app app db-upgrade`, not at import) ---
+def add_missing_column(table, column, ddl):
+    # ALTER TABLE ... ADD COLUMN unless the column already exists (databases that predate schema_version)
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table) or column in {col["name"] for col in inspector.get_columns(table)}:
+        return False
+    print(f"Migrating: Adding '{column}' column to {table} table...")
+    with db.engine.connect() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        conn.commit()
+    return True
+
+def migrate_create_tables():
+    db.create_all()  # creates missing tables only; existing tables are left to the steps below
+
+def migrate_sample_temperature():
+    add_missing_column("water_samples", "temperature", "FLOAT")
+
+def migrate_latest_sample_pointer():
+    if add_missing_column("locations", "latest_sample_id", "INTEGER"):
+        backfill_latest_samples()
+
+def migrate_iot_columns():
+    add_missing_column("iot_readings", "ph", "FLOAT")
+    add_missing_column("iot_readings", "turbidity_ntu", "FLOAT")
+
+def migrate_iot_rollups():
+    print("Building IoT rollups from existing readings...")
+    rebuild_iot_rollups()
+
+def migrate_sample_wqi_config():
+    # existing scores have no fingerprint, so the rescoring job treats them as stale
+    add_missing_column("water_samples", "wqi_config", "VARCHAR(16)")
+    with db.engine.connect() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_water_samples_wqi_config ON water_samples (wqi_config)"))
+        conn.commit()
+
+def migrate_reference_unique():
+    # the seed upsert conflicts on (name, location); drop duplicates left by older seeding first
+    with db.engine.connect() as conn:
+        conn.execute(text(
+            "DELETE FROM reference_locations WHERE id NOT IN"
+            " (SELECT MIN(id) FROM reference_locations GROUP BY name, location)"
+        ))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_reference_locations_name_location"
+            " ON reference_locations (name, location)"
+        ))
+        conn.commit()
+
+def migrate_sample_status():
+    # filled by the rescoring job: status thresholds are part of the fingerprint, so every row is stale now
+    add_missing_column("water_samples", "status", "VARCHAR(64)")
+    add_missing_column("water_samples", "color", "VARCHAR(16)")
+    with db.engine.connect() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_water_samples_status ON water_samples (status)"))
+        conn.commit()
+
+def migrate_access_path_indexes():
+    # composite indexes for the hot queries (see `flask --app app db-explain`); the single-column
+    # location_id and status indexes are leading prefixes of the new ones, so they go
+    add_missing_column("iot_readings", "device_id", "VARCHAR(64)")
+    with db.engine.connect() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_water_samples_location_timestamp"
+            " ON water_samples (location_id, timestamp DESC, id DESC, wqi)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_water_samples_status_config ON water_samples (status, wqi_config)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_locations_latest_sample_id ON locations (latest_sample_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_iot_readings_device_timestamp ON iot_readings (device_id, timestamp)"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_water_samples_location_id"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_water_samples_status"))
+        conn.execute(text("ANALYZE"))  # refresh planner statistics for the new indexes
+        conn.commit()
+
+def migrate_job_leases():
+    JobLease.__table__.create(db.engine, checkfirst=True)
+
+MIGRATIONS = [  # (version, description, step); append new steps, never renumber
+    (1, "create tables", migrate_create_tables),
+    (2, "water_samples.temperature", migrate_sample_temperature),
+    (3, "locations.latest_sample_id", migrate_latest_sample_pointer),
+    (4, "iot_readings.ph and turbidity_ntu", migrate_iot_columns),
+    (5, "iot_rollups backfill", migrate_iot_rollups),
+    (6, "water_samples.wqi_config", migrate_sample_wqi_config),
+    (7, "reference_locations unique (name, location)", migrate_reference_unique),
+    (8, "water_samples.status and color", migrate_sample_status),
+    (9, "composite access-path indexes and iot_readings.device_id", migrate_access_path_indexes),
+    (10, "job_leases", migrate_job_leases),
+]
+
+def schema_version():
+    # highest applied migration, 0 for a new database or one from before schema_version existed
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return 0
+    return db.session.query(func.max(SchemaVersion.version)).scalar() or 0
+
+def migrate_db():
+    """Applies pending MIGRATIONS in order, recording each in schema_version. Returns the versions applied."""
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    current = schema_version()
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        step()
+        db.session.add(SchemaVersion(version=version, description=description, applied_at=datetime.utcnow()))
+        db.session.commit()
+        applied.append(version)
+    return applied
 
 # --- Core WQI Function ---
 def clean_response(text):
@@ -176,6 +439,178 @@ def clean_response(text):
     text = re.sub(r"Thinking Process:[\s\S]*?(?=\n\n|\Z)", "", text, flags=re.IGNORECASE)
     return text.strip()
 
+DEFAULT_IDEAL = {  # ideal target values for each parameter
+    "ph": 7.0,
+    "do": 14.6,
+    "turbidity": 0.0,
+    "tds": 0.0,
+    "nitrate": 0.0,
+    "temperature": 25.0,
+}
+DEFAULT_STANDARD = {  # permissible standard values for each parameter
+    "ph": 8.5,
+    "do": 5.0,
+    "turbidity": 5.0,
+    "tds": 500.0,
+    "nitrate": 45.0,
+    "temperature": 30.0,
+}
+MAX_BATCH_SIZE = 50000  # upper bound on readings accepted by /calculate/batch
+
+class WQIModel:
+    """
+    Weighted Arithmetic WQI compiled from config once.
+
+    Ideal/standard values, unit weights and the per-parameter rating mode are
+    precomputed so scoring a reading is only arithmetic. `score` handles one
+    reading; `score_many` / `score_columns` score thousands at once with NumPy
+    and give exactly the same results as `score` for every row.
+    """
+
+    def __init__(self, ideal, standard):
+        self.params = []   # parameters that can contribute to the index, in config order
+        self.ideal = []    # Vi per parameter
+        self.standard = [] # Vs per parameter
+        self.weights = []  # Wi = K / Vs per parameter
+        self.modes = []    # "inverse" (DO), "absolute" (pH, temperature) or "direct"
+        try:
+            self.k = 1 / sum(1 / v for v in standard.values())  # proportionality constant using standards
+        except ZeroDivisionError:
+            self.k = None  # a zero standard makes every score undefined
+            return
+        for param, vs in standard.items():
+            vi = ideal[param]
+            if vs - vi == 0:
+                continue  # rating would divide by zero; the scalar formula always skipped these
+            if param == "do":
+                mode = "inverse"  # for DO, lower than ideal is worse
+            elif param in ["ph", "temperature"]:
+                mode = "absolute"  # absolute deviation from ideal
+            else:
+                mode = "direct"  # higher than ideal indicates worse quality
+            self.params.append(param)
+            self.ideal.append(vi)
+            self.standard.append(vs)
+            self.weights.append(self.k / vs)
+            self.modes.append(mode)
+
+    @classmethod
+    def from_config(cls, config):
+        cfg_wqi = (config or {}).get("wqi", {})  # read WQI portion of config
+        return cls(cfg_wqi.get("ideal", DEFAULT_IDEAL), cfg_wqi.get("standard", DEFAULT_STANDARD))
+
+    def score(self, data):
+        """Score one reading dict; returns the WQI rounded to 2 decimals or None."""
+        if self.k is None:
+            return None
+        total_qw = 0.0
+        total_w = 0.0
+        for param, vi, vs, wi, mode in zip(self.params, self.ideal, self.standard, self.weights, self.modes):
+            if param not in data or data[param] is None:
+                continue
+            try:
+                vo = float(data[param])  # observed value from input
+            except (ValueError, TypeError):
+                continue
+            if mode == "inverse":
+                qi = (vi - vo) / (vi - vs) * 100
+            elif mode == "absolute":
+                qi = abs(vo - vi) / (vs - vi) * 100
+            else:
+                qi = (vo - vi) / (vs - vi) * 100
+            qi = max(0.0, qi)  # clamp negative to zero (NaN also clamps to zero)
+            total_qw += qi * wi  # accumulate Qi weighted
+            total_w += wi        # accumulate weights
+        if total_w == 0:
+            return None
+        return round(total_qw / total_w, 2)  # weighted average -> final WQI
+
+    def score_columns(self, columns, n=None):
+        """
+        Score column-oriented readings.
+
+        - columns (dict): parameter name -> sequence of observed values (None = missing).
+        - n (int): number of rows; inferred from the first column when omitted.
+        Returns: list of WQI values (rounded to 2 decimals) or None per row.
+        """
+        if n is None:
+            n = len(next(iter(columns.values()))) if columns else 0
+        if n == 0:
+            return []
+        if self.k is None:
+            return [None] * n
+        total_qw = np.zeros(n)
+        total_w = np.zeros(n)
+        for param, vi, vs, wi, mode in zip(self.params, self.ideal, self.standard, self.weights, self.modes):
+            col = columns.get(param)
+            if col is None:
+                continue
+            vo, present = _column_to_array(col, n)
+            if mode == "inverse":
+                qi = (vi - vo) / (vi - vs) * 100
+            elif mode == "absolute":
+                qi = np.abs(vo - vi) / (vs - vi) * 100
+            else:
+                qi = (vo - vi) / (vs - vi) * 100
+            qi = np.where(qi > 0.0, qi, 0.0)  # same clamp as max(0.0, qi), including NaN -> 0
+            total_qw += np.where(present, qi * wi, 0.0)
+            total_w += np.where(present, wi, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            wqi = total_qw / total_w
+        # Python's round() keeps results identical to the scalar path
+        return [round(float(v), 2) if w != 0 else None for v, w in zip(wqi, total_w)]
+
+    def score_many(self, rows):
+        """Score a sequence of reading dicts; equivalent to [score(r) for r in rows]."""
+        rows = [r if isinstance(r, dict) else {} for r in rows]
+        columns = {param: [r.get(param) for r in rows] for param in self.params}
+        return self.score_columns(columns, len(rows))
+
+def _column_to_array(col, n):
+    # convert a column to float64 plus a mask of usable values (None / unparsable -> missing)
+    if isinstance(col, np.ndarray) and col.dtype.kind == "f":
+        return col.astype(float, copy=False), np.ones(n, dtype=bool)  # NaN is a value, as in float()
+    if not isinstance(col, (list, tuple)):
+        col = list(col)  # positional access below (e.g. pandas Series)
+    present = np.ones(n, dtype=bool)
+    try:
+        values = np.array(col, dtype=float)  # None becomes NaN here
+    except (ValueError, TypeError):
+        values = np.zeros(n)
+        for i, v in enumerate(col):
+            try:
+                values[i] = float(v)
+            except (ValueError, TypeError):
+                present[i] = False  # None or unparsable
+        return values, present
+    nan_idx = np.flatnonzero(np.isnan(values))  # only NaN slots can hide a None
+    if nan_idx.size:
+        present[nan_idx] = [col[i] is not None for i in nan_idx]
+    return values, present
+
+def get_wqi_model():
+    global WQI_MODEL
+    if WQI_MODEL is None:
+        WQI_MODEL = WQIModel.from_config(CONFIG)  # compile once per config load
+    return WQI_MODEL
+
+def get_wqi_fingerprint():
+    # short hash of what stored scores depend on: ideal/standard values and the status buckets (hex colors excluded)
+    global WQI_FINGERPRINT
+    if WQI_FINGERPRINT is None:
+        cfg_wqi = CONFIG.get("wqi", {})
+        classifier = get_status_classifier()
+        inputs = {"ideal": cfg_wqi.get("ideal", DEFAULT_IDEAL), "standard": cfg_wqi.get("standard", DEFAULT_STANDARD),
+                  "status": [classifier.bounds, classifier.lookup]}
+        WQI_FINGERPRINT = hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return WQI_FINGERPRINT
+
+def sample_wqi(sample):
+    # WQI for a sample under the current config: the stored value if it is current, else scored (not saved)
+    if sample.wqi_config == get_wqi_fingerprint():
+        return sample.wqi
+    return calculate_wqi(sample_payload(sample))
+
 def calculate_wqi(data):
     """
     Calculates the Water Quality Index (WQI) using the Weighted Arithmetic WQI method.
@@ -187,66 +622,69 @@ def calculate_wqi(data):
     Returns:
     - float: Water Quality Index (rounded to 2 decimals), or None if no valid data.
     """
+    return get_wqi_model().score(data)
 
-    cfg_wqi = CONFIG.get("wqi", {})  # read WQI portion of config
-    IDEAL = cfg_wqi.get("ideal", {  # ideal target values for each parameter
-        "ph": 7.0,
-        "do": 14.6,
-        "turbidity": 0.0,
-        "tds": 0.0,
-        "nitrate": 0.0,
-        "temperature": 25.0,
-    })
-    STANDARD = cfg_wqi.get("standard", {  # permissible standard values for each parameter
-        "ph": 8.5,
-        "do": 5.0,
-        "turbidity": 5.0,
-        "tds": 500.0,
-        "nitrate": 45.0,
-        "temperature": 30.0,
-    })
-
-    # 3) Proportionality constant K
-    try:
-        K = 1 / sum(1 / v for v in STANDARD.values())  # proportionality constant using standards
-    except ZeroDivisionError:
-        return None
-
-    total_qw = 0.0
-    total_w = 0.0
-
-    for param in STANDARD:  # iterate each parameter (ph, do, turbidity, etc.)
-        if param not in data or data[param] is None:
-            continue
+def calculate_wqi_many(rows):
+    """Batch form of calculate_wqi: one WQI (or None) per reading dict."""
+    return get_wqi_model().score_many(rows)
 
-        try:
-            Vo = float(data[param])  # observed value from input
-            Vi = IDEAL[param]        # ideal target value
-            Vs = STANDARD[param]     # permissible standard value
 
-            Wi = K / Vs  # unit weight for this parameter
+DEFAULT_STATUS_THRESHOLDS = [  # used when config.json has no wqi.status_thresholds
+    {"max": 25, "status": "Excellent", "color": "success"},
+    {"max": 50, "status": "Good", "color": "primary"},
+    {"max": 75, "status": "Poor", "color": "warning"},
+    {"max": 100, "status": "Very Poor", "color": "danger"},
+    {"max": None, "status": "Unfit for Consumption", "color": "dark"},
+]
+NO_DATA_STATUS = ("No Data", "secondary")
 
-            # quality rating Qi: how far the observed value is from ideal/standard
-            if param == "do":
-                Qi = (Vi - Vo) / (Vi - Vs) * 100  # for DO, lower than ideal is worse
-            elif param in ["ph", "temperature"]:
-                Qi = abs(Vo - Vi) / (Vs - Vi) * 100  # absolute deviation from ideal
-            else:
-                Qi = (Vo - Vi) / (Vs - Vi) * 100  # higher than ideal indicates worse quality
+class StatusClassifier:
+    """
+    WQI -> (status, color) lookup compiled from status_thresholds.
 
-            Qi = max(0.0, Qi)  # clamp negative to zero
+    Thresholds are tried in the order listed and the first with wqi <= max wins, so only
+    buckets with a larger max than every earlier one are reachable. Those bounds are kept
+    sorted, with the open-ended (max: null) label after them; one value is classified with
+    bisect and an array with np.searchsorted.
+    """
 
-            total_qw += Qi * Wi  # accumulate Qi weighted
-            total_w += Wi        # accumulate weights
+    def __init__(self, thresholds):
+        self.bounds = []
+        self.labels = []
+        above = ("Unknown", "secondary")  # no open-ended bucket configured
+        for t in thresholds:
+            label = (t.get("status") or "Unknown", t.get("color") or "secondary")
+            if t.get("max") is None:
+                above = label
+                break  # later buckets can never match
+            mx = float(t["max"])
+            if not self.bounds or mx > self.bounds[-1]:
+                self.bounds.append(mx)
+                self.labels.append(label)
+        self.lookup = self.labels + [above]
+        self.bounds_array = np.array(self.bounds, dtype=float)
 
-        except (ValueError, TypeError, ZeroDivisionError):
-            continue
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("wqi", {}).get("status_thresholds") or DEFAULT_STATUS_THRESHOLDS)
 
-    if total_w == 0:
-        return None
+    def classify(self, wqi):
+        if wqi is None or not isfinite(wqi):
+            return NO_DATA_STATUS  # NaN would otherwise bisect into the first bucket
+        return self.lookup[bisect_left(self.bounds, wqi)]  # first bucket with wqi <= max
 
-    return round(total_qw / total_w, 2)  # weighted average -> final WQI
+    def classify_many(self, values):
+        """(status, color) for each WQI in values (None, NaN, inf -> No Data)."""
+        arr = np.array([np.nan if v is None else v for v in values], dtype=float)
+        idx = np.searchsorted(self.bounds_array, arr, side="left")
+        lookup = self.lookup
+        return [lookup[i] if ok else NO_DATA_STATUS for i, ok in zip(idx.tolist(), np.isfinite(arr).tolist())]
 
+def get_status_classifier():
+    global STATUS_CLASSIFIER
+    if STATUS_CLASSIFIER is None:
+        STATUS_CLASSIFIER = StatusClassifier.from_config(CONFIG)  # compile once per config load
+    return STATUS_CLASSIFIER
 
 def get_status(wqi):
     """
@@ -255,26 +693,21 @@ def get_status(wqi):
     - wqi: Water Quality Index (float)
     Returns: (status_string, bootstrap_color)
     """
+    return get_status_classifier().classify(wqi)
 
-    if wqi is None:
-        return "No Data", "secondary"  # no score -> show secondary
-    thresholds = CONFIG.get("wqi", {}).get("status_thresholds")  # pick thresholds from config
-    if not thresholds:
-        if wqi <= 25:
-            return "Excellent", "success"
-        elif wqi <= 50:
-            return "Good", "primary"
-        elif wqi <= 75:
-            return "Poor", "warning"
-        elif wqi <= 100:
-            return "Very Poor", "danger"
-        else:
-            return "Unfit for Consumption", "dark"
-    for t in thresholds:  # find the first threshold bucket matching this wqi
-        mx = t.get("max")
-        if mx is None or wqi <= float(mx):
-            return t.get("status") or "Unknown", t.get("color") or "secondary"
-    return "Unknown", "secondary"
+def get_statuses(values):
+    """Batch form of get_status."""
+    return get_status_classifier().classify_many(values)
+
+def stored_status(wqi, status, color):
+    # status/color stored with a current score, falling back to classifying rows written before they were stored
+    return (status, color) if status is not None else get_status(wqi)
+
+def score_sample(sample):
+    # (re)score a WaterSample from its readings and store status/color and the config fingerprint with it
+    sample.wqi = calculate_wqi(sample_payload(sample))
+    sample.status, sample.color = get_status(sample.wqi)
+    sample.wqi_config = get_wqi_fingerprint()
 
 # --- Utility: Haversine distance (km) ---
 def haversine_distance(lat1, lng1, lat2, lng2):
@@ -282,9 +715,648 @@ def haversine_distance(lat1, lng1, lat2, lng2):
     dlat = radians(lat2 - lat1)
     dlng = radians(lng2 - lng1)
     a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlng / 2) ** 2
+    a = min(1.0, a)  # rounding can push antipodal points just past 1
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
     return R * c
 
+# --- Spatial index for nearest-location lookups ---
+EARTH_RADIUS_KM = 6371.0
+SPATIAL_CELL_DEG = 1.0  # grid cell size in degrees
+SPATIAL_CHECK_INTERVAL_S = 30  # how often a worker checks the DB for writes made by other workers
+
+class SpatialIndex:
+    """
+    Lat/lng grid over user and reference locations.
+
+    Points are bucketed into SPATIAL_CELL_DEG cells; a query scans rings of cells
+    outward from the query cell and stops once no unscanned cell can hold a point
+    closer than the current k-th best (great-circle lower bound), so lookups touch
+    only the neighbourhood of the click regardless of how many points exist.
+    """
+
+    def __init__(self, cell_deg=SPATIAL_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.n_lat = int(round(180 / cell_deg))
+        self.n_lng = int(round(360 / cell_deg))
+        self.cells = {}   # (lat_cell, lng_cell) -> {key: (lat, lng)}
+        self.points = {}  # key -> (lat_cell, lng_cell)
+        self.lock = threading.RLock()
+        self.signature = None  # DB state the index was built from
+        self.checked_at = 0.0
+
+    def _cell(self, lat, lng):
+        i = min(int(floor((lat + 90) / self.cell_deg)), self.n_lat - 1)
+        j = int(floor((lng + 180) / self.cell_deg)) % self.n_lng
+        return i, j
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, key, lat, lng):
+        with self.lock:
+            self.remove(key)
+            cell = self._cell(lat, lng)
+            self.cells.setdefault(cell, {})[key] = (lat, lng)
+            self.points[key] = cell
+
+    def remove(self, key):
+        with self.lock:
+            cell = self.points.pop(key, None)
+            if cell is None:
+                return
+            bucket = self.cells.get(cell)
+            bucket.pop(key, None)
+            if not bucket:
+                del self.cells[cell]
+
+    def _ring(self, ci, cj, r):
+        """
+        Cells first reached at Chebyshev distance r (longitude wraps, latitude clips), each once.
+        Once 2r+1 exceeds n_lng the side columns wrap onto columns scanned by earlier rings;
+        when 2r == n_lng both sides are the single column half the grid away.
+        """
+        if r == 0:
+            yield ci, cj
+            return
+        span = min(2 * r + 1, self.n_lng)
+        for i in range(ci - r, ci + r + 1):
+            if i < 0 or i >= self.n_lat:
+                continue
+            if i in (ci - r, ci + r):
+                for dj in range(span):
+                    yield i, (cj - r + dj) % self.n_lng
+            elif 2 * r + 1 <= self.n_lng:
+                yield i, (cj - r) % self.n_lng
+                yield i, (cj + r) % self.n_lng
+            elif 2 * r == self.n_lng:
+                yield i, (cj + r) % self.n_lng
+
+    def _covers_grid(self, r):
+        # rings 0..r have reached every row and every column
+        return r >= self.n_lat - 1 and 2 * r >= self.n_lng - 1
+
+    def _unscanned_bound_km(self, lat, lng, ci, cj, r):
+        # smallest possible distance to any point outside the (2r+1)x(2r+1) block already scanned
+        low_edge = (ci - r) * self.cell_deg - 90
+        high_edge = (ci + r + 1) * self.cell_deg - 90
+        lat_gaps = []
+        if low_edge > -90:
+            lat_gaps.append(lat - low_edge)
+        if high_edge < 90:
+            lat_gaps.append(high_edge - lat)
+        bound = radians(min(lat_gaps)) * EARTH_RADIUS_KM if lat_gaps else float("inf")
+        if 2 * r + 1 < self.n_lng:
+            west_edge = (cj - r) * self.cell_deg - 180
+            east_edge = (cj + r + 1) * self.cell_deg - 180
+            dlng = radians(min(lng - west_edge, east_edge - lng))
+            # hav(d) >= cos(lat_q) * cos(lat_p) * hav(dlng); take the smallest cos(lat_p) in the block
+            cos_min = max(0.0, min(cos(radians(max(low_edge, -90))), cos(radians(min(high_edge, 90)))))
+            h = max(0.0, cos(radians(lat)) * cos_min) * sin(dlng / 2) ** 2
+            bound = min(bound, 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(h))))
+        return bound
+
+    def nearest(self, lat, lng, k=1, radius_km=None, kinds=None):
+        """
+        Returns up to k (distance_km, key) pairs sorted by distance.
+
+        - radius_km: only points within this great-circle distance.
+        - kinds: restrict to keys whose first element is in this set (e.g. {"location"}).
+        """
+        with self.lock:
+            if not self.points or k <= 0:
+                return []
+            lng = (lng + 180) % 360 - 180
+            ci, cj = self._cell(lat, lng)
+            best = []  # max-heap of (-distance, key)
+            seen = 0
+            r = 0
+            while True:
+                for cell in self._ring(ci, cj, r):
+                    bucket = self.cells.get(cell)
+                    if not bucket:
+                        continue
+                    seen += len(bucket)
+                    for key, (plat, plng) in bucket.items():
+                        if kinds is not None and key[0] not in kinds:
+                            continue
+                        dist = haversine_distance(lat, lng, plat, plng)
+                        if radius_km is not None and dist > radius_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-dist, key))
+                        elif dist < -best[0][0]:
+                            heapq.heapreplace(best, (-dist, key))
+                if seen >= len(self.points) or self._covers_grid(r):
+                    break  # every point has been considered (fewer than k may match)
+                bound = self._unscanned_bound_km(lat, lng, ci, cj, r)
+                if radius_km is not None and bound > radius_km:
+                    break
+                if len(best) == k and bound >= -best[0][0]:
+                    break
+                r += 1
+            return sorted((-d, key) for d, key in best)
+
+SPATIAL_INDEX = SpatialIndex()
+
+def _spatial_signature():
+    # cheap fingerprint of both point tables; changes when any worker inserts or deletes
+    loc = db.session.query(db.func.count(Location.id), db.func.max(Location.id)).one()
+    ref = db.session.query(db.func.count(ReferenceLocation.id), db.func.max(ReferenceLocation.id)).one()
+    return tuple(loc) + tuple(ref)
+
+def get_spatial_index():
+    # build on first use and rebuild when another worker changed the tables
+    now = time.time()
+    idx = SPATIAL_INDEX
+    if idx.signature is not None and now - idx.checked_at < SPATIAL_CHECK_INTERVAL_S:
+        return idx
+    signature = _spatial_signature()
+    with idx.lock:
+        idx.checked_at = now
+        if signature != idx.signature:
+            idx.cells.clear()
+            idx.points.clear()
+            for loc_id, lat, lng in db.session.query(Location.id, Location.latitude, Location.longitude):
+                idx.add(("location", loc_id), lat, lng)
+            for ref_id, lat, lng in db.session.query(ReferenceLocation.id, ReferenceLocation.latitude, ReferenceLocation.longitude):
+                idx.add(("reference", ref_id), lat, lng)
+            idx.signature = signature
+    return idx
+
+def _refresh_spatial_signature():
+    # after a local write the in-memory index is already current; record the new DB state
+    if SPATIAL_INDEX.signature is not None:
+        SPATIAL_INDEX.signature = _spatial_signature()
+        SPATIAL_INDEX.checked_at = time.time()
+
+# --- Map clusters for /api/locations?bbox&zoom ---
+MAP_TILE_SIZE = 256  # web mercator pixels per tile, as used by Google Maps
+MAP_MAX_LAT = 85.05112878  # mercator cut-off
+MAP_MAX_ZOOM = 22
+CLUSTER_CHECK_INTERVAL_S = 10  # how often a worker checks the DB for writes made by other workers
+
+def mercator(lat, lng):
+    # normalized web mercator coordinates in [0, 1) for arrays of degrees
+    lat = np.clip(lat, -MAP_MAX_LAT, MAP_MAX_LAT)
+    x = (np.asarray(lng, dtype=float) + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)
+    return np.clip(x, 0.0, 1.0 - 1e-12), np.clip(y, 0.0, 1.0 - 1e-12)
+
+class MapPoints:
+    """
+    Column arrays of every user and reference location, with grid clusters built per zoom on first use.
+
+    At zoom z the world is (256 * 2^z) pixels wide; points are grouped by the cluster_radius_px
+    grid cell they fall in. Each cluster keeps its count, centroid, member bounds and WQI
+    count/sum/min/max, aggregated with one sort and reduceat per zoom.
+    """
+
+    def __init__(self, items):
+        self.items = items  # point payloads, as listed by the unfiltered /api/locations
+        n = len(items)
+        self.lat = np.fromiter((item["latitude"] for item in items), dtype=float, count=n)
+        self.lng = np.fromiter((item["longitude"] for item in items), dtype=float, count=n)
+        self.wqi = np.fromiter((np.nan if item["wqi"] is None else item["wqi"] for item in items), dtype=float, count=n)
+        self.x, self.y = mercator(self.lat, self.lng)
+        self.zooms = {}
+        self.lock = threading.Lock()
+
+    def cells_per_side(self, zoom, radius_px):
+        return MAP_TILE_SIZE * (2 ** zoom) / float(radius_px)
+
+    def clusters(self, zoom, radius_px):
+        key = (zoom, radius_px)
+        grid = self.zooms.get(key)
+        if grid is not None:
+            return grid
+        with self.lock:
+            grid = self.zooms.get(key)
+            if grid is None:
+                grid = self.zooms[key] = self._build(zoom, radius_px)
+        return grid
+
+    def _build(self, zoom, radius_px):
+        scale = self.cells_per_side(zoom, radius_px)
+        cx = np.floor(self.x * scale).astype(np.int64)
+        cy = np.floor(self.y * scale).astype(np.int64)
+        keys = cx * (int(scale) + 1) + cy
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        if not len(sorted_keys):
+            starts = np.zeros(0, dtype=np.int64)
+        else:
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        counts = np.diff(np.r_[starts, len(sorted_keys)])
+        lat, lng, wqi = self.lat[order], self.lng[order], self.wqi[order]
+        has_wqi = ~np.isnan(wqi)
+        def reduce(ufunc, values):
+            return ufunc.reduceat(values, starts) if len(starts) else values[:0]
+        return {
+            "cx": cx[order][starts], "cy": cy[order][starts], "count": counts,
+            "first": order[starts],  # one member, used when a cell holds a single point
+            "lat": reduce(np.add, lat) / np.maximum(counts, 1), "lng": reduce(np.add, lng) / np.maximum(counts, 1),
+            "south": reduce(np.minimum, lat), "north": reduce(np.maximum, lat),
+            "west": reduce(np.minimum, lng), "east": reduce(np.maximum, lng),
+            "wqi_n": reduce(np.add, has_wqi.astype(np.int64)), "wqi_sum": reduce(np.add, np.where(has_wqi, wqi, 0.0)),
+            "wqi_min": reduce(np.fmin, wqi), "wqi_max": reduce(np.fmax, wqi),  # fmin/fmax skip NaN
+        }
+
+    def query(self, bbox, zoom, max_cluster_zoom, radius_px):
+        """Items inside bbox (west, south, east, north): clusters up to max_cluster_zoom, then points."""
+        west, south, east, north = bbox
+        if zoom > max_cluster_zoom:
+            in_lng = (self.lng >= west) & (self.lng <= east) if west <= east else (self.lng >= west) | (self.lng <= east)
+            mask = in_lng & (self.lat >= south) & (self.lat <= north)
+            return [dict(self.items[i], type="point") for i in np.flatnonzero(mask)]
+        grid = self.clusters(zoom, radius_px)
+        scale = self.cells_per_side(zoom, radius_px)
+        (x0, x1), (y0, y1) = mercator([north, south], [west, east])
+        cx0, cx1, cy0, cy1 = (int(floor(v * scale)) for v in (x0, x1, y0, y1))
+        cx, cy = grid["cx"], grid["cy"]
+        in_x = (cx >= cx0) & (cx <= cx1) if west <= east else (cx >= cx0) | (cx <= cx1)  # bbox across the antimeridian
+        out = []
+        for i in np.flatnonzero(in_x & (cy >= cy0) & (cy <= cy1)):
+            count = int(grid["count"][i])
+            if count == 1:
+                out.append(dict(self.items[grid["first"][i]], type="point"))
+                continue
+            wqi_n = int(grid["wqi_n"][i])
+            avg = float(grid["wqi_sum"][i]) / wqi_n if wqi_n else None
+            status, color = get_status(avg) if avg is not None else ("No Data", "secondary")  # colored by the mean
+            out.append({
+                "type": "cluster",
+                "count": count,
+                "latitude": float(grid["lat"][i]),
+                "longitude": float(grid["lng"][i]),
+                "bounds": [float(grid["south"][i]), float(grid["west"][i]), float(grid["north"][i]), float(grid["east"][i])],
+                "wqi_count": wqi_n,
+                "wqi_min": float(grid["wqi_min"][i]) if wqi_n else None,
+                "wqi_avg": round(avg, 2) if avg is not None else None,
+                "wqi_max": float(grid["wqi_max"][i]) if wqi_n else None,
+                "status": status,
+                "color": color,
+            })
+        return out
+
+class MapClusterIndex:
+    """
+    Process-wide MapPoints snapshot for the clustered map endpoint.
+
+    Sample and location writes in this process call invalidate(). Writes made by other workers
+    show up as a new data_generation() when the response cache is shared, and otherwise through
+    a table signature checked at most every CLUSTER_CHECK_INTERVAL_S. The snapshot is rebuilt
+    on the next request after any of these.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.points = None
+        self.signature = None
+        self.checked_at = 0.0
+        self.data_generation = None  # data_generation() the snapshot was built at
+        self.generation = 0  # bumped by invalidate(); a build that overlapped a write is not kept
+
+    def invalidate(self):
+        self.generation += 1
+        self.points = None
+
+    def get(self):
+        now = time.time()
+        data_gen = data_generation()
+        points = self.points
+        if points is not None and data_gen == self.data_generation and now - self.checked_at < CLUSTER_CHECK_INTERVAL_S:
+            return points
+        signature = _map_signature()
+        with self.lock:
+            if self.points is not None and signature == self.signature and data_gen == self.data_generation:
+                self.checked_at = now
+                return self.points
+            generation = self.generation
+            points = MapPoints(map_location_items())
+            if generation == self.generation:
+                self.points, self.signature, self.checked_at = points, signature, now
+                self.data_generation = data_gen
+        return points
+
+MAP_CLUSTERS = MapClusterIndex()
+
+def _map_signature():
+    # spatial signature plus sample count/max id: changes when any worker adds or removes a sample
+    samples = db.session.query(db.func.count(WaterSample.id), db.func.max(WaterSample.id)).one()
+    return _spatial_signature() + tuple(samples)
+
+MAP_LOCATION_ROWS = (select(Location.id, Location.name, Location.latitude, Location.longitude, Location.latest_sample_id,
+                            WaterSample.wqi, WaterSample.wqi_config, WaterSample.status, WaterSample.color,
+                            WaterSample.ph, WaterSample.do, WaterSample.tds, WaterSample.turbidity,
+                            WaterSample.nitrate, WaterSample.temperature)
+                     .outerjoin(WaterSample, WaterSample.id == Location.latest_sample_id)
+                     .order_by(Location.id))
+
+def map_location_rows(status, fingerprint):
+    # rows whose latest sample has this status: an indexed lookup on the stored status of current
+    # rows, plus stale rows (classified by the caller) and, for "No Data", locations without samples
+    queries = [
+        MAP_LOCATION_ROWS.where(WaterSample.status == status, WaterSample.wqi_config == fingerprint),
+        MAP_LOCATION_ROWS.where(Location.latest_sample_id.is_not(None), stale_samples_clause(fingerprint)),
+    ]
+    if status == NO_DATA_STATUS[0]:
+        queries.append(MAP_LOCATION_ROWS.where(Location.latest_sample_id.is_(None)))
+    return sorted((row for stmt in queries for row in db.session.execute(stmt)), key=lambda row: row.id)
+
+def map_location_items(status=None):
+    """
+    User locations with their latest WQI followed by the static references, as map point payloads.
+    Reads plain column rows rather than ORM objects (hydration dominates at 100k locations).
+    Current rows use their stored status; stale ones are rescored in one batch, as in
+    locations_with_latest_sample.
+    - status: only return locations (and references) with this status.
+    """
+    fingerprint = get_wqi_fingerprint()
+    if status is None:
+        rows = db.session.execute(MAP_LOCATION_ROWS).all()
+    else:
+        rows = map_location_rows(status, fingerprint)
+    wqi_values = [row.wqi for row in rows]
+    labels = [NO_DATA_STATUS if row.latest_sample_id is None else stored_status(row.wqi, row.status, row.color)
+              for row in rows]
+    stale = [i for i, row in enumerate(rows) if row.latest_sample_id is not None and row.wqi_config != fingerprint]
+    if stale:
+        payloads = [{"ph": rows[i].ph, "do": rows[i].do, "tds": rows[i].tds, "turbidity": rows[i].turbidity,
+                     "nitrate": rows[i].nitrate, "temperature": rows[i].temperature} for i in stale]
+        scores = calculate_wqi_many(payloads)
+        for i, score, label in zip(stale, scores, get_statuses(scores)):
+            wqi_values[i] = score
+            labels[i] = label
+    output = []
+    for row, wqi_val, (row_status, color) in zip(rows, wqi_values, labels):
+        if status is not None and row_status != status:
+            continue  # a stale row that classifies differently now
+        output.append({
+            "name": row.name,
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "wqi": wqi_val,
+            "status": row_status,
+            "color": color
+        })
+    for item in ReferenceLocation.query.all():
+        ref_status, color = get_status(item.wqi)
+        if status is not None and ref_status != status:
+            continue
+        output.append({
+            "name": item.name + " (" + item.location + ")",
+            "latitude": item.latitude,
+            "longitude": item.longitude,
+            "wqi": item.wqi,
+            "status": ref_status,
+            "color": color
+        })
+    return output
+
+def parse_bbox(value):
+    # "west,south,east,north" in degrees; west > east means the box crosses the antimeridian
+    try:
+        west, south, east, north = (float(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        return None
+    return west, south, east, north
+
+# --- Metrics (Prometheus text format at /metrics) ---
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")
+METRICS_DUMP_INTERVAL_S = 5.0  # how often a worker writes its snapshot for the other workers
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)  # statements per request
+CHAT_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+METRIC_DEFS = {  # name -> (type, help, histogram buckets); rendered in this order
+    "wqi_http_requests_total": ("counter", "HTTP requests by method, route and status.", None),
+    "wqi_http_request_duration_seconds": ("histogram", "Time to build the response (until headers for streamed responses).", LATENCY_BUCKETS),
+    "wqi_http_request_sql_queries": ("histogram", "SQL statements executed per request.", SQL_COUNT_BUCKETS),
+    "wqi_http_request_sql_seconds": ("histogram", "Time spent in SQL per request.", LATENCY_BUCKETS),
+    "wqi_http_slow_requests_total": ("counter", "Requests slower than metrics.slow_request_ms.", None),
+    "wqi_sql_queries_total": ("counter", "SQL statements executed, including background threads.", None),
+    "wqi_iot_readings_queued_total": ("counter", "IoT readings accepted into the write-behind queue.", None),
+    "wqi_iot_readings_written_total": ("counter", "IoT readings committed to the database.", None),
+    "wqi_iot_queue_depth": ("gauge", "IoT readings waiting in the write-behind queue.", None),
+    "wqi_iot_queue_capacity": ("gauge", "Size of the IoT write-behind queue (0 when write-behind is off).", None),
+    "wqi_iot_stream_subscribers": ("gauge", "Open /api/iot/stream connections.", None),
+    "wqi_chat_upstream_duration_seconds": ("histogram", "Chat router latency by outcome (until response headers for streams).", CHAT_LATENCY_BUCKETS),
+    "wqi_chat_cache_requests_total": ("counter", "Chat cache lookups by result.", None),
+    "wqi_response_cache_requests_total": ("counter", "Cached page lookups by route and result.", None),
+}
+
+class Metrics:
+    """
+    Process-local counters and histograms rendered in the Prometheus text format.
+
+    Histograms are kept as per-bucket counts plus a sum. With metrics.shared each gunicorn
+    worker also writes a JSON snapshot to data/metrics/ every few seconds, and /metrics adds
+    up the snapshots of all workers so any worker can answer a scrape for the whole app.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> number (counter) or [bucket counts..., +Inf count, sum] (histogram)
+        self.dumped_at = 0.0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = METRIC_DEFS[name][2]
+        key = (name, labels)
+        with self.lock:
+            hist = self.values.get(key)
+            if hist is None:
+                hist = self.values[key] = [0] * (len(buckets) + 1) + [0.0]
+            hist[bisect_left(buckets, value)] += 1  # first bucket with value <= le
+            hist[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            items = [[name, list(labels), list(value) if isinstance(value, list) else value]
+                     for (name, labels), value in self.values.items()]
+        items.extend([name, [], value] for name, value in metrics_gauges().items())
+        return {"pid": os.getpid(), "values": items}
+
+    def maybe_dump(self):
+        if not CONFIG.get("metrics", {}).get("shared", True):
+            return
+        now = time.monotonic()
+        if now - self.dumped_at < METRICS_DUMP_INTERVAL_S:
+            return
+        self.dumped_at = now
+        self.dump()
+
+    def dump(self):
+        # atomic replace, so a concurrent scrape never reads a half-written file
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            app.logger.warning(f"Metrics snapshot failed: {e}")
+
+    def render(self):
+        snapshots = [self.snapshot()]
+        if CONFIG.get("metrics", {}).get("shared", True):
+            snapshots.extend(read_worker_snapshots())
+        merged = {}
+        for snap in snapshots:
+            for name, labels, value in snap["values"]:
+                if name not in METRIC_DEFS:
+                    continue  # written by an older version of the app
+                if METRIC_DEFS[name][0] == "gauge" and not snap.get("live", True):
+                    continue  # a dead worker's queue is gone; its counters still count
+                key = (name, tuple(tuple(pair) for pair in labels))
+                if isinstance(value, list):
+                    current = merged.get(key)
+                    merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFS.items():
+            series = sorted((labels, value) for (n, labels), value in merged.items() if n == name)
+            if not series and kind != "gauge":
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{metric_labels(labels)} {metric_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else metric_number(bound)
+                    lines.append(f"{name}_bucket{metric_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{metric_labels(labels)} {metric_number(value[-1])}")
+                lines.append(f"{name}_count{metric_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+def metric_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def metrics_gauges():
+    writer = IOT_WRITER
+    return {
+        "wqi_iot_queue_depth": writer.depth() if writer else 0,
+        "wqi_iot_queue_capacity": writer.max_size if writer else 0,
+        "wqi_iot_stream_subscribers": len(IOT_HUB.subscribers),
+    }
+
+def read_worker_snapshots():
+    # snapshots of the other workers; files of exited workers keep their counters but not their gauges
+    out = []
+    own = os.getpid()
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if snap.get("pid") == own:
+            continue
+        snap["live"] = pid_alive(snap.get("pid"))
+        out.append(snap)
+    return out
+
+def pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, TypeError, ValueError):
+        return False
+    return True
+
+@event.listens_for(Engine, "before_cursor_execute")
+def sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info["metrics_started"] = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def sql_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("metrics_started", None)
+    if started is None:
+        return
+    METRICS.inc("wqi_sql_queries_total")
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+        g.sql_seconds += time.perf_counter() - started
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    observe_request(response.status_code)
+    return response
+
+@app.teardown_request
+def record_failed_request(exc):
+    # after_request is skipped when an exception propagates (debug, PROPAGATE_EXCEPTIONS) or an
+    # error handler itself fails; count those as 500s. observe_request runs once per request.
+    if exc is not None:
+        observe_request(500)
+
+def observe_request(status):
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"  # bounded label set
+    labels = (("method", request.method), ("route", route))
+    METRICS.inc("wqi_http_requests_total", labels + (("status", str(status)),))
+    METRICS.observe("wqi_http_request_duration_seconds", elapsed, labels)
+    METRICS.observe("wqi_http_request_sql_queries", g.sql_queries, labels)
+    METRICS.observe("wqi_http_request_sql_seconds", g.sql_seconds, labels)
+    slow_ms = float(CONFIG.get("metrics", {}).get("slow_request_ms", 1000))
+    if slow_ms > 0 and elapsed * 1000 >= slow_ms:
+        METRICS.inc("wqi_http_slow_requests_total", labels)
+        app.logger.warning(json.dumps({  # one JSON object per line for log shippers
+            "event": "slow_request", "method": request.method, "route": route, "path": request.path,
+            "status": status, "duration_ms": round(elapsed * 1000, 1),
+            "sql_queries": g.sql_queries, "sql_ms": round(g.sql_seconds * 1000, 1),
+        }))
+    METRICS.maybe_dump()
+
+def observe_chat_upstream(started, ok):
+    METRICS.observe("wqi_chat_upstream_duration_seconds", time.perf_counter() - started,
+                    (("outcome", "ok" if ok else "error"),))
+
+def count_chat_cache(hit):
+    METRICS.inc("wqi_chat_cache_requests_total", (("result", "hit" if hit else "miss"),))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # optional bearer token, so the endpoint can be exposed without publishing traffic details
+    token = os.environ.get("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+def dump_metrics_on_exit():
+    # keep a serving worker's final counts for the next scrape (CLI commands never dumped, so skip them)
+    if METRICS.dumped_at:
+        METRICS.dump()
+
+atexit.register(dump_metrics_on_exit)
+
 # --- Routes ---
 @app.route('/')
 def home():
@@ -330,88 +1402,105 @@ def chat():
     if not token:
         return jsonify({"error": "Server is not configured with Hugging Face token"}), 500
 
-    system_prefix = (
-        "You are a helpful assistant. Provide detailed and comprehensive answers when the user asks for explanations. "
-        "Keep your answers compact and brief yet logical and meaningful, ensuring the user gets a complete answer without being cut off. "
-        "Do not include your internal chain of thought or reasoning process in the final output, only the response to the user."
-    )
-    model_id = os.environ.get("HF_CHAT_MODEL", "HuggingFaceTB/SmolLM3-3B:hf-inference")  # primary chat model
-    fallback_model = "HuggingFaceTB/SmolLM3-3B:hf-inference"  # fallback if primary fails
-    try:
-        resp = requests.post(  # call Hugging Face chat completions
-            "https://router.huggingface.co/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model_id,
-                "messages": [
-                    {"role": "system", "content": system_prefix},
-                    {"role": "user", "content": user_message},
-                ],
-                "max_tokens": 3000,
-                "temperature": 0.7,
-            },
-            timeout=60,
-        )
-    except Exception as e:
-        return jsonify({"error": "Chat service unreachable", "detail": str(e)}), 502
+    model_id = os.environ.get("HF_CHAT_MODEL", CHAT_FALLBACK_MODEL)  # primary chat model
+    key = chat_cache_key(model_id, user_message)
+    cached = get_chat_cache().get(key)
+    count_chat_cache(cached is not None)
+    if cached is not None:
+        resp = jsonify({"reply": cached})
+        resp.headers["X-Cache"] = "HIT"
+        return resp
+    def upstream():
+        # only the flight leader calls upstream, so only it needs a slot; None means busy
+        if not CHAT_SLOTS.acquire():
+            return None
+        started = time.perf_counter()
+        try:
+            result = chat_completion(token, model_id, user_message)
+        finally:
+            CHAT_SLOTS.release()
+        observe_chat_upstream(started, result[1] == 200)
+        return result
+    # identical questions asked concurrently share one upstream call; waiters hold no slot
+    result = CHAT_FLIGHTS.do(key, upstream)
+    if result is None:
+        return chat_busy_response()
+    body, status, answered = result
+    if status == 200:
+        # keyed on the model that answered: a fallback reply must not pass for the primary model's
+        get_chat_cache().set(chat_cache_key(answered, user_message), body["reply"])
+    resp = jsonify(body)
+    resp.status_code = status
+    resp.headers["X-Cache"] = "MISS"
+    return resp
 
+# --- Chat upstream client and response cache ---
+CHAT_URL = os.environ.get("HF_CHAT_URL", "https://router.huggingface.co/v1/chat/completions")
+CHAT_FALLBACK_MODEL = "HuggingFaceTB/SmolLM3-3B:hf-inference"  # fallback if primary fails
+CHAT_TIMEOUT = (5, 60)  # (connect, read) seconds; overridden by the chat section of config.json
+CHAT_SYSTEM_PREFIX = (
+    "You are a helpful assistant. Provide detailed and comprehensive answers when the user asks for explanations. "
+    "Keep your answers compact and brief yet logical and meaningful, ensuring the user gets a complete answer without being cut off. "
+    "Do not include your internal chain of thought or reasoning process in the final output, only the response to the user."
+)
+CHAT_CACHE_PATH = os.path.join(DATA_DIR, "chat_cache.db")
+CHAT_SESSION = None
+CHAT_SESSION_PID = None
+
+def get_chat_session():
+    # one pooled keep-alive session per process (not shared across fork)
+    global CHAT_SESSION, CHAT_SESSION_PID
+    if CHAT_SESSION is None or CHAT_SESSION_PID != os.getpid():
+        import requests  # only the chat proxy needs it; keep it off the worker boot path
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(CONFIG.get("chat", {}).get("pool_size", 16)))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept": "application/json", "Content-Type": "application/json"})
+        CHAT_SESSION, CHAT_SESSION_PID = session, os.getpid()
+    return CHAT_SESSION
+
+def chat_request_body(model, user_message, stream=False):
+    body = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": CHAT_SYSTEM_PREFIX},
+            {"role": "user", "content": user_message},
+        ],
+        "max_tokens": 3000,
+        "temperature": 0.7,
+    }
+    if stream:
+        body["stream"] = True
+    return body
+
+def chat_completion(token, model_id, user_message):
+    """
+    Calls the inference router (falling back to CHAT_FALLBACK_MODEL on an error status).
+
+    Returns: (json_body, http_status, model) — json_body/http_status ready for jsonify
+    ({"reply": ...} on success) and the model that answered.
+    """
+    session = get_chat_session()
+    headers = {"Authorization": f"Bearer {token}"}
+    deadline = time.monotonic() + chat_deadline()
+    model = model_id
+    try:
+        resp = session.post(CHAT_URL, headers=headers, json=chat_request_body(model_id, user_message), timeout=chat_timeout())
+    except Exception as e:
+        return {"error": "Chat service unreachable", "detail": str(e)}, 502, model
     if resp.status_code >= 400:
+        if model_id == CHAT_FALLBACK_MODEL or time.monotonic() >= deadline:
+            return {"error": "Chat service failed", "detail": resp.text}, 502, model
+        model = CHAT_FALLBACK_MODEL
         try:
-            data_err = resp.json()
-        except:
-            data_err = {}
-        if model_id != fallback_model:
-            try:
-                resp2 = requests.post(
-                    "https://router.huggingface.co/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Accept": "application/json",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": fallback_model,
-                        "messages": [
-                            {"role": "system", "content": system_prefix},
-                            {"role": "user", "content": user_message},
-                        ],
-                        "max_tokens": 3000,
-                        "temperature": 0.7,
-                    },
-                    timeout=60,
-                )
-            except Exception as e2:
-                return jsonify({"error": "Chat service unreachable", "detail": str(e2)}), 502
-            if resp2.status_code >= 400:
-                return jsonify({"error": "Chat service failed", "detail": resp2.text}), 502
-            try:
-                data = resp2.json()
-                content = (
-                    data.get("choices", [{}])[0]
-                    .get("message", {})
-                    .get("content", "")
-                )
-            except Exception:
-                return jsonify({"error": "Invalid response from chat service"}), 502
-            if not content:
-                content = "No answer available."
-            
-            # Check for incomplete finish
-            finish_reason = (
-                data.get("choices", [{}])[0]
-                .get("finish_reason", "")
-            )
-            content = clean_response(content)
-            if finish_reason == "length":
-                content += "\n\n(Note: My response was cut off because it reached the maximum length.)"
-                
-            return jsonify({"reply": content})
-        return jsonify({"error": "Chat service failed", "detail": resp.text}), 502
-
+            resp = session.post(CHAT_URL, headers=headers, json=chat_request_body(CHAT_FALLBACK_MODEL, user_message),
+                                timeout=chat_timeout(deadline))
+        except Exception as e2:
+            return {"error": "Chat service unreachable", "detail": str(e2)}, 502, model
+        if resp.status_code >= 400:
+            return {"error": "Chat service failed", "detail": resp.text}, 502, model
     try:
         data = resp.json()
         content = (
@@ -424,126 +1513,800 @@ def chat():
             .get("finish_reason", "")
         )
     except Exception:
-        return jsonify({"error": "Invalid response from chat service"}), 502
-
+        return {"error": "Invalid response from chat service"}, 502, model
     if not content:
         content = "No answer available."
     content = clean_response(content)
     if finish_reason == "length":
         content += "\n\n(Note: My response was cut off because it reached the maximum length.)"
+    return {"reply": content}, 200, model  # cleaned model output for the UI
 
-    return jsonify({"reply": content})  # return cleaned model output to the UI
+class ThinkStripper:
+    """
+    Incremental form of clean_response for streamed text.
 
-@app.route('/data')
-def data_page():
-    locations = Location.query.all()  # read all locations
-    rows = []
-    for loc in locations:
-        sample = (WaterSample.query  # fetch most recent sample for the location
-                  .filter_by(location_id=loc.id)
-                  .order_by(WaterSample.timestamp.desc())
-                  .first())
-        if sample and sample.wqi is None:
-            data = {"ph": sample.ph, "do": sample.do, "tds": sample.tds, "turbidity": sample.turbidity, "nitrate": sample.nitrate, "temperature": sample.temperature}
-            sample.wqi = calculate_wqi(data)
-            db.session.commit()
-        wqi_val = sample.wqi if sample else None  # may be None if no sample exists
-        status, color = get_status(wqi_val) if wqi_val is not None else ("No Data", "secondary")
-        rows.append({
-            "name": loc.name or "Unnamed",
-            "latitude": loc.latitude,
-            "longitude": loc.longitude,
-            "wqi": wqi_val,
-            "status": status,
-            "color": color,
-            "timestamp": sample.timestamp if sample else None,
-            "location_id": loc.id,
-            "sample_id": sample.id if sample else None,
-            "ph": sample.ph if sample else None,
-            "do": sample.do if sample else None,
-            "tds": sample.tds if sample else None,
-            "turbidity": sample.turbidity if sample else None,
-            "nitrate": sample.nitrate if sample else None,
-            "temperature": sample.temperature if sample else None,
-        })
-    ref_rows = ReferenceLocation.query.all()
-    return render_template("data.html", rows=rows, wb_data=ref_rows)
+    feed() returns the text that is safe to show so far. Text inside <think>...</think>,
+    or from "Thinking Process:" up to the next blank line, is dropped. A possible
+    partial marker at the end of a chunk is held back until the next chunk decides it.
+    Leading whitespace is dropped and trailing whitespace is only released once more
+    text follows, the way clean_response strips the whole reply.
+    """
 
-@app.route('/download_excel')
-def download_excel():
-    locations = Location.query.all()  # pull all data to export
-    data_list = []
-    
-    # User Data
-    for loc in locations:
-        sample = (WaterSample.query
-                  .filter_by(location_id=loc.id)
-                  .order_by(WaterSample.timestamp.desc())
-                  .first())
-        
-        row = {
-            "Location Name": loc.name,
-            "Latitude": loc.latitude,
-            "Longitude": loc.longitude,
-            "WQI": sample.wqi if sample else None,
-            "Status": get_status(sample.wqi)[0] if sample and sample.wqi is not None else "No Data",
-            "pH": sample.ph if sample else None,
-            "DO (mg/L)": sample.do if sample else None,
-            "TDS (mg/L)": sample.tds if sample else None,
-            "Turbidity (NTU)": sample.turbidity if sample else None,
-            "Nitrate (mg/L)": sample.nitrate if sample else None,
-            "Temperature (C)": sample.temperature if sample else None,
-            "Timestamp": sample.timestamp if sample else None,
-            "Type": "User Added"
-        }
-        data_list.append(row)
-    
-    # Static Reference Data
-    for item in ReferenceLocation.query.all():
-        row = {
-            "Location Name": item.name + " - " + item.location,
-            "Latitude": item.latitude,
-            "Longitude": item.longitude,
-            "WQI": item.wqi,
-            "Status": item.status,
-            "pH": None,
-            "DO (mg/L)": None,
-            "TDS (mg/L)": None,
-            "Turbidity (NTU)": None,
-            "Nitrate (mg/L)": None,
-            "Temperature (C)": None,
-            "Timestamp": None,
-            "Type": "Static Reference"
-        }
-        data_list.append(row)
-
-    df = pd.DataFrame(data_list)
-    
-    # Try using openpyxl for Excel, fallback to CSV if missing
-    try:
-        import openpyxl
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Water Quality Data')
-        
-        output.seek(0)
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'water_quality_data_{datetime.now().strftime("%Y%m%d")}.xlsx'
-        )
-    except ImportError:
-        # Fallback to CSV
-        output = io.BytesIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'water_quality_data_{datetime.now().strftime("%Y%m%d")}.csv'
-        )
+    MARKERS = [("<think>", "</think>", True), ("thinking process:", "\n\n", False)]  # (open, close, consume close)
+
+    def __init__(self):
+        self.buf = ""
+        self.closing = None  # active marker while inside a hidden span
+        self.started = False
+        self.pending = ""
+
+    @staticmethod
+    def _partial_suffix(text, marker):
+        # length of the longest suffix of text that is a proper prefix of marker
+        for n in range(min(len(marker) - 1, len(text)), 0, -1):
+            if text[-n:].lower() == marker[:n]:
+                return n
+        return 0
+
+    def feed(self, chunk):
+        self.buf += chunk
+        out = []
+        while True:
+            if self.closing is not None:
+                close, consume = self.closing
+                idx = self.buf.lower().find(close)
+                if idx < 0:
+                    keep = self._partial_suffix(self.buf, close)
+                    self.buf = self.buf[len(self.buf) - keep:] if keep else ""
+                    break
+                self.buf = self.buf[idx + len(close):] if consume else self.buf[idx:]
+                self.closing = None
+                continue
+            lowered = self.buf.lower()
+            hits = [(lowered.find(o), o, c, k) for o, c, k in self.MARKERS if lowered.find(o) >= 0]
+            if hits:
+                idx, opener, close, consume = min(hits)
+                out.append(self.buf[:idx])
+                self.buf = self.buf[idx + len(opener):]
+                self.closing = (close, consume)
+                continue
+            keep = max(self._partial_suffix(self.buf, o) for o, _, _ in self.MARKERS)
+            out.append(self.buf[:len(self.buf) - keep] if keep else self.buf)
+            self.buf = self.buf[len(self.buf) - keep:] if keep else ""
+            break
+        return self._emit("".join(out))
+
+    def _emit(self, text):
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self.started = True
+        text = self.pending + text
+        stripped = text.rstrip()
+        self.pending = text[len(stripped):]  # hold trailing whitespace back
+        return stripped
+
+    def finish(self):
+        # end of stream: a still-open span is dropped; reasoning never reaches the browser
+        rest, self.buf = ("" if self.closing is not None else self.buf), ""
+        return self._emit(rest)
+
+def stream_chat_completion(token, model_id, user_message, outcome):
+    """
+    Streams a completion from the router as Server-Sent Events for the browser.
+
+    Yields `data: {"delta": "..."}` events with cleaned text, then `event: done` with the
+    finish reason, or `event: error`. Falls back to CHAT_FALLBACK_MODEL when the primary
+    model answers with an error status before streaming starts. Completed replies are
+    stored in the chat cache.
+    - outcome: dict; "result" is set to the (json_body, http_status, model) chat_completion
+      would have returned, for callers waiting on the same question.
+    """
+    session = get_chat_session()
+    headers = {"Authorization": f"Bearer {token}", "Accept": "text/event-stream"}
+    resp = None
+    started = time.perf_counter()
+    deadline = time.monotonic() + chat_deadline()
+    for model in ([model_id] if model_id == CHAT_FALLBACK_MODEL else [model_id, CHAT_FALLBACK_MODEL]):
+        if model != model_id and time.monotonic() >= deadline:
+            break
+        try:
+            resp = session.post(CHAT_URL, headers=headers, json=chat_request_body(model, user_message, stream=True),
+                                timeout=chat_timeout(deadline), stream=True)
+        except Exception as e:
+            observe_chat_upstream(started, False)
+            outcome["result"] = ({"error": "Chat service unreachable", "detail": str(e)}, 502, model)
+            yield sse_event("error", outcome["result"][0])
+            return
+        if resp.status_code < 400:
+            break
+        detail = resp.text
+        resp.close()
+        resp = None
+    observe_chat_upstream(started, resp is not None)
+    if resp is None:
+        outcome["result"] = ({"error": "Chat service failed", "detail": detail}, 502, model)
+        yield sse_event("error", outcome["result"][0])
+        return
+
+    stripper = ThinkStripper()
+    parts = []
+    finish_reason = ""
+    try:
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            try:
+                choice = json.loads(data).get("choices", [{}])[0]
+            except (ValueError, IndexError, AttributeError):
+                continue
+            finish_reason = choice.get("finish_reason") or finish_reason
+            text = stripper.feed((choice.get("delta") or {}).get("content") or "")
+            if text:
+                parts.append(text)
+                yield sse_event(None, {"delta": text})
+        tail = stripper.finish()
+    except Exception as e:
+        outcome["result"] = ({"error": "Chat stream interrupted", "detail": str(e)}, 502, model)
+        yield sse_event("error", outcome["result"][0])
+        return
+    finally:
+        resp.close()  # return the connection to the pool
+    if tail:
+        parts.append(tail)
+        yield sse_event(None, {"delta": tail})
+    if not parts:
+        parts.append("No answer available.")
+        yield sse_event(None, {"delta": parts[0]})
+    if finish_reason == "length":
+        note = "\n\n(Note: My response was cut off because it reached the maximum length.)"
+        parts.append(note)
+        yield sse_event(None, {"delta": note})
+    get_chat_cache().set(chat_cache_key(model, user_message), "".join(parts))  # the model that answered
+    outcome["result"] = ({"reply": "".join(parts)}, 200, model)
+    yield sse_event("done", {"finish_reason": finish_reason or "stop"})
+
+def lead_chat_stream(key, call, token, model_id, user_message):
+    # the flight leader's stream: frees its slot and hands the reply to waiters when it ends
+    outcome = {}
+    try:
+        yield from stream_chat_completion(token, model_id, user_message, outcome)
+    finally:
+        CHAT_SLOTS.release()
+        CHAT_FLIGHTS.leave(key, call, outcome.get("result"))  # None if the client went away mid-stream
+
+def shared_chat_events(call):
+    # an identical question is already in flight: wait for its reply (no slot) and send it as one delta
+    result = CHAT_FLIGHTS.wait(call)
+    if result is None:
+        yield sse_event("error", {"error": "Chat is busy, please retry shortly"})
+        return
+    body, status, _ = result
+    if status != 200:
+        yield sse_event("error", body)
+        return
+    yield sse_event(None, {"delta": body["reply"]})
+    yield sse_event("done", {"finish_reason": "shared"})
+
+def sse_event(name, data):
+    prefix = f"event: {name}\n" if name else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    payload = request.get_json(silent=True) or {}
+    user_message = (payload.get("message") or "").strip()
+    if not user_message:
+        return jsonify({"error": "Please provide a question in 'message'"}), 400
+    token = os.environ.get("HUGGING_FACE_API_TOKEN")
+    if not token:
+        return jsonify({"error": "Server is not configured with Hugging Face token"}), 500
+    model_id = os.environ.get("HF_CHAT_MODEL", CHAT_FALLBACK_MODEL)
+    key = chat_cache_key(model_id, user_message)
+    cached = get_chat_cache().get(key)
+    count_chat_cache(cached is not None)
+    if cached is not None:
+        events = iter([sse_event(None, {"delta": cached}), sse_event("done", {"finish_reason": "cached"})])
+    else:
+        # same coalescing as /chat: only the leader streams from upstream and takes a slot
+        call, leader = CHAT_FLIGHTS.enter(key)
+        if not leader:
+            events = shared_chat_events(call)
+        elif not CHAT_SLOTS.acquire():
+            CHAT_FLIGHTS.leave(key, call, None)
+            return chat_busy_response()
+        else:
+            events = lead_chat_stream(key, call, token, model_id, user_message)
+    return Response(events, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def chat_cache_key(model_id, message):
+    # normalize case, whitespace and trailing punctuation so FAQ-style repeats share an entry
+    normalized = re.sub(r"\s+", " ", message.strip().lower()).rstrip(" ?!.")
+    return hashlib.sha256(f"{model_id}\n{normalized}".encode("utf-8")).hexdigest()
+
+class ChatCache:
+    """In-memory LRU of chat replies with a TTL."""
+
+    def __init__(self, ttl=86400.0, max_entries=500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (reply, stored_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or time.time() - item[1] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, reply):
+        with self.lock:
+            self.entries[key] = (reply, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)  # evict least recently used
+
+class SQLiteChatCache(ChatCache):
+    """Same interface backed by a SQLite file, so all workers and restarts share replies."""
+
+    def __init__(self, path, ttl=86400.0, max_entries=500):
+        super().__init__(ttl, max_entries)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS chat_cache (key TEXT PRIMARY KEY, reply TEXT NOT NULL,"
+                         " stored_at REAL NOT NULL, used_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_chat_cache_used_at ON chat_cache (used_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT reply, stored_at FROM chat_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    conn.execute("DELETE FROM chat_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE chat_cache SET used_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, reply):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO chat_cache (key, reply, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                         (key, reply, now, now))
+            conn.execute("DELETE FROM chat_cache WHERE key IN (SELECT key FROM chat_cache"
+                         " ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key wait and share its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> {"event": Event, "result": ...}
+
+    def enter(self, key):
+        """Returns (call, leader). The leader must finish with leave(); others wait(call)."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                return call, False
+            call = self.calls[key] = {"event": threading.Event(), "result": None}
+            return call, True
+
+    def leave(self, key, call, result):
+        call["result"] = result
+        with self.lock:
+            self.calls.pop(key, None)
+        call["event"].set()
+
+    @staticmethod
+    def wait(call):
+        call["event"].wait()
+        return call["result"]
+
+    def do(self, key, fn):
+        call, leader = self.enter(key)
+        if not leader:
+            return self.wait(call)
+        result = None
+        try:
+            result = fn()
+            return result
+        finally:
+            self.leave(key, call, result)
+
+class WorkerSlots:
+    """
+    Caps concurrent long-running requests of one kind per worker process.
+
+    The limit is read from CONFIG[section][key] on each acquire. acquire() never waits: when
+    every slot is taken the caller answers 503 straight away, so upstream chat calls and open
+    SSE streams cannot tie up every thread (or greenlet) that serves IoT ingest.
+    """
+
+    def __init__(self, section, key, default):
+        self.section, self.key, self.default = section, key, default
+        self.lock = threading.Lock()
+        self.in_use = 0
+
+    def limit(self):
+        return max(1, int(CONFIG.get(self.section, {}).get(self.key, self.default)))
+
+    def acquire(self):
+        with self.lock:
+            if self.in_use >= self.limit():
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_use = max(0, self.in_use - 1)
+
+CHAT_SLOTS = WorkerSlots("chat", "max_concurrent", 4)
+CHAT_FLIGHTS = SingleFlight()
+
+def chat_busy_response():
+    resp = jsonify({"error": "Chat is busy, please retry shortly"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(int(CONFIG.get("chat", {}).get("busy_retry_after_s", 5)))
+    return resp
+
+def chat_deadline():
+    # total budget for one question, primary and fallback model together
+    return float(CONFIG.get("chat", {}).get("deadline_s", 90))
+
+def chat_timeout(deadline=None):
+    """(connect, read) timeout for one upstream call, trimmed to what is left of deadline."""
+    cfg_chat = CONFIG.get("chat", {})
+    connect = float(cfg_chat.get("connect_timeout_s", CHAT_TIMEOUT[0]))
+    read = float(cfg_chat.get("read_timeout_s", CHAT_TIMEOUT[1]))
+    if deadline is not None:
+        left = max(1.0, deadline - time.monotonic())
+        connect, read = min(connect, left), min(read, left)
+    return (connect, read)
+
+CHAT_CACHE = None
+
+def get_chat_cache():
+    global CHAT_CACHE
+    if CHAT_CACHE is None:
+        cfg_chat = CONFIG.get("chat", {})
+        ttl = float(cfg_chat.get("cache_ttl_s", 86400))
+        max_entries = int(cfg_chat.get("cache_max_entries", 500))
+        if cfg_chat.get("cache_backend") == "sqlite":
+            CHAT_CACHE = SQLiteChatCache(CHAT_CACHE_PATH, ttl, max_entries)
+        else:
+            CHAT_CACHE = ChatCache(ttl, max_entries)
+    return CHAT_CACHE
+
+# --- Response cache for read-heavy pages ---
+RESPONSE_CACHE_PATH = os.path.join(DATA_DIR, "response_cache.db")
+
+class ResponseCache:
+    """
+    In-process LRU of rendered responses, tagged with the data generation they were built at.
+
+    The generation is bumped by every write to locations, samples or references (see
+    data_changed), which drops all entries at once. Only this process sees the bump, so use
+    it with a single worker; SQLiteResponseCache shares entries and generation between workers.
+    Entries older than max_age seconds (0 = no limit) are misses too: writes made on another
+    host sharing the database never bump this host's generation.
+    """
+
+    def __init__(self, max_entries=256, max_body_bytes=32 * 1024 * 1024, max_age=30.0):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> entry dict (generation, body, content_type, etag)
+        self.current = 0
+
+    def generation(self):
+        return self.current
+
+    def bump(self):
+        with self.lock:
+            self.current += 1
+            self.entries.clear()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["generation"] != self.current or self._expired(entry["stored_at"]):
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def _expired(self, stored_at):
+        return bool(self.max_age) and time.time() - stored_at > self.max_age
+
+    def set(self, key, entry):
+        with self.lock:
+            if entry["generation"] != self.current:
+                return  # rendered before a write that has since committed
+            self.entries[key] = dict(entry, stored_at=time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)  # evict least recently used
+
+class SQLiteResponseCache(ResponseCache):
+    """Same interface backed by a SQLite file, so every worker serves the same entries and sees the same bumps."""
+
+    def __init__(self, path, max_entries=256, max_body_bytes=32 * 1024 * 1024, max_age=30.0):
+        super().__init__(max_entries, max_body_bytes, max_age)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # lookups never wait for a worker storing an entry
+            conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, generation INTEGER NOT NULL,"
+                         " content_type TEXT NOT NULL, etag TEXT NOT NULL, body BLOB NOT NULL, stored_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_stored_at ON response_cache (stored_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_generation (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO cache_generation (id, value) VALUES (1, 0)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def generation(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT value FROM cache_generation WHERE id = 1").fetchone()[0]
+
+    def bump(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE cache_generation SET value = value + 1 WHERE id = 1")
+            conn.execute("DELETE FROM response_cache")
+
+    def get(self, key):
+        # hits are read-only (entries are evicted oldest-first rather than least recently used)
+        with self._connect() as conn:
+            row = conn.execute("SELECT r.generation, r.content_type, r.etag, r.body, r.stored_at FROM response_cache r"
+                               " JOIN cache_generation g ON g.id = 1 AND g.value = r.generation"
+                               " WHERE r.key = ?", (key,)).fetchone()
+        if row is None or self._expired(row[4]):
+            return None
+        return {"generation": row[0], "content_type": row[1], "etag": row[2], "body": row[3]}
+
+    def set(self, key, entry):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO response_cache (key, generation, content_type, etag, body, stored_at)"
+                         " SELECT ?, ?, ?, ?, ?, ? FROM cache_generation WHERE id = 1 AND value = ?",
+                         (key, entry["generation"], entry["content_type"], entry["etag"], entry["body"], time.time(),
+                          entry["generation"]))
+            conn.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache"
+                         " ORDER BY stored_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+RESPONSE_CACHE = None
+RESPONSE_CACHE_PID = None
+
+def get_response_cache():
+    # None when disabled ("response_cache": {"backend": "off"})
+    global RESPONSE_CACHE, RESPONSE_CACHE_PID
+    if RESPONSE_CACHE is None or RESPONSE_CACHE_PID != os.getpid():
+        cfg_cache = CONFIG.get("response_cache", {})
+        backend = cfg_cache.get("backend", "sqlite")
+        if backend == "off":
+            return None
+        max_entries = int(cfg_cache.get("max_entries", 256))
+        max_body_bytes = int(cfg_cache.get("max_body_kb", 32768)) * 1024
+        max_age = float(cfg_cache.get("max_age_s", 30) or 0)
+        if backend == "memory":
+            RESPONSE_CACHE = ResponseCache(max_entries, max_body_bytes, max_age)
+        else:
+            RESPONSE_CACHE = SQLiteResponseCache(RESPONSE_CACHE_PATH, max_entries, max_body_bytes, max_age)
+        RESPONSE_CACHE_PID = os.getpid()
+    return RESPONSE_CACHE
+
+def data_generation():
+    # changes whenever data_changed() runs in any worker sharing the cache (None when caching is off)
+    cache = get_response_cache()
+    return cache.generation() if cache is not None else None
+
+def data_changed():
+    """Call after committing writes to locations, samples or reference locations."""
+    MAP_CLUSTERS.invalidate()
+    cache = get_response_cache()
+    if cache is not None:
+        cache.bump()
+
+DATABASE_KEY = hashlib.sha1(app.config["SQLALCHEMY_DATABASE_URI"].encode("utf-8")).hexdigest()[:8]
+
+def cached_response(view):
+    """
+    Serves a GET view from the response cache until the next data_changed() or max_age_s,
+    with an ETag so repeat visitors get 304. Keys cover the database, the path with query string and the
+    config.json version. Only 200 responses under max_body_kb are stored.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_response_cache()
+        if cache is None:
+            return view(*args, **kwargs)
+        key = f"{DATABASE_KEY}:{CONFIG_MTIME}:{request.full_path}"
+        entry = cache.get(key)
+        hit = entry is not None
+        if not hit:
+            generation = cache.generation()  # read before rendering, so a concurrent write invalidates the result
+            resp = app.make_response(view(*args, **kwargs))
+            if resp.status_code != 200 or resp.is_streamed:
+                return resp
+            body = resp.get_data()
+            entry = {"generation": generation, "content_type": resp.content_type, "body": body,
+                     "etag": hashlib.sha1(body).hexdigest()[:20]}
+            if len(body) <= cache.max_body_bytes:
+                cache.set(key, entry)
+        METRICS.inc("wqi_response_cache_requests_total",
+                    (("route", request.url_rule.rule), ("result", "hit" if hit else "miss")))
+        resp = Response(entry["body"], content_type=entry["content_type"])
+        resp.set_etag(entry["etag"])
+        resp.cache_control.no_cache = True  # always revalidate; unchanged pages cost a 304
+        resp.headers["X-Cache"] = "HIT" if hit else "MISS"
+        return resp.make_conditional(request)
+    return wrapper
+
+@app.route('/data')
+@cached_response
+def data_page():
+    rows = []
+    for loc, sample in locations_with_latest_sample():  # every location with its most recent sample
+        wqi_val = sample.wqi if sample else None  # may be None if no sample exists
+        status, color = stored_status(wqi_val, sample.status, sample.color) if sample else NO_DATA_STATUS
+        rows.append({
+            "name": loc.name or "Unnamed",
+            "latitude": loc.latitude,
+            "longitude": loc.longitude,
+            "wqi": wqi_val,
+            "status": status,
+            "color": color,
+            "timestamp": sample.timestamp if sample else None,
+            "location_id": loc.id,
+            "sample_id": sample.id if sample else None,
+            "ph": sample.ph if sample else None,
+            "do": sample.do if sample else None,
+            "tds": sample.tds if sample else None,
+            "turbidity": sample.turbidity if sample else None,
+            "nitrate": sample.nitrate if sample else None,
+            "temperature": sample.temperature if sample else None,
+        })
+    ref_rows = ReferenceLocation.query.all()
+    return render_template("data.html", rows=rows, wb_data=ref_rows)
+
+@app.route('/download_excel')
+def download_excel():
+    # latest sample per location plus static references, as XLSX (CSV if openpyxl is missing)
+    try:
+        import openpyxl  # noqa: F401
+        fmt = "xlsx"
+    except ImportError:
+        fmt = "csv"
+    return export_response(fmt, "latest", None, None,
+                           f'water_quality_data_{datetime.now().strftime("%Y%m%d")}.{fmt}')
+
+# --- Streaming export ---
+EXPORT_PAGE_SIZE = 1000  # rows fetched per server-side cursor page and emitted per chunk
+EXPORT_COLUMNS = [  # (spreadsheet header, NDJSON/Parquet key)
+    ("Location Name", "location_name"),
+    ("Latitude", "latitude"),
+    ("Longitude", "longitude"),
+    ("WQI", "wqi"),
+    ("Status", "status"),
+    ("pH", "ph"),
+    ("DO (mg/L)", "do"),
+    ("TDS (mg/L)", "tds"),
+    ("Turbidity (NTU)", "turbidity"),
+    ("Nitrate (mg/L)", "nitrate"),
+    ("Temperature (C)", "temperature"),
+    ("Timestamp", "timestamp"),
+    ("Type", "type"),
+]
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+def export_rows(scope, start, end):
+    """
+    Yields pages (lists of row dicts keyed by EXPORT_COLUMNS keys) from a server-side cursor.
+
+    - scope "latest": every location with its latest sample, then the static references.
+    - scope "all": every water sample in [start, end), oldest first.
+    Missing or stale (older config) WQI values are scored per page for the export only; nothing is written back.
+    """
+    cols = [Location.name, Location.latitude, Location.longitude, WaterSample.wqi, WaterSample.ph,
+            WaterSample.do, WaterSample.tds, WaterSample.turbidity, WaterSample.nitrate,
+            WaterSample.temperature, WaterSample.timestamp, WaterSample.id, WaterSample.wqi_config,
+            WaterSample.status]
+    if scope == "latest":
+        stmt = (select(*cols)
+                .select_from(Location)
+                .outerjoin(WaterSample, WaterSample.id == Location.latest_sample_id)
+                .order_by(Location.id))
+    else:
+        stmt = (select(*cols)
+                .select_from(WaterSample)
+                .join(Location, Location.id == WaterSample.location_id)
+                .order_by(WaterSample.timestamp, WaterSample.id))
+    if start is not None:
+        stmt = stmt.where(WaterSample.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(WaterSample.timestamp < end)
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_PAGE_SIZE))
+    fingerprint = get_wqi_fingerprint()
+    for page in result.partitions():
+        missing = [i for i, r in enumerate(page) if r.id is not None and r.wqi_config != fingerprint]
+        scores = dict(zip(missing, calculate_wqi_many([
+            {"ph": page[i].ph, "do": page[i].do, "tds": page[i].tds, "turbidity": page[i].turbidity,
+             "nitrate": page[i].nitrate, "temperature": page[i].temperature} for i in missing])))
+        statuses = dict(zip(missing, (label[0] for label in get_statuses([scores[i] for i in missing]))))
+        rows = []
+        for i, r in enumerate(page):
+            wqi = scores.get(i, r.wqi)
+            if i in statuses:
+                status = statuses[i]
+            else:  # current row (stored status) or a location without samples
+                status = stored_status(wqi, r.status, None)[0] if r.id is not None else NO_DATA_STATUS[0]
+            rows.append({
+                "location_name": r.name,
+                "latitude": r.latitude,
+                "longitude": r.longitude,
+                "wqi": wqi,
+                "status": status,
+                "ph": r.ph,
+                "do": r.do,
+                "tds": r.tds,
+                "turbidity": r.turbidity,
+                "nitrate": r.nitrate,
+                "temperature": r.temperature,
+                "timestamp": r.timestamp,
+                "type": "User Added",
+            })
+        yield rows
+    if scope == "latest" and start is None and end is None:
+        result = db.session.execute(select(ReferenceLocation).execution_options(yield_per=EXPORT_PAGE_SIZE))
+        for page in result.scalars().partitions():
+            yield [{
+                "location_name": item.name + " - " + item.location,
+                "latitude": item.latitude,
+                "longitude": item.longitude,
+                "wqi": item.wqi,
+                "status": item.status,
+                "ph": None, "do": None, "tds": None, "turbidity": None, "nitrate": None, "temperature": None,
+                "timestamp": None,
+                "type": "Static Reference",
+            } for item in page]
+
+def stream_csv(pages):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([header for header, _ in EXPORT_COLUMNS])
+    for rows in pages:
+        for row in rows:
+            writer.writerow([
+                row[key].isoformat(sep=" ") if key == "timestamp" and row[key] is not None else row[key]
+                for _, key in EXPORT_COLUMNS
+            ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+def stream_ndjson(pages):
+    for rows in pages:
+        chunk = []
+        for row in rows:
+            if row["timestamp"] is not None:
+                row["timestamp"] = row["timestamp"].isoformat()
+            chunk.append(json.dumps(row))
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+class ChunkSink(io.RawIOBase):
+    # write-only file object that hands bytes back to a generator instead of keeping them
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_parquet(pages):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([
+        ("location_name", pa.string()), ("latitude", pa.float64()), ("longitude", pa.float64()),
+        ("wqi", pa.float64()), ("status", pa.string()), ("ph", pa.float64()), ("do", pa.float64()),
+        ("tds", pa.float64()), ("turbidity", pa.float64()), ("nitrate", pa.float64()),
+        ("temperature", pa.float64()), ("timestamp", pa.timestamp("us")), ("type", pa.string()),
+    ])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in pages:
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))  # one row group per page
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()  # footer
+    yield sink.drain()
+
+def stream_xlsx(pages):
+    # openpyxl write-only mode keeps one row in memory at a time; the zip is assembled on save
+    import tempfile
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Water Quality Data")
+    ws.append([header for header, _ in EXPORT_COLUMNS])
+    for rows in pages:
+        for row in rows:
+            ws.append([row[key] for _, key in EXPORT_COLUMNS])
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            data = tmp.read(64 * 1024)
+            if not data:
+                break
+            yield data
+
+EXPORT_WRITERS = {"csv": stream_csv, "ndjson": stream_ndjson, "parquet": stream_parquet, "xlsx": stream_xlsx}
+
+def export_response(fmt, scope, start, end, filename):
+    generate = EXPORT_WRITERS[fmt](export_rows(scope, start, end))
+    return Response(stream_with_context(generate), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route('/export', methods=['GET'])
+def export_data():
+    fmt = (request.args.get("format") or "csv").lower()
+    scope = (request.args.get("scope") or "latest").lower()
+    if fmt not in EXPORT_WRITERS:
+        return jsonify({"error": f"'format' must be one of {','.join(EXPORT_WRITERS)}"}), 400
+    if scope not in ("latest", "all"):
+        return jsonify({"error": "'scope' must be 'latest' or 'all'"}), 400
+    try:
+        start = parse_iot_timestamp(request.args["from"]) if request.args.get("from") else None
+        end = parse_iot_timestamp(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'from' or 'to'"}), 400
+    try:
+        if fmt == "parquet":
+            import pyarrow  # noqa: F401
+        elif fmt == "xlsx":
+            import openpyxl  # noqa: F401
+    except ImportError:
+        return jsonify({"error": f"'{fmt}' export is not available on this server"}), 501
+    filename = f'water_quality_{scope}_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+    return export_response(fmt, scope, start, end, filename)
 
 @app.route('/calculate', methods=['POST'])
 def calculate():
@@ -556,47 +2319,256 @@ def calculate():
         "color": color
     })
 
+@app.route('/calculate/batch', methods=['POST'])
+def calculate_batch():
+    payload = request.get_json(silent=True)  # a list of readings, {"readings": [...]} or {"columns": {...}}
+    if isinstance(payload, dict) and isinstance(payload.get("columns"), dict):
+        columns = payload["columns"]  # column-oriented: {"ph": [...], "do": [...], ...}
+        lengths = {len(v) for v in columns.values() if isinstance(v, list)}
+        if len(lengths) != 1 or not all(isinstance(v, list) for v in columns.values()):
+            return jsonify({"error": "'columns' must map parameters to equal-length arrays"}), 400
+        n = lengths.pop()
+        if n > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Too many readings (max {MAX_BATCH_SIZE})"}), 413
+        scores = get_wqi_model().score_columns(columns, n)
+    else:
+        readings = payload.get("readings") if isinstance(payload, dict) else payload
+        if not isinstance(readings, list):
+            return jsonify({"error": "Provide a JSON array of readings, {'readings': [...]} or {'columns': {...}}"}), 400
+        if len(readings) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Too many readings (max {MAX_BATCH_SIZE})"}), 413
+        scores = calculate_wqi_many(readings)  # vectorized scoring of the whole batch
+    results = [{"wqi": score, "status": status, "color": color}
+               for score, (status, color) in zip(scores, get_statuses(scores))]
+    return jsonify({"count": len(results), "results": results})
+
 @app.route('/api/locations', methods=['GET'])
+@cached_response
 def api_locations():
-    locations = Location.query.all()  # list all locations with latest WQI
-    output = []
-    
-    # User added locations
-    for loc in locations:
-        sample = (WaterSample.query
-                  .filter_by(location_id=loc.id)
-                  .order_by(WaterSample.timestamp.desc())
-                  .first())
-        wqi_val = None
-        if sample:
-            if sample.wqi is None:
-                data = {"ph": sample.ph, "do": sample.do, "tds": sample.tds, "turbidity": sample.turbidity, "nitrate": sample.nitrate, "temperature": sample.temperature}
-                sample.wqi = calculate_wqi(data)
-                db.session.commit()
-            wqi_val = sample.wqi
-        status, color = get_status(wqi_val) if wqi_val is not None else ("No Data", "secondary")  # derive status from WQI
-        output.append({
-            "name": loc.name,
-            "latitude": loc.latitude,
-            "longitude": loc.longitude,
-            "wqi": wqi_val,
-            "status": status,
-            "color": color
-        })
-    
-    # Static Reference locations
-    for item in ReferenceLocation.query.all():
-        status, color = get_status(item.wqi)
-        output.append({
-            "name": item.name + " (" + item.location + ")",
-            "latitude": item.latitude,
-            "longitude": item.longitude,
-            "wqi": item.wqi,
-            "status": status,
-            "color": color
-        })
+    if "bbox" not in request.args and "zoom" not in request.args:
+        # send combined list (user + reference), optionally only one status ("Very Poor", "No Data", ...)
+        return jsonify(map_location_items(request.args.get("status") or None))
+
+    # viewport query: clusters at low zoom, individual points once zoomed in past cluster_max_zoom
+    cfg_map = CONFIG.get("map", {})
+    bbox = parse_bbox(request.args.get("bbox", "-180,-90,180,90"))
+    if bbox is None:
+        return jsonify({"error": "bbox must be west,south,east,north in degrees"}), 400
+    try:
+        zoom = min(MAP_MAX_ZOOM, max(0, int(float(request.args.get("zoom", 0)))))
+    except ValueError:
+        return jsonify({"error": "zoom must be a number"}), 400
+    max_cluster_zoom = int(cfg_map.get("cluster_max_zoom", 14))
+    radius_px = max(1, int(cfg_map.get("cluster_radius_px", 60)))
+    items = MAP_CLUSTERS.get().query(bbox, zoom, max_cluster_zoom, radius_px)
+    return jsonify({
+        "zoom": zoom,
+        "clustered": zoom <= max_cluster_zoom,
+        "count": sum(item.get("count", 1) for item in items),  # locations represented
+        "items": items,
+    })
+
+# --- Location history (WQI trend and anomalies) ---
+HISTORY_BUCKETS = {"raw": 0, "1h": 3600, "6h": 21600, "1d": 86400, "7d": 604800, "30d": 2592000}
+HISTORY_MAX_POINTS = 2000  # points per response; the bucket is widened to stay under this
+HISTORY_WINDOW = 7  # default points in the moving average / z-score window
+HISTORY_MIN_WINDOW = 3  # points needed before a z-score is reported
+HISTORY_Z = 3.0  # default |z| at which a point is flagged as an anomaly
+
+def rolling_stats(values, window):
+    """
+    Trailing statistics over a series with NaN gaps, from cumulative sums (O(n), no Python loop).
+
+    Returns (moving_average, zscore): the mean of the last `window` points including each
+    point, and how many standard deviations each point is from the `window` points before it
+    (NaN until HISTORY_MIN_WINDOW earlier points exist or when they are all equal).
+    """
+    valid = ~np.isnan(values)
+    v = np.where(valid, values, 0.0)
+    s1 = np.r_[0.0, np.cumsum(v)]
+    s2 = np.r_[0.0, np.cumsum(v * v)]
+    sn = np.r_[0, np.cumsum(valid)]
+    idx = np.arange(len(values))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lo, hi = np.maximum(idx - window + 1, 0), idx + 1
+        ma = (s1[hi] - s1[lo]) / (sn[hi] - sn[lo])
+        lo, hi = np.maximum(idx - window, 0), idx  # previous points only, so a spike does not hide itself
+        n = sn[hi] - sn[lo]
+        mean = (s1[hi] - s1[lo]) / n
+        std = np.sqrt(np.maximum((s2[hi] - s2[lo]) / n - mean * mean, 0.0))
+        z = (values - mean) / std
+    z[(n < HISTORY_MIN_WINDOW) | ~(std > 1e-9) | ~valid] = np.nan
+    return ma, z
+
+def history_number(values, digits):
+    # NaN -> None for JSON
+    return [None if v != v else round(v, digits) for v in values.tolist()]
+
+def location_history_stmt(location_id, start, end):
+    # one location's samples in [start, end), oldest first (a range scan of ix_water_samples_location_timestamp)
+    stmt = (select(WaterSample.timestamp, WaterSample.wqi, WaterSample.wqi_config,
+                   *[getattr(WaterSample, f) for f in SAMPLE_FIELDS])
+            .where(WaterSample.location_id == location_id)
+            .order_by(WaterSample.timestamp, WaterSample.id))
+    if start is not None:
+        stmt = stmt.where(WaterSample.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(WaterSample.timestamp < end)
+    return stmt
+
+def location_history(location_id, start, end, bucket, window, z_threshold):
+    """
+    WQI and parameter series for one location's samples in [start, end) (either may be None).
 
-    return jsonify(output)  # send combined list (user + reference)
+    Rows come from one indexed range query; stale stored WQI values are rescored in a batch.
+    With a bucket, samples are averaged per bucket (WQI also min/max) with NumPy reduceat.
+    The moving average and z-scores are computed on the resulting WQI series. "raw" is widened
+    to the smallest bucket that fits in HISTORY_MAX_POINTS when there are more samples.
+    """
+    rows = db.session.execute(location_history_stmt(location_id, start, end)).all()
+    fingerprint = get_wqi_fingerprint()
+    wqi = [row.wqi for row in rows]
+    stale = [i for i, row in enumerate(rows) if row.wqi_config != fingerprint]
+    if stale:
+        for i, score in zip(stale, calculate_wqi_many([{f: getattr(rows[i], f) for f in SAMPLE_FIELDS} for i in stale])):
+            wqi[i] = score
+    n = len(rows)
+    t = np.fromiter(((row.timestamp - EPOCH).total_seconds() for row in rows), dtype=float, count=n)
+    columns = {"wqi": np.array([np.nan if v is None else v for v in wqi], dtype=float)}
+    for f in SAMPLE_FIELDS:
+        columns[f] = np.array([np.nan if getattr(row, f) is None else getattr(row, f) for row in rows], dtype=float)
+
+    if bucket == "raw" and n > HISTORY_MAX_POINTS:
+        span = t[-1] - t[0]
+        bucket = next((name for name, seconds in HISTORY_BUCKETS.items()
+                       if seconds and span / seconds < HISTORY_MAX_POINTS), "30d")
+    seconds = HISTORY_BUCKETS[bucket]
+    if seconds and n:
+        keys = np.floor(t / seconds)
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        counts = np.diff(np.r_[starts, n])
+        times = keys[starts] * seconds
+        series = {}
+        for name, col in columns.items():
+            present = ~np.isnan(col)
+            total = np.add.reduceat(np.where(present, col, 0.0), starts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                series[name] = total / np.add.reduceat(present.astype(np.int64), starts)
+        series["wqi_min"] = np.fmin.reduceat(columns["wqi"], starts)  # fmin/fmax skip NaN
+        series["wqi_max"] = np.fmax.reduceat(columns["wqi"], starts)
+    else:
+        counts, times, series = np.ones(n, dtype=np.int64), t, dict(columns)
+        series["wqi_min"] = series["wqi_max"] = columns["wqi"]
+    series = {name: values[-HISTORY_MAX_POINTS:] for name, values in series.items()}  # keep the newest
+    counts, times = counts[-HISTORY_MAX_POINTS:], times[-HISTORY_MAX_POINTS:]
+    ma, z = rolling_stats(series["wqi"], window)
+    anomaly = np.abs(np.nan_to_num(z)) >= z_threshold
+
+    out = {name: history_number(values, 2 if name.startswith("wqi") else 3) for name, values in series.items()}
+    out["wqi_ma"], out["wqi_z"] = history_number(ma, 2), history_number(z, 2)
+    stamps = [epoch_to_utc(s).isoformat() for s in times.tolist()]
+    names = ["wqi", "wqi_min", "wqi_max"] + SAMPLE_FIELDS + ["wqi_ma", "wqi_z"]
+    points = []
+    for i, (ts, count, flag) in enumerate(zip(stamps, counts.tolist(), anomaly.tolist())):
+        point = {"t": ts, "count": count}
+        for name in names:
+            point[name] = out[name][i]
+        point["anomaly"] = flag
+        points.append(point)
+    scored = columns["wqi"][~np.isnan(columns["wqi"])]
+    return {
+        "bucket": bucket,
+        "window": window,
+        "z_threshold": z_threshold,
+        "stats": {
+            "samples": n,
+            "scored": int(scored.size),
+            "wqi_mean": round(float(scored.mean()), 2) if scored.size else None,
+            "wqi_std": round(float(scored.std()), 2) if scored.size else None,
+            "wqi_min": round(float(scored.min()), 2) if scored.size else None,
+            "wqi_max": round(float(scored.max()), 2) if scored.size else None,
+        },
+        "points": points,
+        "anomalies": [{"t": p["t"], "wqi": p["wqi"], "z": p["wqi_z"]} for p in points if p["anomaly"]],
+    }
+
+class HistoryCache:
+    """
+    LRU of rendered history responses, one group per location.
+
+    Each entry is tagged with the location's sample signature (sample count, newest id and
+    WQI total under the current config fingerprint), read with one indexed aggregate query per
+    request. A new, deleted, edited or rescored sample changes the signature and the next
+    request for that location recomputes; other locations keep their entries.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (location_id, args) -> (signature, body, etag)
+
+    def get(self, key, signature):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[0] != signature:
+                return None
+            self.entries.move_to_end(key)
+            return item
+
+    def set(self, key, signature, body, etag):
+        with self.lock:
+            self.entries[key] = (signature, body, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+HISTORY_CACHE = HistoryCache()
+
+def location_signature_stmt(location_id):
+    # covered by ix_water_samples_location_timestamp (location_id, timestamp, id, wqi): no table reads
+    return (select(func.count(WaterSample.id), func.max(WaterSample.id), func.sum(WaterSample.wqi))
+            .where(WaterSample.location_id == location_id))
+
+def location_sample_signature(location_id):
+    row = db.session.execute(location_signature_stmt(location_id)).one()
+    return tuple(row) + (get_wqi_fingerprint(),)
+
+@app.route('/api/locations/<int:location_id>/history', methods=['GET'])
+def location_history_api(location_id):
+    try:
+        start = parse_iot_timestamp(request.args["from"]) if request.args.get("from") else None
+        end = parse_iot_timestamp(request.args["to"]) if request.args.get("to") else None
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"error": "Invalid 'from' or 'to'"}), 400
+    if start is not None and end is not None and start >= end:
+        return jsonify({"error": "'from' must be before 'to'"}), 400
+    bucket = request.args.get("bucket") or "raw"
+    if bucket not in HISTORY_BUCKETS:
+        return jsonify({"error": f"'bucket' must be one of {','.join(HISTORY_BUCKETS)}"}), 400
+    try:
+        window = int(request.args.get("window") or HISTORY_WINDOW)
+        z_threshold = float(request.args.get("z") or HISTORY_Z)
+    except ValueError:
+        return jsonify({"error": "Invalid 'window' or 'z'"}), 400
+    if not (2 <= window <= 500) or not z_threshold > 0:
+        return jsonify({"error": "'window' must be 2-500 and 'z' positive"}), 400
+
+    key = (location_id, start, end, bucket, window, z_threshold)
+    signature = location_sample_signature(location_id)
+    cached = HISTORY_CACHE.get(key, signature)
+    if cached is None:
+        if signature[0] == 0 and db.session.get(Location, location_id) is None:
+            return jsonify({"error": "Location not found"}), 404
+        payload = location_history(location_id, start, end, bucket, window, z_threshold)
+        payload.update({"location_id": location_id,
+                        "from": start.isoformat() if start else None, "to": end.isoformat() if end else None})
+        body = json.dumps(payload).encode("utf-8")
+        cached = (signature, body, hashlib.sha1(body).hexdigest()[:20])
+        HISTORY_CACHE.set(key, *cached)
+    resp = Response(cached[1], mimetype="application/json")
+    resp.set_etag(cached[2])
+    resp.cache_control.no_cache = True  # revalidate; unchanged history costs a 304
+    return resp.make_conditional(request)
 
 @app.route('/data/location', methods=['POST'])
 def create_location():
@@ -609,6 +2581,9 @@ def create_location():
     loc = Location(name=name, latitude=latitude, longitude=longitude)
     db.session.add(loc)
     db.session.commit()
+    SPATIAL_INDEX.add(("location", loc.id), latitude, longitude)  # keep nearest-lookups in sync
+    _refresh_spatial_signature()
+    data_changed()
     return jsonify({"status": "ok", "location_id": loc.id}), 200
 
 @app.route('/data/location/<int:location_id>/delete', methods=['POST'])
@@ -616,6 +2591,9 @@ def delete_location(location_id):
     loc = Location.query.get_or_404(location_id)
     db.session.delete(loc)
     db.session.commit()
+    SPATIAL_INDEX.remove(("location", location_id))
+    _refresh_spatial_signature()
+    data_changed()
     return jsonify({"status": "ok"}), 200
 
 @app.route('/data/sample', methods=['POST'])
@@ -637,9 +2615,12 @@ def create_sample():
         "temperature": f("temperature"),
     }
     sample = WaterSample(location_id=loc.id, **payload)
-    sample.wqi = calculate_wqi(payload)  # compute and store WQI for the sample
+    score_sample(sample)  # compute and store WQI and status for the sample
     db.session.add(sample)
+    db.session.flush()
+    refresh_latest_sample(loc)  # keep the latest-sample pointer current
     db.session.commit()
+    data_changed()
     return jsonify({"status": "ok", "sample_id": sample.id}), 200
 
 @app.route('/data/sample/<int:sample_id>/update', methods=['POST'])
@@ -654,49 +2635,617 @@ def update_sample(sample_id):
     sample.turbidity = f("turbidity", sample.turbidity)
     sample.nitrate = f("nitrate", sample.nitrate)
     sample.temperature = f("temperature", sample.temperature)
-    payload = {"ph": sample.ph, "do": sample.do, "tds": sample.tds, "turbidity": sample.turbidity, "nitrate": sample.nitrate, "temperature": sample.temperature}
-    sample.wqi = calculate_wqi(payload)
-    db.session.commit()
+    score_sample(sample)
+    db.session.commit()  # timestamp is unchanged, so the location's latest-sample pointer stays valid
+    data_changed()
     return jsonify({"status": "ok"}), 200
 
 @app.route('/data/sample/<int:sample_id>/delete', methods=['POST'])
 def delete_sample(sample_id):
     sample = WaterSample.query.get_or_404(sample_id)
+    loc = sample.location
+    if loc.latest_sample_id == sample.id:
+        loc.latest_sample_id = None  # release the pointer before the row goes away
+        db.session.flush()
     db.session.delete(sample)
+    db.session.flush()
+    refresh_latest_sample(loc)  # fall back to the next most recent sample, if any
     db.session.commit()
+    data_changed()
     return jsonify({"status": "ok"}), 200
 
+# --- Bulk sample import (CSV / XLSX) ---
+IMPORT_CHUNK_SIZE = 5000  # rows scored and inserted per round trip
+IMPORT_MATCH_RADIUS_KM = 0.05  # rows within 50 m of an existing location are filed under it
+IMPORT_MAX_ERRORS = 100  # errors listed in the report (all of them are counted)
+SAMPLE_FIELDS = ["ph", "do", "tds", "turbidity", "nitrate", "temperature"]
+IMPORT_FIELDS = SAMPLE_FIELDS + ["location_id", "location", "latitude", "longitude", "timestamp"]
+IMPORT_COLUMN_ALIASES = {  # normalized header (lowercase, letters and digits only) -> field
+    "ph": "ph",
+    "do": "do", "dissolvedoxygen": "do", "domgl": "do",
+    "tds": "tds", "totaldissolvedsolids": "tds", "tdsmgl": "tds",
+    "turbidity": "turbidity", "turbidityntu": "turbidity",
+    "nitrate": "nitrate", "no3": "nitrate", "nitratemgl": "nitrate",
+    "temperature": "temperature", "temp": "temperature", "temperaturec": "temperature", "watertemperature": "temperature",
+    "locationid": "location_id",
+    "location": "location", "locationname": "location", "name": "location", "site": "location", "station": "location",
+    "latitude": "latitude", "lat": "latitude",
+    "longitude": "longitude", "lng": "longitude", "lon": "longitude", "long": "longitude",
+    "timestamp": "timestamp", "date": "timestamp", "datetime": "timestamp", "time": "timestamp",
+    "sampledat": "timestamp", "sampledate": "timestamp",
+}
+
+def import_header_key(header):
+    return re.sub(r"[^a-z0-9]", "", str(header if header is not None else "").lower())
+
+def map_import_columns(header, overrides=None):
+    """
+    Maps spreadsheet headers to import fields.
+
+    - overrides: {field: header} that take precedence over IMPORT_COLUMN_ALIASES.
+    Returns: ({field: column index}, [unmapped headers]); raises ValueError for a bad override.
+    """
+    keys = [import_header_key(h) for h in header]
+    mapping = {}
+    for field, name in (overrides or {}).items():
+        if field not in IMPORT_FIELDS:
+            raise ValueError(f"Unknown field '{field}' in column mapping")
+        if import_header_key(name) not in keys:
+            raise ValueError(f"Column '{name}' not found in the file header")
+        mapping[field] = keys.index(import_header_key(name))
+    taken = set(mapping.values())
+    for idx, key in enumerate(keys):
+        field = IMPORT_COLUMN_ALIASES.get(key)
+        if field and field not in mapping and idx not in taken:
+            mapping[field] = idx
+            taken.add(idx)
+    unmapped = [str(h) for idx, h in enumerate(header) if idx not in taken and h not in (None, "")]
+    return mapping, unmapped
+
+def detect_import_format(filename, fmt=None):
+    fmt = (fmt or os.path.splitext(filename or "")[1].lstrip(".")).lower()
+    if fmt in ("xlsx", "xlsm"):
+        return "xlsx"
+    if fmt in ("csv", "txt"):
+        return "csv"
+    raise ValueError("Unsupported file type (use .csv or .xlsx)")
+
+def iter_import_rows(stream, fmt):
+    # yields row tuples, header first, from a binary file object without loading it whole
+    if fmt == "csv":
+        yield from csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    else:
+        from openpyxl import load_workbook
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+def import_number(value, field):
+    # hot path: called for every cell, so try the conversion first and classify failures after
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
+        raise ValueError(f"Invalid '{field}': {value!r}")
+    if number - number != 0 or value is True or value is False:  # NaN/inf, or a boolean cell
+        raise ValueError(f"Invalid '{field}': {value!r}")
+    return number
+
+def import_timestamp(value, default):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return default
+    if isinstance(value, datetime):  # openpyxl gives datetimes for date cells
+        return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+    if hasattr(value, "year"):  # plain date
+        return datetime(value.year, value.month, value.day)
+    try:
+        return parse_iot_timestamp(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid 'timestamp': {value!r}")
+
+class ImportLocationResolver:
+    """
+    Matches import rows to locations: by location_id, by coordinates within
+    IMPORT_MATCH_RADIUS_KM of a stored location, or by exact (case-insensitive) name.
+    Rows with coordinates and no match create a new location unless create is False.
+    In a dry run nothing is written and would-be locations get placeholder ids.
+    """
+
+    def __init__(self, create=True, dry_run=False):
+        self.create = create
+        self.dry_run = dry_run
+        self.ids = set()
+        self.by_name = {}
+        for loc_id, name in db.session.query(Location.id, Location.name):
+            self.ids.add(loc_id)
+            if name:
+                self.by_name.setdefault(name.strip().lower(), loc_id)
+        self.by_coords = {}  # rounded (lat, lng) -> id, including locations created by this import
+        self.index = get_spatial_index()
+        self.new_index = SpatialIndex()  # locations created by this import (also used in dry runs)
+        self.matched = set()
+        self.created = []  # (id, lat, lng) of new locations
+
+    def resolve(self, location_id, name, lat, lng):
+        # returns a location id or raises ValueError
+        if location_id is not None:
+            if location_id != int(location_id) or int(location_id) not in self.ids:
+                raise ValueError(f"Unknown location_id {location_id:g}")
+            return self._hit(int(location_id))
+        name_key = name.strip().lower() if name else None
+        if lat is not None and lng is not None:
+            if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                raise ValueError("Latitude/longitude out of range")
+            key = (round(lat, 5), round(lng, 5))
+            if key in self.by_coords:
+                return self._hit(self.by_coords[key])
+            hits = (self.index.nearest(lat, lng, k=1, radius_km=IMPORT_MATCH_RADIUS_KM, kinds={"location"})
+                    or self.new_index.nearest(lat, lng, k=1, radius_km=IMPORT_MATCH_RADIUS_KM))
+            if hits:
+                self.by_coords[key] = hits[0][1][1]
+                return self._hit(hits[0][1][1])
+            if not self.create:
+                raise ValueError(f"No location within {IMPORT_MATCH_RADIUS_KM * 1000:g} m of {lat}, {lng}")
+            if self.dry_run:
+                loc_id = -(len(self.created) + 1)
+            else:
+                loc = Location(name=name.strip() if name else None, latitude=lat, longitude=lng)
+                db.session.add(loc)
+                db.session.flush()
+                loc_id = loc.id
+            self.created.append((loc_id, lat, lng))
+            self.new_index.add(("location", loc_id), lat, lng)
+            self.by_coords[key] = loc_id
+            return loc_id
+        if lat is not None or lng is not None:
+            raise ValueError("Both latitude and longitude are required")
+        if name_key:
+            if name_key not in self.by_name:
+                raise ValueError(f"Unknown location '{name.strip()}' (add latitude/longitude to create it)")
+            return self._hit(self.by_name[name_key])
+        raise ValueError("Missing location (location_id, latitude/longitude or location name)")
+
+    def _hit(self, loc_id):
+        self.matched.add(loc_id)
+        return loc_id
+
+def import_samples(rows, overrides=None, dry_run=False, create_locations=True):
+    """
+    Imports water samples from an iterator of row tuples whose first row is the header.
+
+    Rows are validated, scored with the vectorized WQI model and inserted in chunks of
+    IMPORT_CHUNK_SIZE (one executemany and commit per chunk). Invalid rows are skipped and
+    reported. With dry_run nothing is written.
+    Returns: report dict. Raises ValueError when the header cannot be used.
+    """
+    started = time.time()
+    rows = iter(rows)
+    header = next(rows, None)
+    if not header:
+        raise ValueError("File is empty")
+    mapping, unmapped = map_import_columns(header, overrides)
+    if not any(field in mapping for field in SAMPLE_FIELDS):
+        raise ValueError(f"No parameter columns found (expected some of: {', '.join(SAMPLE_FIELDS)})")
+    if not ({"location_id", "location"} & mapping.keys() or {"latitude", "longitude"} <= mapping.keys()):
+        raise ValueError("No location columns found (location_id, latitude/longitude or location name)")
+    resolver = ImportLocationResolver(create=create_locations, dry_run=dry_run)
+    report = {
+        "dry_run": dry_run,
+        "columns": {field: str(header[idx]) for field, idx in mapping.items()},
+        "unmapped_columns": unmapped,
+        "rows": 0, "valid": 0, "invalid": 0, "imported": 0,
+        "errors": [],
+    }
+    wqi_stats = {"n": 0, "sum": 0.0, "min": None, "max": None}
+    fields = [(field, mapping[field]) for field in SAMPLE_FIELDS if field in mapping]
+    width = max(mapping.values()) + 1
+    now = datetime.utcnow()
+    fingerprint = get_wqi_fingerprint()
+
+    def cell(row, field):
+        idx = mapping.get(field)
+        return row[idx] if idx is not None else None
+
+    def flush(chunk):
+        scores = get_wqi_model().score_columns({f: [r.get(f) for r in chunk] for f, _ in fields}, len(chunk))
+        for record, score, (status, color) in zip(chunk, scores, get_statuses(scores)):
+            record["wqi"] = score
+            record["status"] = status
+            record["color"] = color
+            record["wqi_config"] = fingerprint
+            if score is not None:
+                wqi_stats["n"] += 1
+                wqi_stats["sum"] += score
+                wqi_stats["min"] = score if wqi_stats["min"] is None else min(wqi_stats["min"], score)
+                wqi_stats["max"] = score if wqi_stats["max"] is None else max(wqi_stats["max"], score)
+        if not dry_run:
+            # Core insert on the table: one executemany per chunk (the ORM bulk path splits
+            # the chunk into a statement per distinct pattern of missing values)
+            db.session.execute(insert(WaterSample.__table__), chunk)
+            db.session.commit()
+            report["imported"] += len(chunk)
+
+    chunk = []
+    for line_no, row in enumerate(rows, start=2):
+        if not row or all(v is None or (isinstance(v, str) and not v.strip()) for v in row):
+            continue  # blank line
+        report["rows"] += 1
+        row = tuple(row) + (None,) * (width - len(row))
+        try:
+            record = {field: import_number(row[idx], field) for field, idx in fields}
+            if all(record[field] is None for field, _ in fields):
+                raise ValueError("No parameter values")
+            name = cell(row, "location")
+            record["location_id"] = resolver.resolve(
+                import_number(cell(row, "location_id"), "location_id"),
+                str(name) if name is not None else None,
+                import_number(cell(row, "latitude"), "latitude"),
+                import_number(cell(row, "longitude"), "longitude"),
+            )
+            record["timestamp"] = import_timestamp(cell(row, "timestamp"), now)
+        except ValueError as e:
+            report["invalid"] += 1
+            if len(report["errors"]) < IMPORT_MAX_ERRORS:
+                report["errors"].append({"line": line_no, "error": str(e)})
+            continue
+        report["valid"] += 1
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    if not dry_run:
+        db.session.commit()  # locations created for rows that all turned out invalid
+        if resolver.created:
+            for loc_id, lat, lng in resolver.created:
+                SPATIAL_INDEX.add(("location", loc_id), lat, lng)  # keep nearest-lookups in sync
+            _refresh_spatial_signature()
+        if report["imported"]:
+            backfill_latest_samples()  # one set-based pass instead of a pointer update per row
+        data_changed()
+    report["locations_matched"] = len(resolver.matched - {loc_id for loc_id, _, _ in resolver.created})
+    report["locations_created"] = len(resolver.created)
+    report["wqi"] = {
+        "min": wqi_stats["min"],
+        "mean": round(wqi_stats["sum"] / wqi_stats["n"], 2) if wqi_stats["n"] else None,
+        "max": wqi_stats["max"],
+    }
+    report["elapsed_s"] = round(time.time() - started, 3)
+    return report
+
+def parse_import_mapping(items):
+    # "field=Header" strings (CLI) -> {field: header}
+    overrides = {}
+    for item in items:
+        field, sep, name = item.partition("=")
+        if not sep or not field.strip() or not name.strip():
+            raise ValueError(f"Column mapping must look like field=Header, got '{item}'")
+        overrides[field.strip()] = name.strip()
+    return overrides
+
+@app.route('/data/import', methods=['POST'])
+def import_samples_api():
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return jsonify({"error": "Upload a CSV or XLSX file in 'file'"}), 400
+    dry_run = (request.form.get("dry_run") or request.args.get("dry_run") or "").lower() in ("1", "true", "yes")
+    create_locations = (request.form.get("create_locations") or "true").lower() not in ("0", "false", "no")
+    try:
+        fmt = detect_import_format(upload.filename, request.form.get("format"))
+        overrides = json.loads(request.form["mapping"]) if request.form.get("mapping") else None
+        if overrides is not None and not isinstance(overrides, dict):
+            raise ValueError("'mapping' must be a JSON object of field -> column header")
+        report = import_samples(iter_import_rows(upload.stream, fmt), overrides, dry_run, create_locations)
+    except ImportError:
+        return jsonify({"error": "XLSX import requires the openpyxl package"}), 501
+    except ValueError as e:  # includes malformed mapping JSON
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    report["format"] = fmt
+    return jsonify(report), 200
+
+@app.cli.command("import-samples")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Validate and report without writing anything.")
+@click.option("--format", "fmt", type=click.Choice(["csv", "xlsx"]), help="File format (default: from the extension).")
+@click.option("--map", "mapping", multiple=True, help="Column mapping override, e.g. --map do='Dissolved O2'.")
+@click.option("--no-create-locations", is_flag=True, help="Reject rows that match no existing location.")
+def import_samples_command(path, dry_run, fmt, mapping, no_create_locations):
+    """Import historical water samples from a CSV or XLSX file."""
+    try:
+        fmt = detect_import_format(path, fmt)
+        with open(path, "rb") as f:
+            report = import_samples(iter_import_rows(f, fmt), parse_import_mapping(mapping), dry_run,
+                                    not no_create_locations)
+    except ValueError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    report["format"] = fmt
+    print(json.dumps(report, indent=2, default=str))
+
+# --- Config hot reload and WQI rescoring ---
+CONFIG_CHECK_INTERVAL_S = 2.0  # how often requests stat config.json for changes
+CONFIG_CHECKED_AT = 0.0
+RESCORE_CHUNK_SIZE = 2000
+RESCORE_STATE = {"running": False, "fingerprint": None, "rescored": 0, "last_id": 0,
+                 "started_at": None, "finished_at": None, "error": None}
+RESCORE_LOCK = threading.Lock()
+RESCORE_LEASE = "wqi-rescore"
+RESCORE_RETRY_S = 30  # while stale rows remain (job failed or running elsewhere), look again this often
+RESCORE_CHECK = {"fingerprint": None, "done": False, "at": 0.0}  # this process's last look for stale rows
+
+def reload_config_if_changed():
+    """Reloads config.json when its mtime changed (checked at most every CONFIG_CHECK_INTERVAL_S). Returns True on reload."""
+    global CONFIG_CHECKED_AT, LATEST_IOT_CACHE, CHAT_CACHE
+    now = time.time()
+    if now - CONFIG_CHECKED_AT < CONFIG_CHECK_INTERVAL_S:
+        return False
+    CONFIG_CHECKED_AT = now
+    try:
+        mtime = os.stat(CONFIG_PATH).st_mtime_ns
+    except OSError:
+        return False
+    if mtime == CONFIG_MTIME:
+        return False
+    previous = CONFIG
+    load_config()
+    if CONFIG.get("wqi") != previous.get("wqi") or CONFIG.get("iot") != previous.get("iot"):
+        LATEST_IOT_CACHE = None  # cached payload carries wqi/status computed under the old config
+    if CONFIG.get("wqi") != previous.get("wqi"):
+        MAP_CLUSTERS.invalidate()  # same for the map points (cached responses are keyed by config version)
+    if CONFIG.get("chat") != previous.get("chat"):
+        CHAT_CACHE = None
+    print(f"Reloaded config.json (WQI fingerprint {get_wqi_fingerprint()})")
+    return True
+
+def stale_samples_clause(fingerprint):
+    # rows whose stored wqi was computed under another config, or before fingerprints existed;
+    # spelled as ranges rather than != so the planner can read ix_water_samples_wqi_config
+    return or_(WaterSample.wqi_config.is_(None), WaterSample.wqi_config < fingerprint,
+               WaterSample.wqi_config > fingerprint)
+
+def stale_sample_probe(fingerprint):
+    # any stale row at all (checked by the background job before it takes the lease)
+    return select(WaterSample.id).where(stale_samples_clause(fingerprint)).limit(1)
+
+def rescore_stale_samples(chunk_size=RESCORE_CHUNK_SIZE, progress=None):
+    """
+    Rescores samples whose stored WQI is stale for the current config.
+
+    Walks water_samples by id in chunks of chunk_size. Each chunk is read, scored with the
+    vectorized model and written with one UPDATE executemany in its own transaction, so an
+    interrupted run keeps every finished chunk and the next run only sees the rows left over.
+    Stops early if the config changes mid-run.
+    - progress: optional callback(rescored_so_far, last_id) after each chunk.
+    Returns: number of rows rescored.
+    """
+    fingerprint = get_wqi_fingerprint()
+    model = get_wqi_model()
+    table = WaterSample.__table__
+    stmt = (update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .where(or_(table.c.wqi_config.is_(None), table.c.wqi_config != fingerprint))  # skip rows rewritten meanwhile
+            .values(wqi=bindparam("b_wqi"), status=bindparam("b_status"), color=bindparam("b_color"),
+                    wqi_config=fingerprint))
+    fields = [getattr(WaterSample, name) for name in SAMPLE_FIELDS]
+    total = 0
+    last_id = 0
+    while get_wqi_fingerprint() == fingerprint:
+        rows = db.session.execute(
+            select(WaterSample.id, *fields)
+            .where(WaterSample.id > last_id, stale_samples_clause(fingerprint))
+            .order_by(WaterSample.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        scores = model.score_columns({name: [getattr(r, name) for r in rows] for name in SAMPLE_FIELDS}, len(rows))
+        with serialized_write():
+            db.session.execute(stmt, [{"b_id": r.id, "b_wqi": score, "b_status": status, "b_color": color}
+                                      for r, score, (status, color) in zip(rows, scores, get_statuses(scores))])
+            db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+        if progress:
+            progress(total, last_id)
+    return total
+
+def lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lease(name, seconds):
+    """
+    Takes (or renews) the named job lease for this process until `seconds` from now.
+    Returns False while another process holds an unexpired lease, so only one worker on
+    any host sharing the database runs the job.
+    """
+    now = datetime.utcnow()
+    holder = lease_holder()
+    table = JobLease.__table__
+    with serialized_write():
+        taken = db.session.execute(
+            update(table)
+            .where(table.c.name == name, or_(table.c.holder == holder, table.c.expires_at < now))
+            .values(holder=holder, expires_at=now + timedelta(seconds=seconds))
+        ).rowcount
+        if not taken:
+            try:
+                db.session.execute(insert(table).values(name=name, holder=holder,
+                                                        expires_at=now + timedelta(seconds=seconds)))
+            except IntegrityError:
+                db.session.rollback()  # the row exists and someone else holds it
+                return False
+        db.session.commit()
+    return True
+
+def release_lease(name):
+    table = JobLease.__table__
+    with serialized_write():
+        db.session.execute(update(table)
+                           .where(table.c.name == name, table.c.holder == lease_holder())
+                           .values(expires_at=datetime.utcnow()))
+        db.session.commit()
+
+def rescore_lease_seconds():
+    return float(CONFIG.get("rescore", {}).get("lease_s", 60))
+
+def renew_rescore_lease():
+    # called between chunks; a lease that expired and was taken over stops this run
+    if not acquire_lease(RESCORE_LEASE, rescore_lease_seconds()):
+        raise RuntimeError("rescore lease taken over by another process")
+
+def run_rescore_job():
+    # background entry point: one job per process at a time (RESCORE_LOCK) and per database (lease)
+    if not RESCORE_LOCK.acquire(blocking=False):
+        return
+    try:
+        with app.app_context():
+            fingerprint = get_wqi_fingerprint()
+            if db.session.execute(stale_sample_probe(fingerprint)).first() is None:
+                if RESCORE_CHECK["fingerprint"] == fingerprint:
+                    RESCORE_CHECK["done"] = True  # nothing stale; stop looking until the config changes
+                return
+            if not acquire_lease(RESCORE_LEASE, rescore_lease_seconds()):
+                return  # another worker is rescoring; watch_config looks again later
+            RESCORE_STATE.update(running=True, fingerprint=fingerprint, rescored=0, last_id=0,
+                                 started_at=datetime.utcnow().isoformat(), finished_at=None, error=None)
+
+            def progress(n, last):
+                RESCORE_STATE.update(rescored=n, last_id=last)
+                renew_rescore_lease()
+            try:
+                rescore_stale_samples(int(CONFIG.get("rescore", {}).get("chunk_size", RESCORE_CHUNK_SIZE)), progress)
+                if get_wqi_fingerprint() == fingerprint:
+                    RESCORE_CHECK.update(fingerprint=fingerprint, done=True)
+            except Exception as e:
+                db.session.rollback()
+                RESCORE_STATE["error"] = str(e)
+                print(f"WQI rescoring failed: {e}")  # not marked done, so it is retried after RESCORE_RETRY_S
+            finally:
+                RESCORE_STATE.update(running=False, finished_at=datetime.utcnow().isoformat())
+                release_lease(RESCORE_LEASE)
+    finally:
+        RESCORE_LOCK.release()
+
+@app.before_request
+def watch_config():
+    # hot-reload config.json and look for stale rows in the background: right away for a new
+    # fingerprint, then every RESCORE_RETRY_S until a run (here or in another worker) finishes.
+    # No database work happens here; the stale-row probe runs in the rescore thread.
+    reload_config_if_changed()
+    fingerprint = get_wqi_fingerprint()
+    now = time.monotonic()
+    if fingerprint == RESCORE_CHECK["fingerprint"] and (RESCORE_CHECK["done"] or now - RESCORE_CHECK["at"] < RESCORE_RETRY_S):
+        return
+    RESCORE_CHECK.update(fingerprint=fingerprint, done=False, at=now)
+    if not CONFIG.get("rescore", {}).get("background", True) or RESCORE_STATE["running"]:
+        return
+    threading.Thread(target=run_rescore_job, name="wqi-rescore", daemon=True).start()
+
+@app.route('/api/rescore', methods=['GET'])
+def rescore_status():
+    fingerprint = get_wqi_fingerprint()
+    stale = db.session.query(func.count(WaterSample.id)).filter(stale_samples_clause(fingerprint)).scalar()
+    return jsonify(dict(RESCORE_STATE, current_fingerprint=fingerprint, stale=stale))
+
+@app.cli.command("wqi-rescore")
+@click.option("--chunk-size", default=RESCORE_CHUNK_SIZE, show_default=True, help="Rows per transaction.")
+def wqi_rescore_command(chunk_size):
+    """Rescore water samples whose stored WQI was computed with a different config.json."""
+    if not acquire_lease(RESCORE_LEASE, rescore_lease_seconds()):
+        raise click.ClickException("Another process is rescoring (job_leases row 'wqi-rescore'); try again later.")
+    started = time.time()
+
+    def progress(n, last):
+        print(f"  rescored {n} rows (through id {last})")
+        renew_rescore_lease()
+    try:
+        total = rescore_stale_samples(chunk_size, progress)
+    finally:
+        release_lease(RESCORE_LEASE)
+    print(f"Rescored {total} samples under WQI config {get_wqi_fingerprint()} in {time.time() - started:.1f}s.")
+
 @app.route('/api/iot', methods=['POST', 'GET'])
 def ingest_iot():
-    if request.method == 'GET':  # return latest IoT reading
-        latest = (IoTReading.query
-                  .order_by(IoTReading.timestamp.desc())
-                  .first())
-        if not latest:
+    if request.method == 'GET':  # return latest IoT reading (served from cache, with WQI precomputed)
+        device_id = request.args.get("device_id")
+        entry = get_latest_iot_cache().get() if not device_id else latest_device_entry(device_id)
+        if entry is None:
             return jsonify({"error": "No data"}), 404
-        payload = {}
-        if latest.temperature_c is not None:
-            payload["temperature_c"] = round(float(latest.temperature_c), 2)
-        if latest.ph is not None:
-            payload["ph"] = round(float(latest.ph), 2)
-        turb_val = latest.turbidity_ntu if latest.turbidity_ntu is not None else latest.turbidity_percent
-        if turb_val is not None:
-            payload["turbidity"] = round(float(turb_val), 2)
-        payload["timestamp"] = latest.timestamp.isoformat()
-        return jsonify(payload)
+        resp = jsonify(entry["payload"])
+        resp.set_etag(entry["etag"])
+        resp.last_modified = entry["last_modified"]
+        resp.cache_control.no_cache = True  # always revalidate; unchanged readings cost a 304
+        return resp.make_conditional(request)
     payload = request.get_json(silent=True) or {}  # parse POSTed IoT reading
+    values, error = parse_iot_reading(payload)
+    if error:
+        return jsonify({"error": error}), 400
+    ts = datetime.utcnow()  # record time of ingestion
+    if iot_write_behind_enabled():
+        try:
+            seq = get_iot_writer().submit([(values, ts)])[0]  # persisted later by the background writer
+        except IoTQueueFull as e:
+            return iot_queue_full_response(e)
+        return jsonify({"status": "queued", "seq": seq, "timestamp": ts.isoformat()}), 202
+    rec_id = write_iot_readings([(values, ts)])[0]  # store, update rollups and archive
+    return jsonify({"status": "ok", "id": rec_id, "timestamp": ts.isoformat()})
+
+def latest_device_entry(device_id):
+    # latest reading of one device, one index seek on ix_iot_readings_device_timestamp (not cached)
+    latest = db.session.execute(LATEST_DEVICE_READING, {"device_id": device_id}).first()
+    if latest is None:
+        return None
+    payload = iot_stream_event(latest.id, latest.temperature_c, latest.ph, latest.turbidity_ntu,
+                               latest.turbidity_percent, latest.timestamp)
+    payload["device_id"] = device_id
+    return latest_reading_entry(payload, latest.timestamp)
+
+def iot_reading_payload(temperature_c, ph, turbidity_ntu, turbidity_percent, timestamp):
+    # JSON shape served by GET /api/iot and pushed on /api/iot/stream
+    payload = {}
+    if temperature_c is not None:
+        payload["temperature_c"] = round(float(temperature_c), 2)
+    if ph is not None:
+        payload["ph"] = round(float(ph), 2)
+    turb_val = turbidity_ntu if turbidity_ntu is not None else turbidity_percent
+    if turb_val is not None:
+        payload["turbidity"] = round(float(turb_val), 2)
+    payload["timestamp"] = timestamp.isoformat()
+    return payload
+
+IOT_BATCH_MAX = 10000  # readings accepted per /api/iot/batch request
+NDJSON_INVALID = object()  # placeholder for an unparsable NDJSON line
+IOT_CSV_HEADER = ["id", "temperature_c", "ph", "turbidity_percent", "turbidity_ntu", "timestamp", "device_id"]
+
+def parse_iot_reading(payload):
+    """
+    Validates one IoT reading dict.
+
+    Returns: (values, None) with IoTReading column values, or (None, error_message).
+    """
+    if not isinstance(payload, dict):
+        return None, "Reading must be a JSON object"
+    # Device id (optional)
+    device_id = payload.get("device_id")
+    if device_id is not None and (not isinstance(device_id, str) or not 0 < len(device_id) <= 64):
+        return None, "Invalid 'device_id' (string of 1-64 characters)"
     # Parse temperature
     try:
         temperature_c = float(payload.get("temperature_c"))
     except (TypeError, ValueError):
-        return jsonify({"error": "Missing or invalid 'temperature_c'"}), 400
+        return None, "Missing or invalid 'temperature_c'"
     # Parse pH (optional)
     ph_val = None
     if payload.get("ph") is not None:
         try:
             ph_val = float(payload.get("ph"))
         except (TypeError, ValueError):
-            return jsonify({"error": "Invalid 'ph'"}), 400
+            return None, "Invalid 'ph'"
     # Parse turbidity from any of the keys
     turbidity_ntu_val = None
     turbidity_percent_val = None
@@ -704,48 +3253,1104 @@ def ingest_iot():
         try:
             turbidity_ntu_val = float(payload.get("turbidity"))
         except (TypeError, ValueError):
-            return jsonify({"error": "Invalid 'turbidity'"}), 400
+            return None, "Invalid 'turbidity'"
     elif payload.get("turbidity_ntu") is not None:
         try:
             turbidity_ntu_val = float(payload.get("turbidity_ntu"))
         except (TypeError, ValueError):
-            return jsonify({"error": "Invalid 'turbidity_ntu'"}), 400
+            return None, "Invalid 'turbidity_ntu'"
     if payload.get("turbidity_percent") is not None:
         try:
             turbidity_percent_val = float(payload.get("turbidity_percent"))
         except (TypeError, ValueError):
-            return jsonify({"error": "Invalid 'turbidity_percent'"}), 400
+            return None, "Invalid 'turbidity_percent'"
     # Require some turbidity value
     if turbidity_ntu_val is None and turbidity_percent_val is None:
-        return jsonify({"error": "Provide 'turbidity' (or 'turbidity_ntu') or 'turbidity_percent'"}), 400
+        return None, "Provide 'turbidity' (or 'turbidity_ntu') or 'turbidity_percent'"
     # If percent missing, mirror from NTU to keep non-null constraint
     if turbidity_percent_val is None and turbidity_ntu_val is not None:
         turbidity_percent_val = turbidity_ntu_val
-    ts = datetime.utcnow()  # record time of ingestion
-    rec = IoTReading(
-        temperature_c=temperature_c,
-        turbidity_percent=turbidity_percent_val,
-        ph=ph_val,
-        turbidity_ntu=turbidity_ntu_val,
-        timestamp=ts
+    return {
+        "temperature_c": temperature_c,
+        "turbidity_percent": turbidity_percent_val,
+        "ph": ph_val,
+        "turbidity_ntu": turbidity_ntu_val,
+        "device_id": device_id,
+    }, None
+
+def parse_iot_timestamp(value):
+    """
+    Parses a device timestamp (ISO 8601 string or Unix epoch seconds/milliseconds).
+
+    Returns: naive UTC datetime (matching datetime.utcnow() storage), or raises ValueError.
+    """
+    if isinstance(value, bool):
+        raise ValueError("Invalid 'timestamp'")
+    if isinstance(value, (int, float)):
+        seconds = value / 1000.0 if value > 1e11 else float(value)  # tolerate millisecond epochs
+        return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(tzinfo=None)
+    if isinstance(value, str):
+        raw = value.strip()
+        if raw.endswith("Z"):
+            raw = raw[:-1] + "+00:00"
+        ts = datetime.fromisoformat(raw)
+        if ts.tzinfo is not None:
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return ts
+    raise ValueError("Invalid 'timestamp'")
+
+def read_iot_batch_items():
+    # returns (items, error): a JSON array / {"readings": [...]} body or NDJSON lines
+    content_type = (request.mimetype or "").lower()
+    if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(NDJSON_INVALID)  # reported per item below
+        return items, None
+    payload = request.get_json(silent=True)
+    items = payload.get("readings") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return None, "Provide a JSON array of readings, {'readings': [...]} or NDJSON"
+    return items, None
+
+@app.route('/api/iot/batch', methods=['POST'])
+def ingest_iot_batch():
+    items, error = read_iot_batch_items()
+    if error:
+        return jsonify({"error": error}), 400
+    if len(items) > IOT_BATCH_MAX:
+        return jsonify({"error": f"Too many readings (max {IOT_BATCH_MAX})"}), 413
+
+    now = datetime.utcnow()  # default time for readings without a device timestamp
+    results = [None] * len(items)
+    accepted = []  # (index, values, timestamp)
+    for i, item in enumerate(items):
+        values, err = parse_iot_reading(item) if item is not NDJSON_INVALID else (None, "Invalid JSON")
+        ts = now
+        if err is None and item.get("timestamp") is not None:
+            try:
+                ts = parse_iot_timestamp(item.get("timestamp"))
+            except (ValueError, OverflowError, OSError):
+                err = "Invalid 'timestamp'"
+        if err:
+            results[i] = {"index": i, "status": "error", "error": err}
+            continue
+        accepted.append((i, values, ts))
+
+    queued = False
+    if accepted and iot_write_behind_enabled():
+        try:
+            seqs = get_iot_writer().submit([(values, ts) for _, values, ts in accepted])
+        except IoTQueueFull as e:
+            return iot_queue_full_response(e)  # all-or-nothing so devices can simply retry the batch
+        for seq, (i, _, ts) in zip(seqs, accepted):
+            results[i] = {"index": i, "status": "queued", "seq": seq, "timestamp": ts.isoformat()}
+        queued = True
+    elif accepted:
+        ids = write_iot_readings([(values, ts) for _, values, ts in accepted])
+        for rec_id, (i, _, ts) in zip(ids, accepted):
+            results[i] = {"index": i, "status": "ok", "id": rec_id, "timestamp": ts.isoformat()}
+
+    body = {"accepted": len(accepted), "rejected": len(items) - len(accepted), "results": results}
+    if queued:
+        return jsonify(body), 202
+    return jsonify(body), 200 if accepted or not items else 400
+
+def write_iot_readings(readings):
+    """
+    Persists validated readings with one multi-row INSERT, folds them into the
+    rollup tables and appends them to the archive.
+
+    - readings: [(values, timestamp), ...] as produced by parse_iot_reading.
+    Returns: list of new IoTReading ids in input order.
+    """
+    rows = [dict(values, timestamp=ts) for values, ts in readings]
+    with serialized_write():
+        ids = db.session.scalars(  # single multi-row INSERT ... RETURNING id
+            insert(IoTReading).returning(IoTReading.id, sort_by_parameter_order=True),
+            rows
+        ).all()
+        apply_rollup_deltas(rollup_deltas(readings))  # same transaction as the raw rows
+        db.session.commit()
+    METRICS.inc("wqi_iot_readings_written_total", value=len(ids))
+    records = [(rec_id, values, ts) for rec_id, (values, ts) in zip(ids, readings)]
+    archive_iot_readings(records)
+    IOT_HUB.publish_records(records)  # push to live /api/iot/stream subscribers
+    newest = max(records, key=lambda r: (r[2], r[0]))
+    get_latest_iot_cache().offer(
+        iot_stream_event(newest[0], newest[1]["temperature_c"], newest[1]["ph"], newest[1]["turbidity_ntu"],
+                         newest[1]["turbidity_percent"], newest[2]),
+        newest[2])
+    return ids
+
+# --- IoT write-behind queue ---
+class IoTQueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("IoT ingest queue is full")
+        self.retry_after = retry_after  # seconds until the writer has likely drained a flush
+
+class IoTWriter:
+    """
+    Bounded in-process buffer of validated IoT readings drained by a background thread.
+
+    Readings are flushed with write_iot_readings when `flush_batch` rows are waiting
+    or `flush_interval` seconds have passed, whichever comes first. When the buffer
+    is full, submit raises IoTQueueFull so the route can answer 429. If a flush fails
+    (e.g. the database is down) the rows go back to the front of the buffer and are
+    retried, so backpressure builds up instead of readings being dropped.
+    """
+
+    def __init__(self, max_size=10000, flush_batch=500, flush_interval=1.0):
+        self.max_size = max_size
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self.buffer = deque()  # (seq, values, timestamp)
+        self.cond = threading.Condition()
+        self.seq = itertools.count(1)
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+        self.written = 0
+        self.failures = 0
+
+    def depth(self):
+        return len(self.buffer)
+
+    def submit(self, readings):
+        # enqueue [(values, timestamp), ...] atomically; returns one sequence id per reading
+        with self.cond:
+            if len(self.buffer) + len(readings) > self.max_size:
+                raise IoTQueueFull(max(1, int(self.flush_interval + 0.999)))
+            seqs = []
+            for values, ts in readings:
+                seq = next(self.seq)
+                self.buffer.append((seq, values, ts))
+                seqs.append(seq)
+            if len(self.buffer) >= self.flush_batch:
+                self.cond.notify()
+        self._ensure_thread()
+        METRICS.inc("wqi_iot_readings_queued_total", value=len(seqs))
+        return seqs
+
+    def _ensure_thread(self):
+        # start lazily and per process so forked gunicorn workers each get their own writer
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            return
+        with self.cond:
+            if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopping = False
+            self.thread = threading.Thread(target=self._run, name="iot-writer", daemon=True)
+            self.thread.start()
+
+    def _take(self):
+        with self.cond:
+            n = min(self.flush_batch, len(self.buffer))
+            return [self.buffer.popleft() for _ in range(n)]
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if len(self.buffer) < self.flush_batch and not self.stopping:
+                    self.cond.wait(self.flush_interval)
+                if self.stopping and not self.buffer:
+                    return
+            if not self.flush_once() and not self.stopping:
+                time.sleep(self.flush_interval)  # back off after a failed write
+
+    def flush_once(self):
+        batch = self._take()
+        if not batch:
+            return True
+        try:
+            with app.app_context():
+                write_iot_readings([(values, ts) for _, values, ts in batch])
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            self.failures += 1
+            print(f"IoT write-behind flush failed ({len(batch)} readings): {e}")
+            with self.cond:
+                self.buffer.extendleft(reversed(batch))  # retry in original order
+            return False
+
+    def stop(self, timeout=10.0):
+        # drain everything still buffered; called on worker shutdown
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread is not None and self.thread.is_alive() and self.pid == os.getpid():
+            self.thread.join(timeout)
+        deadline = time.time() + timeout
+        while self.buffer and time.time() < deadline:
+            if not self.flush_once():
+                time.sleep(0.2)
+        if self.buffer:
+            print(f"IoT write-behind: {len(self.buffer)} readings not persisted at shutdown")
+
+IOT_WRITER = None
+
+def iot_write_behind_enabled():
+    env = os.environ.get("IOT_WRITE_BEHIND")
+    if env is not None:
+        return env.lower() in ("1", "true", "yes", "on")
+    return bool(CONFIG.get("iot", {}).get("write_behind"))
+
+def get_iot_writer():
+    global IOT_WRITER
+    if IOT_WRITER is None:
+        cfg_iot = CONFIG.get("iot", {})
+        IOT_WRITER = IoTWriter(
+            max_size=int(cfg_iot.get("queue_max", 10000)),
+            flush_batch=int(cfg_iot.get("flush_batch", 500)),
+            flush_interval=float(cfg_iot.get("flush_interval_ms", 1000)) / 1000.0,
+        )
+    return IOT_WRITER
+
+def stop_iot_writer():
+    # flush buffered readings into the database and archive
+    if IOT_WRITER is not None:
+        IOT_WRITER.stop()
+
+def iot_queue_full_response(err):
+    resp = jsonify({"error": "Ingest queue is full, retry later", "retry_after": err.retry_after})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(err.retry_after)
+    return resp
+
+# --- IoT archive (rotating gzip CSV segments) ---
+ARCHIVE_DIR = os.path.join(DATA_DIR, "iot_archive")
+ARCHIVE_TS_FORMAT = "%Y%m%dT%H%M%S"
+
+class IoTArchive:
+    """
+    Append-only archive of IoT readings as gzip-compressed CSV segments.
+
+    Each process keeps one segment open with a buffered writer and rotates it after
+    `rotate_seconds` or once `rotate_bytes` of compressed data were written. Every
+    segment starts with its own CSV header (IOT_CSV_HEADER). Open segments are named
+    `iot-<opened>-p<pid>.open.csv.gz`; on rotation they are renamed to
+    `iot-<first>_<last>-p<pid>.csv.gz` using the earliest/latest reading timestamps,
+    which lets `read_range` skip segments that cannot contain the requested window.
+    """
+
+    def __init__(self, directory, rotate_seconds=86400, rotate_bytes=64 * 1024 * 1024, flush_seconds=5.0):
+        self.directory = directory
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.flush_seconds = flush_seconds
+        self.lock = iot_lock
+        self._raw = None
+        self._gz = None
+        self._text = None
+        self._writer = None
+        self._orphans = []  # handles inherited across fork; never closed here (see _open)
+        self.path = None
+        self.pid = None
+        self.opened_at = 0.0
+        self.flushed_at = 0.0
+        self.first_ts = None
+        self.last_ts = None
+
+    def _open(self):
+        if self._text is not None and self.pid != os.getpid():
+            # a forked child must not finish the parent's gzip stream; keep the handle alive and start fresh
+            self._orphans.append((self._raw, self._gz, self._text))
+            self._raw = self._gz = self._text = self._writer = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.pid = os.getpid()
+        self.opened_at = time.time()
+        self.flushed_at = self.opened_at
+        self.first_ts = self.last_ts = None
+        stamp = datetime.utcnow().strftime(ARCHIVE_TS_FORMAT)
+        self.path = os.path.join(self.directory, f"iot-{stamp}-p{self.pid}.open.csv.gz")
+        self._raw = open(self.path, "ab")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        self._text = io.TextIOWrapper(self._gz, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(IOT_CSV_HEADER)  # schema header for this segment
+
+    def _close(self):
+        if self._text is None:
+            return
+        self._text.close()  # writes the gzip trailer
+        self._raw.close()
+        if self.first_ts is not None:
+            final = os.path.join(self.directory, "iot-{}_{}-p{}.csv.gz".format(
+                self.first_ts.strftime(ARCHIVE_TS_FORMAT), self.last_ts.strftime(ARCHIVE_TS_FORMAT), self.pid))
+            os.replace(self.path, final)
+        else:
+            os.remove(self.path)  # nothing but a header
+        self._raw = self._gz = self._text = self._writer = None
+        self.path = None
+
+    def _needs_rotation(self):
+        return (time.time() - self.opened_at >= self.rotate_seconds
+                or self._raw.tell() >= self.rotate_bytes)
+
+    def append(self, records):
+        """records: [(id, values, timestamp), ...] as written by write_iot_readings."""
+        if not records:
+            return
+        with self.lock:
+            if self._text is None or self.pid != os.getpid():
+                self._open()
+            elif self._needs_rotation():
+                self._close()
+                self._open()
+            self._writer.writerows(
+                [rec_id, v["temperature_c"], v["ph"], v["turbidity_percent"], v["turbidity_ntu"], ts.isoformat(),
+                 v.get("device_id")]
+                for rec_id, v, ts in records
+            )
+            for _, _, ts in records:
+                if self.first_ts is None or ts < self.first_ts:
+                    self.first_ts = ts
+                if self.last_ts is None or ts > self.last_ts:
+                    self.last_ts = ts
+            if time.time() - self.flushed_at >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        # sync-flush the deflate stream so readers see everything written so far
+        if self._text is not None:
+            self._text.flush()
+            self._gz.flush(zlib.Z_SYNC_FLUSH)
+            self._raw.flush()
+            self.flushed_at = time.time()
+
+    def flush(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._close()
+
+    def segments(self, start=None, end=None):
+        # segment paths that may hold readings in [start, end), oldest first
+        out = []
+        for path in glob.glob(os.path.join(self.directory, "iot-*.csv.gz")):
+            name = os.path.basename(path)
+            if not name.endswith(".open.csv.gz"):
+                span = name[len("iot-"):].split("-p", 1)[0]
+                try:
+                    first, last = (datetime.strptime(x, ARCHIVE_TS_FORMAT) for x in span.split("_"))
+                except ValueError:
+                    first = last = None
+                if first is not None:
+                    if (end is not None and first >= end) or (start is not None and last < start.replace(microsecond=0)):
+                        continue
+            out.append(path)
+        return sorted(out, key=os.path.basename)
+
+    def read_range(self, start=None, end=None):
+        """
+        Streams archived readings with start <= timestamp < end (naive UTC datetimes, either optional).
+
+        Yields dicts with id, temperature_c, ph, turbidity_percent, turbidity_ntu, timestamp,
+        reading one segment at a time; order is by segment, then write order.
+        """
+        self.flush()  # include this process's unflushed rows
+        for path in self.segments(start, end):
+            try:
+                with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+                    header = None
+                    for row in csv.reader(f):
+                        if header is None or row[:1] == ["id"]:
+                            header = row  # schema header (repeated if a segment was appended to; older segments lack columns)
+                            continue
+                        rec = parse_archive_row(header, row)
+                        if rec is None:
+                            continue
+                        ts = rec["timestamp"]
+                        if (start is not None and ts < start) or (end is not None and ts >= end):
+                            continue
+                        yield rec
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                continue  # segment truncated by a crash: keep what was readable
+
+def parse_archive_row(header, row):
+    # map a CSV row onto the reading schema using its segment's header; None if malformed
+    if len(row) != len(header):
+        return None
+    raw = dict(zip(header, row))
+    try:
+        rec = {"id": int(raw["id"]), "timestamp": datetime.fromisoformat(raw["timestamp"])}
+    except (KeyError, ValueError):
+        return None
+    for key in ("temperature_c", "ph", "turbidity_percent", "turbidity_ntu"):
+        val = raw.get(key)
+        try:
+            rec[key] = float(val) if val not in (None, "") else None
+        except ValueError:
+            rec[key] = None
+    rec["device_id"] = raw.get("device_id") or None
+    return rec
+
+IOT_ARCHIVE = None
+
+def get_iot_archive():
+    global IOT_ARCHIVE
+    if IOT_ARCHIVE is None:
+        cfg_iot = CONFIG.get("iot", {})
+        IOT_ARCHIVE = IoTArchive(
+            ARCHIVE_DIR,
+            rotate_seconds=float(cfg_iot.get("archive_rotate_hours", 24)) * 3600,
+            rotate_bytes=int(float(cfg_iot.get("archive_rotate_mb", 64)) * 1024 * 1024),
+            flush_seconds=float(cfg_iot.get("archive_flush_s", 5)),
+        )
+    return IOT_ARCHIVE
+
+def archive_iot_readings(records):
+    # records: [(id, values, timestamp), ...]
+    try:
+        get_iot_archive().append(records)
+    except OSError as e:
+        print(f"IoT archive write failed: {e}")  # the database row is already committed
+
+def shutdown_iot():
+    # drain the write-behind queue, then close the archive segment; atexit and gunicorn worker_exit
+    stop_iot_writer()
+    if IOT_ARCHIVE is not None:
+        IOT_ARCHIVE.close()
+
+atexit.register(shutdown_iot)
+
+@app.route('/api/iot/archive', methods=['GET'])
+def iot_archive_export():
+    try:
+        start = parse_iot_timestamp(request.args["from"]) if request.args.get("from") else None
+        end = parse_iot_timestamp(request.args["to"]) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'from' or 'to'"}), 400
+
+    def generate():
+        for rec in get_iot_archive().read_range(start, end):
+            rec["timestamp"] = rec["timestamp"].isoformat()
+            yield json.dumps(rec) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.cli.command("iot-archive-import-csv")
+def iot_archive_import_csv():
+    """Copy the legacy data/iot.csv side-log into the archive and rename it to iot.csv.archived."""
+    csv_path = os.path.join(DATA_DIR, "iot.csv")
+    if not os.path.exists(csv_path):
+        print("No legacy iot.csv found.")
+        return
+    records = []
+    with open(csv_path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0] == "id":
+                continue
+            # early rows have no ph/turbidity_ntu columns, and the legacy log never had device_id
+            header = IOT_CSV_HEADER[:6] if len(row) == 6 else ["id", "temperature_c", "turbidity_percent", "timestamp"]
+            rec = parse_archive_row(header, row)
+            if rec is None:
+                print(f"Skipping malformed row: {row}")
+                continue
+            values = {k: rec.get(k) for k in ("temperature_c", "ph", "turbidity_percent", "turbidity_ntu")}
+            records.append((rec["id"], values, rec["timestamp"]))
+    archive = get_iot_archive()
+    archive.append(records)
+    archive.close()
+    os.replace(csv_path, csv_path + ".archived")
+    print(f"Archived {len(records)} legacy readings.")
+
+# --- Live IoT stream (Server-Sent Events) ---
+STREAM_MAX_SECONDS = 300  # clients reconnect automatically (EventSource), which frees the worker thread
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_QUEUE_SIZE = 256  # per-subscriber buffer; the oldest events are dropped for slow clients
+STREAM_SLOTS = WorkerSlots("iot", "stream_max_per_worker", 2)  # each open stream holds a gthread thread
+
+class IoTHub:
+    """
+    In-memory fan-out of newly stored IoT readings to SSE subscribers.
+
+    Readings stored by this process are published directly. While anyone is
+    subscribed, one watcher thread per process also picks up rows written by other
+    gunicorn workers (id greater than the last one seen), so the database sees one
+    small query per poll interval per process instead of one per open dashboard.
+    """
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.last_id = None  # highest reading id published so far
+        self.watcher = None
+        self.watcher_pid = None
+
+    def subscribe(self, baseline_id=None):
+        # baseline_id: newest reading id already shown to the client
+        q = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(q)
+            if self.last_id is None and baseline_id is not None:
+                self.last_id = baseline_id
+        self._ensure_watcher()
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    def publish(self, event):
+        with self.lock:
+            if self.last_id is not None and event["id"] <= self.last_id:
+                return  # already delivered (e.g. seen by the watcher and a local write)
+            self.last_id = event["id"]
+            targets = list(self.subscribers)
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                try:
+                    q.get_nowait()  # drop the oldest event for this slow client
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    pass
+
+    def publish_records(self, records):
+        # records: [(id, values, timestamp), ...] straight from write_iot_readings
+        if not self.has_subscribers():
+            with self.lock:
+                if records:
+                    self.last_id = max(self.last_id or 0, max(r[0] for r in records))
+            return
+        for rec_id, v, ts in sorted(records, key=lambda r: r[0]):
+            self.publish(iot_stream_event(rec_id, v["temperature_c"], v["ph"], v["turbidity_ntu"], v["turbidity_percent"], ts))
+
+    def _ensure_watcher(self):
+        with self.lock:
+            if self.watcher is not None and self.watcher.is_alive() and self.watcher_pid == os.getpid():
+                return
+            self.watcher_pid = os.getpid()
+            self.watcher = threading.Thread(target=self._watch, name="iot-stream-watcher", daemon=True)
+            self.watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.watcher = None
+                    return
+                last_id = self.last_id
+            try:
+                with app.app_context():
+                    if last_id is None:
+                        last_id = db.session.query(func.max(IoTReading.id)).scalar() or 0
+                        with self.lock:
+                            self.last_id = max(self.last_id or 0, last_id)
+                        continue
+                    rows = (IoTReading.query
+                            .filter(IoTReading.id > last_id)
+                            .order_by(IoTReading.id)
+                            .limit(STREAM_QUEUE_SIZE)
+                            .all())
+                    for r in rows:
+                        self.publish(iot_stream_event(r.id, r.temperature_c, r.ph, r.turbidity_ntu, r.turbidity_percent, r.timestamp))
+            except Exception as e:
+                print(f"IoT stream watcher error: {e}")
+
+IOT_HUB = IoTHub()
+
+def iot_stream_event(rec_id, temperature_c, ph, turbidity_ntu, turbidity_percent, timestamp):
+    # reading payload plus its sensor WQI/status so clients need no /calculate round trip
+    event = iot_reading_payload(temperature_c, ph, turbidity_ntu, turbidity_percent, timestamp)
+    event["id"] = rec_id
+    event["wqi"] = calculate_wqi({"ph": event.get("ph"), "turbidity": event.get("turbidity"), "temperature": event.get("temperature_c")})
+    event["status"], event["color"] = get_status(event["wqi"])
+    return event
+
+def sse_message(event):
+    return f"id: {event['id']}\nevent: reading\ndata: {json.dumps(event)}\n\n"
+
+@app.route('/api/iot/stream', methods=['GET'])
+def iot_stream():
+    if not STREAM_SLOTS.acquire():
+        # sensors.js falls back to polling GET /api/iot when the stream is refused
+        resp = jsonify({"error": "Too many open streams, poll /api/iot instead"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(int(CONFIG.get("iot", {}).get("stream_retry_after_s", 60)))
+        return resp
+    try:
+        entry = get_latest_iot_cache().get()
+        initial = entry["payload"] if entry is not None else None
+        baseline_id = db.session.query(func.max(IoTReading.id)).scalar() or 0
+    except Exception:
+        STREAM_SLOTS.release()
+        raise
+    db.session.close()  # don't hold a pooled connection for the life of the stream
+    q = IOT_HUB.subscribe(baseline_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if initial is not None:
+                yield sse_message(initial)
+            deadline = time.time() + STREAM_MAX_SECONDS
+            while time.time() < deadline:
+                try:
+                    event = q.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_message(event)
+        finally:
+            IOT_HUB.unsubscribe(q)
+            STREAM_SLOTS.release()
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Latest IoT reading cache ---
+LATEST_IOT_PATH = os.path.join(DATA_DIR, "iot_latest.json")
+
+def latest_reading_entry(payload, ts):
+    # ready-to-serve GET /api/iot entry: the payload plus its ETag and Last-Modified
+    body = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return {
+        "payload": payload,
+        "timestamp": ts,
+        "etag": hashlib.sha1(body).hexdigest()[:20],
+        "last_modified": ts.replace(tzinfo=timezone.utc),
+    }
+
+class LatestReadingCache:
+    """
+    Most recent IoT reading as a ready-to-serve payload with ETag and Last-Modified.
+
+    Ingest offers every new reading. Without the shared option, a worker revalidates
+    against the database at most once per `ttl` seconds, to pick up readings stored
+    by other workers. With `shared_path`, ingest also writes the entry to a small JSON
+    file, and readers reload it only when the file's mtime changes. That keeps all
+    workers on one host in sync without touching the database.
+    """
+
+    def __init__(self, ttl=2.0, shared_path=None):
+        self.ttl = ttl
+        self.shared_path = shared_path
+        self.lock = threading.Lock()
+        self.entry = None
+        self.loaded_at = 0.0
+        self.shared_mtime = None
+
+    def offer(self, payload, ts):
+        # payload: iot_stream_event(...) for a stored reading with timestamp ts
+        with self.lock:
+            if self.entry is not None and ts < self.entry["timestamp"]:
+                return  # a late/backfilled reading is not the latest
+            self.entry = latest_reading_entry(payload, ts)
+            self.loaded_at = time.time()
+            if self.shared_path:
+                self._write_shared(payload, ts)
+
+    def _write_shared(self, payload, ts):
+        tmp = f"{self.shared_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"payload": payload, "timestamp": ts.isoformat()}, f)
+            os.replace(tmp, self.shared_path)  # atomic swap so readers never see a partial file
+            self.shared_mtime = os.stat(self.shared_path).st_mtime_ns
+        except OSError as e:
+            print(f"Latest IoT cache write failed: {e}")
+
+    def _read_shared(self):
+        try:
+            mtime = os.stat(self.shared_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.shared_mtime and self.entry is not None:
+            return True
+        try:
+            with open(self.shared_path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.entry = latest_reading_entry(data["payload"], datetime.fromisoformat(data["timestamp"]))
+            self.shared_mtime = mtime
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def get(self):
+        with self.lock:
+            if self.shared_path and self._read_shared():
+                return self.entry
+            if self.entry is not None and time.time() - self.loaded_at < self.ttl:
+                return self.entry
+        latest = db.session.execute(LATEST_IOT_READING).first()
+        with self.lock:
+            self.loaded_at = time.time()
+            if latest is None:
+                self.entry = None
+                return None
+            payload = iot_stream_event(latest.id, latest.temperature_c, latest.ph, latest.turbidity_ntu,
+                                       latest.turbidity_percent, latest.timestamp)
+            self.entry = latest_reading_entry(payload, latest.timestamp)
+            if self.shared_path:
+                self._write_shared(payload, latest.timestamp)
+            return self.entry
+
+LATEST_IOT_CACHE = None
+
+def get_latest_iot_cache():
+    global LATEST_IOT_CACHE
+    if LATEST_IOT_CACHE is None:
+        cfg_iot = CONFIG.get("iot", {})
+        LATEST_IOT_CACHE = LatestReadingCache(
+            ttl=float(cfg_iot.get("latest_cache_ttl_ms", 2000)) / 1000.0,
+            shared_path=LATEST_IOT_PATH if cfg_iot.get("latest_cache_shared") else None,
+        )
+    return LATEST_IOT_CACHE
+
+# --- IoT time series ---
+SERIES_BUCKETS = {"10s": 10, "30s": 30, "1m": 60, "5m": 300, "15m": 900, "1h": 3600, "6h": 21600, "1d": 86400}  # ascending
+SERIES_AGGS = ("avg", "min", "max")
+SERIES_MAX_POINTS = 2000  # buckets per response; the bucket is widened to stay under this
+
+def iot_series_fields():
+    # (name, SQL expression) pairs charted by the series API; turbidity prefers NTU like GET /api/iot
+    return [
+        ("temperature_c", IoTReading.temperature_c),
+        ("ph", IoTReading.ph),
+        ("turbidity", func.coalesce(IoTReading.turbidity_ntu, IoTReading.turbidity_percent)),
+    ]
+
+def epoch_bucket_expr(column, seconds):
+    # SQL expression flooring a timestamp column to a multiple of `seconds` since the epoch (None if unsupported)
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        # drop the fractional part first: strftime rounds to the millisecond, so xx.9995s would land in the next second
+        return cast(func.strftime("%s", func.substr(column, 1, 19)), Integer) // seconds * seconds
+    if dialect == "postgresql":
+        return func.floor(extract("epoch", column) / seconds) * seconds
+    return None
+
+def epoch_to_utc(seconds):
+    return datetime.fromtimestamp(int(seconds), tz=timezone.utc).replace(tzinfo=None)
+
+def iot_series(start, end, bucket_seconds, aggs):
+    """
+    Aggregates IoT readings in [start, end) into fixed-width buckets.
+
+    Returns: list of {"t": bucket_start, "count": n, "<field>": {"<agg>": value}} sorted by time.
+    Whole-minute buckets are served from iot_rollups. Sub-minute buckets (10s, 30s) read raw
+    readings: bucketed in SQL on SQLite/Postgres, streamed and aggregated in Python elsewhere.
+    """
+    if rollup_resolution_for(bucket_seconds):
+        return iot_series_rollup(start, end, bucket_seconds, aggs)
+    fields = iot_series_fields()
+    bucket = epoch_bucket_expr(IoTReading.timestamp, bucket_seconds)
+    points = []
+    if bucket is not None:
+        cols = [bucket.label("b"), func.count(IoTReading.id)]
+        for _, expr in fields:
+            cols += [getattr(func, agg)(expr) for agg in aggs]
+        stmt = (select(*cols)
+                .where(IoTReading.timestamp >= start, IoTReading.timestamp < end)
+                .group_by("b")
+                .order_by("b"))
+        for row in db.session.execute(stmt):
+            point = {"t": epoch_to_utc(row[0]), "count": row[1]}
+            i = 2
+            for name, _ in fields:
+                point[name] = {}
+                for agg in aggs:
+                    val = row[i]
+                    point[name][agg] = round(float(val), 3) if val is not None else None
+                    i += 1
+            points.append(point)
+        return points
+    return iot_series_python(start, end, bucket_seconds, aggs)
+
+def iot_series_python(start, end, bucket_seconds, aggs):
+    # fallback: stream raw rows in timestamp order and aggregate per bucket
+    fields = iot_series_fields()
+    stmt = (select(IoTReading.timestamp, *[expr for _, expr in fields])
+            .where(IoTReading.timestamp >= start, IoTReading.timestamp < end)
+            .order_by(IoTReading.timestamp)
+            .execution_options(yield_per=5000))
+    epoch = datetime(1970, 1, 1)
+    points = []
+    current = None
+    for row in db.session.execute(stmt):
+        b = int((row[0] - epoch).total_seconds()) // bucket_seconds * bucket_seconds
+        if current is None or current["b"] != b:
+            current = {"b": b, "count": 0, "acc": {name: [0.0, 0, None, None] for name, _ in fields}}
+            points.append(current)
+        current["count"] += 1
+        for (name, _), val in zip(fields, row[1:]):
+            if val is None:
+                continue
+            acc = current["acc"][name]  # [sum, n, min, max]
+            acc[0] += val
+            acc[1] += 1
+            acc[2] = val if acc[2] is None else min(acc[2], val)
+            acc[3] = val if acc[3] is None else max(acc[3], val)
+    out = []
+    for p in points:
+        point = {"t": epoch_to_utc(p["b"]), "count": p["count"]}
+        for name, _ in fields:
+            total, n, mn, mx = p["acc"][name]
+            values = {"avg": total / n if n else None, "min": mn, "max": mx}
+            point[name] = {agg: round(float(values[agg]), 3) if values[agg] is not None else None for agg in aggs}
+        out.append(point)
+    return out
+
+# --- IoT rollups ---
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+ROLLUP_FIELDS = ("temperature_c", "ph", "turbidity", "wqi")
+EPOCH = datetime(1970, 1, 1)
+
+def rollup_resolution_for(bucket_seconds):
+    # coarsest rollup resolution that evenly divides the bucket, or None
+    best = None
+    for name, seconds in ROLLUP_RESOLUTIONS.items():
+        if bucket_seconds % seconds == 0:
+            best = name
+    return best
+
+def rollup_deltas(readings):
+    """
+    Aggregates [(values, timestamp), ...] into {(resolution, bucket_start): delta}.
+
+    A delta is {"count": n, "<field>": [n, sum, min, max]} for each ROLLUP_FIELDS entry.
+    WQI is derived from temperature/pH/turbidity the same way the sensors page scores readings.
+    """
+    scored = []
+    for values, ts in readings:
+        turb = values["turbidity_ntu"] if values.get("turbidity_ntu") is not None else values.get("turbidity_percent")
+        scored.append((ts, {"temperature_c": values.get("temperature_c"), "ph": values.get("ph"), "turbidity": turb}))
+    wqis = calculate_wqi_many(
+        [{"ph": v["ph"], "turbidity": v["turbidity"], "temperature": v["temperature_c"]} for _, v in scored]
     )
-    db.session.add(rec)
+    deltas = {}
+    for (ts, v), wqi in zip(scored, wqis):
+        v["wqi"] = wqi
+        epoch_s = int((ts - EPOCH).total_seconds())
+        for name, seconds in ROLLUP_RESOLUTIONS.items():
+            key = (name, epoch_to_utc(epoch_s // seconds * seconds))
+            delta = deltas.get(key)
+            if delta is None:
+                delta = deltas[key] = {"count": 0, **{f: [0, 0.0, None, None] for f in ROLLUP_FIELDS}}
+            delta["count"] += 1
+            for f in ROLLUP_FIELDS:
+                val = v[f]
+                if val is None:
+                    continue
+                acc = delta[f]
+                acc[0] += 1
+                acc[1] += val
+                acc[2] = val if acc[2] is None else min(acc[2], val)
+                acc[3] = val if acc[3] is None else max(acc[3], val)
+    return deltas
+
+def rollup_row(resolution, bucket_start, delta):
+    row = {"resolution": resolution, "bucket_start": bucket_start, "count": delta["count"]}
+    for f in ROLLUP_FIELDS:
+        n, total, mn, mx = delta[f]
+        row.update({f"{f}_n": n, f"{f}_sum": total if n else None, f"{f}_min": mn, f"{f}_max": mx})
+    return row
+
+def apply_rollup_deltas(deltas):
+    # merge deltas into iot_rollups with an atomic upsert per bucket (caller commits)
+    if not deltas:
+        return
+    rows = [rollup_row(res, start, delta) for (res, start), delta in deltas.items()]
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as upsert_insert
+        least, greatest = func.min, func.max  # two-argument scalar forms
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert_insert
+        least, greatest = func.least, func.greatest
+    else:
+        return apply_rollup_rows_generic(rows)
+    stmt = upsert_insert(IoTRollup)
+    t, ex = IoTRollup.__table__.c, stmt.excluded
+    updates = {"count": t["count"] + ex["count"]}
+    for f in ROLLUP_FIELDS:
+        updates[f"{f}_n"] = t[f"{f}_n"] + ex[f"{f}_n"]
+        updates[f"{f}_sum"] = func.coalesce(t[f"{f}_sum"], 0.0) + func.coalesce(ex[f"{f}_sum"], 0.0)
+        # NULL means "no values yet"; coalesce both sides so one NULL never wins
+        updates[f"{f}_min"] = least(func.coalesce(t[f"{f}_min"], ex[f"{f}_min"]), func.coalesce(ex[f"{f}_min"], t[f"{f}_min"]))
+        updates[f"{f}_max"] = greatest(func.coalesce(t[f"{f}_max"], ex[f"{f}_max"]), func.coalesce(ex[f"{f}_max"], t[f"{f}_max"]))
+        updates[f"{f}_sum"] = db.case((updates[f"{f}_n"] == 0, None), else_=updates[f"{f}_sum"])
+    stmt = stmt.on_conflict_do_update(index_elements=["resolution", "bucket_start"], set_=updates)
+    db.session.execute(stmt, rows)
+
+def apply_rollup_rows_generic(rows):
+    # read-modify-write for backends without INSERT ... ON CONFLICT
+    for row in rows:
+        rec = IoTRollup.query.filter_by(resolution=row["resolution"], bucket_start=row["bucket_start"]).first()
+        if rec is None:
+            db.session.add(IoTRollup(**row))
+            continue
+        rec.count += row["count"]
+        for f in ROLLUP_FIELDS:
+            if not row[f"{f}_n"]:
+                continue
+            setattr(rec, f"{f}_n", getattr(rec, f"{f}_n") + row[f"{f}_n"])
+            setattr(rec, f"{f}_sum", (getattr(rec, f"{f}_sum") or 0.0) + row[f"{f}_sum"])
+            for suffix, pick in (("_min", min), ("_max", max)):
+                cur = getattr(rec, f + suffix)
+                setattr(rec, f + suffix, row[f + suffix] if cur is None else pick(cur, row[f + suffix]))
+    db.session.flush()
+
+def iot_series_rollup(start, end, bucket_seconds, aggs):
+    # series from iot_rollups; the window is widened to whole rollup buckets
+    resolution = rollup_resolution_for(bucket_seconds)
+    res_seconds = ROLLUP_RESOLUTIONS[resolution]
+    start_s = int((start - EPOCH).total_seconds()) // res_seconds * res_seconds
+    end_s = -(-int((end - EPOCH).total_seconds()) // res_seconds) * res_seconds
+    rows = (IoTRollup.query
+            .filter(IoTRollup.resolution == resolution,
+                    IoTRollup.bucket_start >= epoch_to_utc(start_s),
+                    IoTRollup.bucket_start < epoch_to_utc(end_s))
+            .order_by(IoTRollup.bucket_start)
+            .yield_per(5000))
+    fields = [name for name, _ in iot_series_fields()]
+    points = []
+    current = None
+    for r in rows:
+        b = int((r.bucket_start - EPOCH).total_seconds()) // bucket_seconds * bucket_seconds
+        if current is None or current["b"] != b:
+            current = {"b": b, "count": 0, "acc": {f: [0, 0.0, None, None] for f in fields}}
+            points.append(current)
+        current["count"] += r.count
+        for f in fields:
+            n = getattr(r, f"{f}_n")
+            if not n:
+                continue
+            acc = current["acc"][f]
+            acc[0] += n
+            acc[1] += getattr(r, f"{f}_sum")
+            mn, mx = getattr(r, f"{f}_min"), getattr(r, f"{f}_max")
+            acc[2] = mn if acc[2] is None else min(acc[2], mn)
+            acc[3] = mx if acc[3] is None else max(acc[3], mx)
+    out = []
+    for p in points:
+        point = {"t": epoch_to_utc(p["b"]), "count": p["count"]}
+        for f in fields:
+            n, total, mn, mx = p["acc"][f]
+            values = {"avg": total / n if n else None, "min": mn, "max": mx}
+            point[f] = {agg: round(float(values[agg]), 3) if values[agg] is not None else None for agg in aggs}
+        out.append(point)
+    return out
+
+def rebuild_iot_rollups(chunk_size=50000):
+    """Recomputes iot_rollups from iot_readings, streaming raw rows in chunks. Returns readings processed."""
+    IoTRollup.query.delete()
     db.session.commit()
-    csv_path = os.path.join(DATA_DIR, "iot.csv")
-    write_header = not os.path.exists(csv_path)
-    with iot_lock:
-        with open(csv_path, "a", newline="") as f:  # also append to a CSV for quick inspection
-            writer = csv.writer(f)
-            if write_header:
-                writer.writerow(["id", "temperature_c", "ph", "turbidity_percent", "turbidity_ntu", "timestamp"])
-            writer.writerow([rec.id, temperature_c, ph_val, turbidity_percent_val, turbidity_ntu_val, ts.isoformat()])
-    return jsonify({"status": "ok", "id": rec.id, "timestamp": ts.isoformat()})
+    stmt = (select(IoTReading.temperature_c, IoTReading.turbidity_percent, IoTReading.ph,
+                   IoTReading.turbidity_ntu, IoTReading.timestamp)
+            .where(IoTReading.timestamp.is_not(None))
+            .order_by(IoTReading.timestamp)
+            .execution_options(yield_per=chunk_size))
+    total = 0
+    result = db.session.execute(stmt)
+    for chunk in result.partitions():
+        readings = [({"temperature_c": r[0], "turbidity_percent": r[1], "ph": r[2], "turbidity_ntu": r[3]}, r[4])
+                    for r in chunk]
+        apply_rollup_deltas(rollup_deltas(readings))
+        total += len(readings)
+    db.session.commit()
+    return total
+
+@app.cli.command("iot-rollup-backfill")
+def iot_rollup_backfill():
+    """Rebuild the minute/hour/day IoT rollup tables from the raw iot_readings table."""
+    total = rebuild_iot_rollups()
+    print(f"Rebuilt IoT rollups from {total} readings.")
+
+@app.route('/api/iot/rollups', methods=['GET'])
+def iot_rollups_api():
+    resolution = request.args.get("resolution") or "1h"
+    if resolution not in ROLLUP_RESOLUTIONS:
+        return jsonify({"error": f"'resolution' must be one of {','.join(ROLLUP_RESOLUTIONS)}"}), 400
+    try:
+        end = parse_iot_timestamp(request.args["to"]) if request.args.get("to") else datetime.utcnow()
+        start = parse_iot_timestamp(request.args["from"]) if request.args.get("from") else end - timedelta(days=7)
+    except ValueError:
+        return jsonify({"error": "Invalid 'from' or 'to'"}), 400
+    rows = (IoTRollup.query
+            .filter(IoTRollup.resolution == resolution,
+                    IoTRollup.bucket_start >= start,
+                    IoTRollup.bucket_start < end)
+            .order_by(IoTRollup.bucket_start)
+            .limit(SERIES_MAX_POINTS)
+            .all())
+    out = []
+    for r in rows:
+        item = {"t": r.bucket_start.isoformat(), "count": r.count}
+        for f in ROLLUP_FIELDS:
+            n = getattr(r, f"{f}_n")
+            item[f] = {
+                "count": n,
+                "sum": getattr(r, f"{f}_sum"),
+                "min": getattr(r, f"{f}_min"),
+                "max": getattr(r, f"{f}_max"),
+                "avg": round(getattr(r, f"{f}_sum") / n, 3) if n else None
+            }
+        out.append(item)
+    return jsonify({"resolution": resolution, "from": start.isoformat(), "to": end.isoformat(), "rollups": out})
+
+@app.route('/api/iot/series', methods=['GET'])
+def iot_series_api():
+    try:
+        end = parse_iot_timestamp(request.args["to"]) if request.args.get("to") else datetime.utcnow()
+        start = parse_iot_timestamp(request.args["from"]) if request.args.get("from") else end - timedelta(hours=24)
+    except ValueError:
+        return jsonify({"error": "Invalid 'from' or 'to'"}), 400
+    if start >= end:
+        return jsonify({"error": "'from' must be before 'to'"}), 400
+    aggs = [a.strip() for a in (request.args.get("agg") or "avg,min,max").split(",") if a.strip()]
+    if not aggs or any(a not in SERIES_AGGS for a in aggs):
+        return jsonify({"error": f"'agg' must be a comma-separated subset of {','.join(SERIES_AGGS)}"}), 400
+    requested = request.args.get("bucket") or "1m"
+    if requested not in SERIES_BUCKETS:
+        return jsonify({"error": f"'bucket' must be one of {','.join(SERIES_BUCKETS)}"}), 400
+    # widen the bucket until the window fits in SERIES_MAX_POINTS
+    span = (end - start).total_seconds()
+    bucket = requested
+    for name, seconds in SERIES_BUCKETS.items():
+        if seconds >= SERIES_BUCKETS[requested]:
+            bucket = name
+            if span / seconds <= SERIES_MAX_POINTS:
+                break
+    points = iot_series(start, end, SERIES_BUCKETS[bucket], aggs)[-SERIES_MAX_POINTS:]  # keep the newest
+    for p in points:
+        p["t"] = p["t"].isoformat()
+    return jsonify({
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "bucket": bucket,
+        "aggs": aggs,
+        "points": points
+    })
 
 @app.route('/sensors')
 def sensors_page():
     return render_template("sensors.html")
 
 @app.route('/config', methods=['GET'])
+@cached_response
 def get_config():
     return jsonify(CONFIG or {})  # expose current config to frontend
 
@@ -756,55 +4361,165 @@ def api_wqi():
         lng = float(request.args.get("lng"))
     except (TypeError, ValueError):
         return jsonify({"error": "Invalid or missing lat/lng"}), 400
+    if not (-90 <= lat <= 90):
+        return jsonify({"error": "Invalid or missing lat/lng"}), 400
+    try:
+        k = int(request.args["k"]) if request.args.get("k") else None
+        radius_km = float(request.args["radius_km"]) if request.args.get("radius_km") else None
+    except ValueError:
+        return jsonify({"error": "Invalid 'k' or 'radius_km'"}), 400
+    if (k is not None and not (1 <= k <= 1000)) or (radius_km is not None and radius_km < 0):
+        return jsonify({"error": "Invalid 'k' or 'radius_km'"}), 400
 
-    locations = Location.query.all()  # choose the nearest stored location to the clicked point
-    if not locations:
-        return jsonify({"error": "No locations available"}), 404
-
-    nearest = None
-    nearest_dist = float("inf")
-    for loc in locations:
-        dist = haversine_distance(lat, lng, loc.latitude, loc.longitude)  # compute great-circle distance (km)
-        if dist < nearest_dist:
-            nearest = loc
-            nearest_dist = dist
+    index = get_spatial_index()
+    if k is not None or radius_km is not None:
+        # k-nearest / radius query over user and reference locations
+        hits = index.nearest(lat, lng, k=k or 1000, radius_km=radius_km)
+        return jsonify({"results": nearest_results(hits)})
 
+    hits = index.nearest(lat, lng, k=1, kinds={"location"})  # choose the nearest stored location to the clicked point
+    if not hits:
+        return jsonify({"error": "No locations available"}), 404
+    nearest = db.session.get(Location, hits[0][1][1])
     if nearest is None:
         return jsonify({"error": "No nearby location found"}), 404
 
-    sample = (WaterSample.query
-              .filter_by(location_id=nearest.id)
-              .order_by(WaterSample.timestamp.desc())
-              .first())
+    sample = nearest.latest_sample
     if sample is None:
         return jsonify({"error": "No samples for nearest location"}), 404
 
-    if sample.wqi is None:
-        data = {
-            "ph": sample.ph,
-            "do": sample.do,
-            "tds": sample.tds,
-            "turbidity": sample.turbidity,
-            "nitrate": sample.nitrate
-        }
-        sample.wqi = calculate_wqi(data)  # compute WQI if missing
-        db.session.commit()
-
-    status, color = get_status(sample.wqi)
+    wqi_val = sample_wqi(sample)  # scored on the fly if missing or stale; GET never writes
+    status, color = get_status(wqi_val)
     return jsonify({
         "latitude": nearest.latitude,
         "longitude": nearest.longitude,
-        "wqi": sample.wqi,
+        "wqi": wqi_val,
         "status": status,
         "color": color
     })
 
+def nearest_results(hits):
+    # resolve (distance, key) hits into JSON rows with one query per table
+    loc_ids = [key[1] for _, key in hits if key[0] == "location"]
+    ref_ids = [key[1] for _, key in hits if key[0] == "reference"]
+    locs = {}
+    if loc_ids:
+        for loc, sample in (db.session.query(Location, WaterSample)
+                            .outerjoin(WaterSample, WaterSample.id == Location.latest_sample_id)
+                            .filter(Location.id.in_(loc_ids))):
+            locs[loc.id] = (loc, sample)
+    refs = {}
+    if ref_ids:
+        refs = {r.id: r for r in ReferenceLocation.query.filter(ReferenceLocation.id.in_(ref_ids))}
+    out = []
+    for dist, (kind, obj_id) in hits:
+        if kind == "location" and obj_id in locs:
+            loc, sample = locs[obj_id]
+            wqi_val = sample_wqi(sample) if sample else None
+            name = loc.name
+            lat, lng = loc.latitude, loc.longitude
+        elif kind == "reference" and obj_id in refs:
+            ref = refs[obj_id]
+            wqi_val = ref.wqi
+            name = ref.name + " (" + ref.location + ")"
+            lat, lng = ref.latitude, ref.longitude
+        else:
+            continue  # removed by another worker since the index was built
+        status, color = get_status(wqi_val)
+        out.append({
+            "type": kind,
+            "id": obj_id,
+            "name": name,
+            "latitude": lat,
+            "longitude": lng,
+            "distance_km": round(dist, 3),
+            "wqi": wqi_val,
+            "status": status,
+            "color": color
+        })
+    return out
+
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """Apply pending schema migrations and upsert the static reference locations (run once per deploy)."""
+    print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+    applied = migrate_db()
+    print(f"Applied migrations {applied}." if applied else "Schema is up to date.")
+    print(f"Upserted {seed_reference_locations()} reference locations from static_wb.json.")
+
+def explain_checks():
+    # (name, statement, index its plan must use) for the hot read paths, built exactly as the routes build them
+    now = datetime.utcnow()
+    fingerprint = get_wqi_fingerprint()
+    return [
+        ("latest sample of a location", latest_sample_id_stmt(1), "ix_water_samples_location_timestamp"),
+        ("location history range", location_history_stmt(1, now - timedelta(days=30), now),
+         "ix_water_samples_location_timestamp"),
+        ("location history signature", location_signature_stmt(1), "ix_water_samples_location_timestamp"),
+        ("map status filter", MAP_LOCATION_ROWS.where(WaterSample.status == "Good", WaterSample.wqi_config == fingerprint),
+         "ix_water_samples_status_config"),
+        ("stale sample probe", stale_sample_probe(fingerprint), "ix_water_samples_wqi_config"),
+        ("latest IoT reading", LATEST_IOT_READING, "ix_iot_readings_timestamp"),
+        ("latest reading of a device", LATEST_DEVICE_READING.params(device_id="esp32"), "ix_iot_readings_device_timestamp"),
+    ]
+
+def explain_plan(conn, stmt):
+    # plan text for stmt on the current backend (SQLite EXPLAIN QUERY PLAN or Postgres EXPLAIN)
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    return [str(row[-1]) for row in conn.exec_driver_sql(prefix + sql)]  # driver SQL: literals may contain ':'
+
+def check_query_plans():
+    """
+    Runs EXPLAIN for every explain_checks() query. Returns [(name, index, plan_lines, uses_index)].
+
+    Small tables are cheapest to scan, so this judges whether each index is usable rather than
+    what today's row counts favour: Postgres disables sequential scans, SQLite plans without
+    sqlite_stat1 (hidden in a transaction that is rolled back, then reloaded).
+    """
+    results = []
+    with db.engine.connect() as conn:
+        has_stats = False
+        if conn.dialect.name == "postgresql":
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        elif inspect(conn).has_table("sqlite_stat1"):
+            has_stats = True
+            conn.exec_driver_sql("DELETE FROM sqlite_stat1")
+            conn.exec_driver_sql("ANALYZE sqlite_master")
+        for name, stmt, index in explain_checks():
+            plan = explain_plan(conn, stmt)
+            results.append((name, index, plan, any(index in line for line in plan)))
+        conn.rollback()
+        if has_stats:
+            conn.exec_driver_sql("ANALYZE sqlite_master")
+    return results
+
+@app.cli.command("db-explain")
+def db_explain():
+    """Print query plans for the hot queries and fail unless each uses its index (SQLite and Postgres)."""
+    dialect = db.engine.dialect.name
+    if dialect not in ("sqlite", "postgresql"):
+        raise click.ClickException(f"db-explain supports SQLite and Postgres, not {dialect}")
+    failed = []
+    for name, index, plan, ok in check_query_plans():
+        print(f"{'ok  ' if ok else 'FAIL'} {name} (expects {index})")
+        for line in plan:
+            print(f"       {line}")
+        if not ok:
+            failed.append(name)
+    if failed:
+        raise click.ClickException(f"{len(failed)} queries do not use their index: {', '.join(failed)}")
+    print("All query plans use their indexes.")
+
+if os.environ.get("WQI_AUTO_MIGRATE") == "1":
+    # opt-in: migrate on import, as before db-upgrade existed (costs a schema check in every worker)
+    with app.app_context():
+        migrate_db()
+        seed_reference_locations()
+
 # --- Run ---
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
-        try:
-            seed_reference_locations()
-        except Exception as e:
-            print(f"Startup seed failed: {e}")
+        migrate_db()  # development server: keep the local SQLite schema current
+        seed_reference_locations()
     app.run(debug=True)  # run the development server
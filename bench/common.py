@@ -0,0 +1,95 @@
+"""
+Shared helpers for the benchmark scripts: loading the app against a scratch database,
+seeding synthetic locations/samples and summarizing latencies.
+"""
+import contextlib
+import os
+import random
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_CHUNK = 5000
+LAT_RANGE = (21.0, 27.0)  # synthetic points fall inside this box
+LNG_RANGE = (85.0, 89.0)
+
+def scratch_database_url():
+    return f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='wqi-bench-'), 'bench.db')}"
+
+def load_app(database_url=None, wal=True):
+    """
+    Imports app.py against database_url (a scratch SQLite file by default) with settings
+    that keep runs deterministic: no write-behind, no latest-reading cache, no background
+    rescoring and no config hot reload. Runtime files (IoT archive, caches, metrics snapshots)
+    go to a scratch WQI_DATA_DIR, which gunicorn started by the suite inherits.
+    """
+    os.environ["DATABASE_URL"] = database_url or scratch_database_url()
+    os.environ.setdefault("WQI_DATA_DIR", tempfile.mkdtemp(prefix="wqi-bench-data-"))
+    sys.path.insert(0, ROOT)
+    import app as app_module  # imported after DATABASE_URL is set
+
+    app_module.CONFIG.setdefault("database", {})
+    if not wal:
+        app_module.CONFIG["database"].update(sqlite_wal=False, sqlite_synchronous="FULL")
+    app_module.CONFIG.setdefault("iot", {}).update(write_behind=False, latest_cache_ttl_ms=0, latest_cache_shared=False)
+    app_module.CONFIG.setdefault("rescore", {})["background"] = False
+    app_module.LATEST_IOT_CACHE = None
+    app_module.reload_config_if_changed = lambda: False  # keep the settings above in force
+    return app_module
+
+def reset_and_seed(app_module, locations, samples, seed=42):
+    """
+    Drops and recreates every table, then inserts `locations` random locations and `samples`
+    scored samples spread across them (chunked executemany), points each location at its
+    latest sample and invalidates cached responses.
+    """
+    from sqlalchemy import insert
+    rng = random.Random(seed)
+    with app_module.app.app_context(), contextlib.redirect_stdout(sys.stderr):  # keep migration chatter off stdout
+        db = app_module.db
+        db.drop_all()
+        app_module.migrate_db()
+        app_module.seed_reference_locations()
+        for start in range(0, locations, SEED_CHUNK):
+            db.session.execute(insert(app_module.Location.__table__), [
+                {"name": f"Bench {i}", "latitude": rng.uniform(*LAT_RANGE), "longitude": rng.uniform(*LNG_RANGE)}
+                for i in range(start, min(locations, start + SEED_CHUNK))
+            ])
+            db.session.commit()
+        loc_ids = [row[0] for row in db.session.query(app_module.Location.id)]
+        model = app_module.get_wqi_model()
+        fingerprint = app_module.get_wqi_fingerprint()
+        for start in range(0, samples, SEED_CHUNK):
+            rows = [{
+                "location_id": rng.choice(loc_ids), "ph": rng.uniform(6, 9), "do": rng.uniform(3, 10),
+                "tds": rng.uniform(100, 900), "turbidity": rng.uniform(0, 20), "nitrate": rng.uniform(0, 50),
+                "temperature": rng.uniform(10, 30),
+            } for _ in range(min(SEED_CHUNK, samples - start))]
+            scores = model.score_columns({f: [r[f] for r in rows] for f in app_module.SAMPLE_FIELDS}, len(rows))
+            for row, score, (status, color) in zip(rows, scores, app_module.get_statuses(scores)):
+                row["wqi"] = score
+                row["status"] = status
+                row["color"] = color
+                row["wqi_config"] = fingerprint
+            db.session.execute(insert(app_module.WaterSample.__table__), rows)
+            db.session.commit()
+        app_module.backfill_latest_samples()
+        app_module.data_changed()  # drop pages cached for the previous scale
+        db.session.remove()
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of seconds, reported in milliseconds
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return round(sorted_values[idx] * 1000, 2)
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "per_s": round(len(latencies) / seconds, 1) if seconds else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
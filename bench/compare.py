@@ -0,0 +1,48 @@
+"""
+Compares two bench/suite.py reports run by run.
+
+Usage:
+    python bench/compare.py baseline.json candidate.json [--threshold 10]
+
+Prints requests/s, p95 and SQL-per-request side by side for every (samples, locations,
+mode, endpoint) present in both, and marks changes beyond --threshold percent.
+Exits with status 1 when any run's throughput regressed past the threshold.
+"""
+import argparse
+import json
+
+def load_runs(path):
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    return {(r["samples"], r["locations"], r["mode"], r["endpoint"]): r for r in report["runs"]}
+
+def change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) / old * 100.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change worth flagging")
+    args = parser.parse_args()
+    base, cand = load_runs(args.baseline), load_runs(args.candidate)
+    regressed = False
+    print(f"{'samples':>8} {'locs':>6} {'mode':8} {'endpoint':14} {'req/s':>17} {'p95 ms':>17} {'sql/req':>11}")
+    for key in sorted(base.keys() & cand.keys()):
+        old, new = base[key], cand[key]
+        tput = change(old["per_s"], new["per_s"])
+        flag = ""
+        if tput is not None and abs(tput) >= args.threshold:
+            flag = "  faster" if tput > 0 else "  SLOWER"
+            regressed = regressed or tput < 0
+        old_sql = (old.get("sql_per_request") or {}).get("mean")
+        new_sql = (new.get("sql_per_request") or {}).get("mean")
+        print(f"{key[0]:>8} {key[1]:>6} {key[2]:8} {key[3]:14} "
+              f"{old['per_s']:>8}->{new['per_s']:<8} {old['p95_ms']:>8}->{new['p95_ms']:<8} "
+              f"{str(old_sql):>5}->{str(new_sql):<5}{flag}")
+    raise SystemExit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Concurrent ingest/read throughput against a scratch database.
+
+Usage:
+    python bench/db_throughput.py [--threads 8] [--seconds 10] [--locations 200] [--samples 20000]
+                                  [--database-url URL] [--no-wal]
+
+Without --database-url a fresh SQLite file in a temp dir is used. Pass a Postgres URL
+(a throwaway database: tables are created and filled) to measure the pooled Postgres profile.
+--no-wal runs SQLite in rollback-journal mode with synchronous=FULL for comparison.
+Each phase drives the app through the Flask test client from N threads:
+    ingest  POST /api/iot
+    read    GET /api/locations and GET /api/iot (latest-reading cache TTL forced to 0)
+    mixed   half the threads ingest, half read
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from common import load_app, reset_and_seed, summarize
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of each phase")
+    parser.add_argument("--locations", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=20000)
+    parser.add_argument("--database-url", help="defaults to a scratch SQLite file")
+    parser.add_argument("--no-wal", action="store_true", help="SQLite rollback journal + synchronous=FULL")
+    return parser.parse_args()
+
+def run_phase(app_module, threads, seconds, roles):
+    # roles: (name, callable(client) -> status) cycled over the threads; returns {name: summary, "errors": n}
+    stop = time.monotonic() + seconds
+    results = {}
+    lock = threading.Lock()
+    errors = []
+
+    def worker(name, call):
+        client = app_module.app.test_client()
+        latencies = []
+        while time.monotonic() < stop:
+            t0 = time.perf_counter()
+            status = call(client)
+            latencies.append(time.perf_counter() - t0)
+            if status >= 400:
+                errors.append(status)
+        with lock:
+            results.setdefault(name, []).extend(latencies)
+
+    pool = [threading.Thread(target=worker, args=roles[i % len(roles)]) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    out = {name: summarize(latencies, seconds) for name, latencies in results.items()}
+    out["errors"] = len(errors)
+    return out
+
+def main():
+    args = parse_args()
+    app_module = load_app(args.database_url, wal=not args.no_wal)
+    reset_and_seed(app_module, args.locations, args.samples)
+
+    rng = random.Random(7)
+
+    def ingest(client):
+        return client.post("/api/iot", json={
+            "temperature_c": rng.uniform(15, 30), "ph": rng.uniform(6, 9), "turbidity_ntu": rng.uniform(0, 10),
+        }).status_code
+
+    def read_locations(client):
+        return client.get("/api/locations").status_code
+
+    def read_latest(client):
+        return client.get("/api/iot").status_code
+
+    ingest_role = ("ingest", ingest)
+    read_roles = [("locations", read_locations), ("latest_iot", read_latest)]
+    report = {
+        "wal": not args.no_wal,
+        "threads": args.threads,
+        "seconds": args.seconds,
+        "locations": args.locations,
+        "samples": args.samples,
+    }
+    with app_module.app.app_context():
+        report["backend"] = app_module.db.engine.dialect.name
+        report["database_url"] = app_module.db.engine.url.render_as_string(hide_password=True)
+    report["ingest"] = run_phase(app_module, args.threads, args.seconds, [ingest_role])
+    report["read"] = run_phase(app_module, args.threads, args.seconds, read_roles)
+    report["mixed"] = run_phase(app_module, args.threads, args.seconds, [ingest_role] + read_roles)
+    app_module.shutdown_iot()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Endpoint benchmark suite with machine-readable output.
+
+Usage:
+    python bench/suite.py [--scales 100:10,10000:10,10000:10000] [--modes client,gunicorn]
+                          [--endpoints calculate,ingest_iot,api_locations,map_viewport,api_wqi,data_page]
+                          [--requests 200] [--concurrency 4] [--workers 2]
+                          [--database-url URL] [--output results.json]
+
+Each scale is SAMPLES:LOCATIONS (add 1000000:10000 for the large dataset; seeding it takes a while).
+For every scale the database is dropped, migrated and seeded, then every endpoint is driven:
+    client    through the Flask test client in this process; SQL statements are counted per request
+    gunicorn  over HTTP against a real gunicorn (gunicorn.conf.py, --workers processes) on the same database
+The report (stdout or --output) lists requests/s and p50/p95/p99 latency per scale, mode and endpoint.
+Compare two reports with bench/compare.py.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from common import LAT_RANGE, LNG_RANGE, ROOT, load_app, reset_and_seed, summarize
+
+ENDPOINTS = ["calculate", "ingest_iot", "api_locations", "map_viewport", "api_wqi", "data_page"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--scales", default="100:10,10000:10,10000:10000", help="comma-separated SAMPLES:LOCATIONS")
+    parser.add_argument("--modes", default="client,gunicorn")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint per mode")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--database-url", help="defaults to a scratch SQLite file (tables are dropped!)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    args.scales = [tuple(int(part) for part in item.split(":")) for item in args.scales.split(",") if item]
+    args.modes = [m for m in args.modes.split(",") if m]
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    return args
+
+def request_for(endpoint, rng):
+    # (method, path, json body) for one call of the named endpoint
+    if endpoint == "calculate":
+        return "POST", "/calculate", {"ph": rng.uniform(6, 9), "do": rng.uniform(3, 10), "tds": rng.uniform(100, 900),
+                                      "turbidity": rng.uniform(0, 20), "nitrate": rng.uniform(0, 50),
+                                      "temperature": rng.uniform(10, 30)}
+    if endpoint == "ingest_iot":
+        return "POST", "/api/iot", {"temperature_c": rng.uniform(15, 30), "ph": rng.uniform(6, 9),
+                                    "turbidity_ntu": rng.uniform(0, 10)}
+    if endpoint == "api_locations":
+        return "GET", "/api/locations", None
+    if endpoint == "map_viewport":
+        # a 1024x768 px map view at a random zoom, centered inside the seeded area
+        zoom = rng.randint(5, 16)
+        half_w, half_h = 2.0 * 360 / 2 ** zoom, 1.5 * 360 / 2 ** zoom
+        lat, lng = rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE)
+        bbox = f"{lng - half_w:.5f},{max(-90, lat - half_h):.5f},{lng + half_w:.5f},{min(90, lat + half_h):.5f}"
+        return "GET", f"/api/locations?bbox={bbox}&zoom={zoom}", None
+    if endpoint == "api_wqi":
+        return "GET", f"/api/wqi?lat={rng.uniform(*LAT_RANGE):.5f}&lng={rng.uniform(*LNG_RANGE):.5f}", None
+    return "GET", "/data", None
+
+def drive(total, concurrency, call):
+    """Runs call(worker_index, rng) `total` times across `concurrency` threads; returns (results, seconds)."""
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker(index):
+        rng = random.Random(1000 + index)
+        local = []
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            local.append(call(index, rng))
+        with lock:
+            results.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started
+
+def run_client(app_module, endpoint, total, concurrency):
+    from sqlalchemy import event
+    local = threading.local()
+
+    def count_statement(*_):
+        local.statements = getattr(local, "statements", 0) + 1
+
+    clients = [app_module.app.test_client() for _ in range(concurrency)]
+
+    def call(index, rng):
+        method, path, body = request_for(endpoint, rng)
+        local.statements = 0
+        t0 = time.perf_counter()
+        resp = clients[index].open(path, method=method, json=body)
+        elapsed = time.perf_counter() - t0
+        return elapsed, resp.status_code, local.statements
+
+    with app_module.app.app_context():
+        engine = app_module.db.engine
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        results, seconds = drive(total, concurrency, call)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    out = summarize([r[0] for r in results], seconds)
+    queries = [r[2] for r in results]
+    out["sql_per_request"] = {"mean": round(sum(queries) / len(queries), 2), "max": max(queries)} if queries else None
+    out["errors"] = sum(1 for r in results if r[1] >= 400)
+    return out
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(database_url, workers):
+    port = free_port()
+    # os.environ carries the scratch WQI_DATA_DIR set by load_app, shared with client mode
+    env = dict(os.environ, DATABASE_URL=database_url, WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}"],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    import requests
+    for _ in range(200):
+        try:
+            requests.post(base + "/calculate", json={"ph": 7}, timeout=1)
+            return proc, base
+        except requests.RequestException:
+            if proc.poll() is not None:
+                raise RuntimeError("gunicorn exited during startup")
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+def run_gunicorn(base, endpoint, total, concurrency):
+    import requests
+    sessions = [requests.Session() for _ in range(concurrency)]  # keep-alive per thread
+
+    def call(index, rng):
+        method, path, body = request_for(endpoint, rng)
+        t0 = time.perf_counter()
+        try:
+            status = sessions[index].request(method, base + path, json=body, timeout=60).status_code
+        except requests.RequestException:
+            status = 599
+        return time.perf_counter() - t0, status
+
+    results, seconds = drive(total, concurrency, call)
+    out = summarize([r[0] for r in results], seconds)
+    out["sql_per_request"] = None  # not observable from outside the server process
+    out["errors"] = sum(1 for r in results if r[1] >= 400)
+    return out
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_args()
+    app_module = load_app(args.database_url)
+    with app_module.app.app_context():
+        database_url = app_module.db.engine.url.render_as_string(hide_password=False)
+        backend = app_module.db.engine.dialect.name
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": backend,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "gunicorn_workers": args.workers,
+        },
+        "runs": [],
+    }
+    for samples, locations in args.scales:
+        seed_started = time.perf_counter()
+        reset_and_seed(app_module, locations, samples)
+        print(f"seeded {samples} samples / {locations} locations in {time.perf_counter() - seed_started:.1f}s",
+              file=sys.stderr)
+        for mode in args.modes:
+            proc = None
+            if mode == "gunicorn":
+                proc, base = start_gunicorn(database_url, args.workers)
+            try:
+                for endpoint in args.endpoints:
+                    if mode == "client":
+                        result = run_client(app_module, endpoint, args.requests, args.concurrency)
+                    else:
+                        result = run_gunicorn(base, endpoint, args.requests, args.concurrency)
+                    report["runs"].append(dict({"samples": samples, "locations": locations, "mode": mode,
+                                                "endpoint": endpoint}, **result))
+                    print(f"  {mode:8} {endpoint:14} {result['per_s']:>8} req/s  p95 {result['p95_ms']} ms",
+                          file=sys.stderr)
+            finally:
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait(timeout=30)
+    app_module.shutdown_iot()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Gunicorn settings picked up automatically from the project root (Procfile: gunicorn app:app)
+import os
+
+# Worker profile, chosen with WEB_WORKER_CLASS:
+#   gthread (default) - threaded workers; long-lived /api/iot/stream and /chat/stream connections
+#                       each hold a thread, not a whole process
+#   gevent            - cooperative workers (pip install gevent); sockets, sleeps, locks and queues
+#                       are monkey-patched, so waiting on the chat router or an SSE client costs a
+#                       greenlet instead of a thread. Database calls are not patched: SQLite and
+#                       psycopg2 run in C and block the whole worker for the length of each query,
+#                       unless psycogreen is installed (Postgres only, see post_fork below)
+# Per worker, upstream chat calls are capped at chat.max_concurrent and open /api/iot/stream
+# connections at iot.stream_max_per_worker (config.json); requests over either cap get a 503.
+# On gthread that leaves WEB_THREADS minus both caps for everything else (IoT ingest included),
+# less any requests waiting on an identical chat question already in flight, which also hold a
+# thread until its answer arrives. gevent lifts those limits for waiting on the network, but a
+# slow query still stalls every greenlet in the worker.
+worker_class = os.environ.get("WEB_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))  # gthread only
+worker_connections = int(os.environ.get("WEB_WORKER_CONNECTIONS", "200"))  # gevent only
+
+# the heartbeat timeout only fires for a worker that stops responding, not for slow requests
+# on gthread/gevent, so it just has to cover a blocking database call
+timeout = int(os.environ.get("WEB_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", "5"))
+
+# load the app in each worker after the gevent worker has patched the standard library;
+# preloading would create locks and sessions in the master with unpatched modules
+preload_app = False
+
+def on_starting(server):
+    reserved_threads_check(server)
+    # per-worker metrics snapshots from a previous run would be added to this run's /metrics totals
+    import glob
+    data_dir = os.environ.get("WQI_DATA_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    for path in glob.glob(os.path.join(data_dir, "metrics", "metrics-*.json")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def reserved_threads_check(server):
+    # warn when the chat and stream caps together could occupy every gthread thread
+    if worker_class != "gthread":
+        return
+    import json
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"), encoding="utf-8") as f:
+            cfg = json.load(f)
+    except (OSError, ValueError):
+        return
+    capped = int(cfg.get("chat", {}).get("max_concurrent", 4)) + int(cfg.get("iot", {}).get("stream_max_per_worker", 2))
+    if threads <= capped:
+        server.log.warning(f"WEB_THREADS={threads} leaves no thread for IoT ingest once {capped} chat calls "
+                           "and streams are open; raise WEB_THREADS or lower the caps in config.json")
+
+def post_fork(server, worker):
+    # psycopg2 blocks in libpq; psycogreen installs a wait callback that yields to the gevent hub
+    if worker_class != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        server.log.info("psycogreen not installed; Postgres queries block the gevent worker")
+        return
+    patch_psycopg()
+
+def worker_exit(server, worker):
+    # flush buffered IoT readings and close the open archive segment before the worker goes away
+    try:
+        from app import shutdown_iot
+        shutdown_iot()
+    except Exception as e:
+        server.log.warning(f"IoT shutdown on worker exit failed: {e}")
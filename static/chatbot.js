@@ -4,6 +4,7 @@ const sendBtn = document.getElementById('send-btn');
 const clearBtn = document.getElementById('clear-btn');
 const loadingEl = document.getElementById('loading');
 const backendUrl = window.CHAT_BACKEND_URL || '/chat';                 
+const streamUrl = window.CHAT_STREAM_URL || '/chat/stream';
 
 const cache = new Map();
 let lastSentAt = 0;
@@ -142,6 +143,68 @@ function appendMessage(role, text, save = true) {
   }
 }
 
+function appendStreamingMessage() {
+  const wrapper = document.createElement('div');
+  wrapper.className = 'msg msg-assistant';
+  chatWindow.appendChild(wrapper);
+  return wrapper;
+}
+
+// Reads /chat/stream (SSE over a POST body) and renders tokens as they arrive.
+// Resolves with the full reply, or null when streaming is unavailable so the caller
+// can fall back to the plain /chat endpoint.
+async function streamReply(text, controller, onActivity) {
+  if (!window.ReadableStream || !window.TextDecoder) return null;
+  const resp = await fetch(streamUrl, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+    body: JSON.stringify({ message: text }),
+    signal: controller.signal,
+  });
+  if (!resp.ok || !resp.body || !(resp.headers.get('Content-Type') || '').includes('text/event-stream')) {
+    return null;
+  }
+  const reader = resp.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let reply = '';
+  let bubble = null;
+  let failed = false;
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    onActivity();
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = 'message';
+      let data = '';
+      block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      });
+      if (!data) continue;
+      const payload = JSON.parse(data);
+      if (event === 'error') {
+        failed = true;
+      } else if (payload.delta) {
+        if (!bubble) {
+          setLoading(false);
+          bubble = appendStreamingMessage();
+        }
+        reply += payload.delta;
+        bubble.innerHTML = renderAssistant(reply);
+        chatWindow.scrollTop = chatWindow.scrollHeight;
+      }
+    }
+  }
+  if (failed && !reply) return null;
+  if (bubble) bubble.remove();  // re-added through appendMessage so it lands in history
+  return reply;
+}
+
 function setLoading(loading) {
   loadingEl.classList.toggle('d-none', !loading);
 }
@@ -176,22 +239,32 @@ async function sendMessage() {
   lastSentAt = Date.now();
 
   const controller = new AbortController();
-  const timeoutId = setTimeout(() => controller.abort(), TIMEOUT_MS);
+  // Idle timeout: a streamed answer may take longer than TIMEOUT_MS as long as tokens keep coming
+  let timeoutId = setTimeout(() => controller.abort(), TIMEOUT_MS);
+  const onActivity = () => {
+    clearTimeout(timeoutId);
+    timeoutId = setTimeout(() => controller.abort(), TIMEOUT_MS);
+  };
 
   try {
-    const resp = await fetch(backendUrl, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ message: text }),
-      signal: controller.signal,
-    });
+    let reply = await streamReply(text, controller, onActivity);
+    if (reply === null) {
+      const resp = await fetch(backendUrl, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message: text }),
+        signal: controller.signal,
+      });
+      if (resp.ok) {
+        const data = await resp.json();
+        reply = data.reply || data.error || 'No response';
+      }
+    }
     clearTimeout(timeoutId);
 
-    if (!resp.ok) {
+    if (reply === null) {
       appendMessage('assistant', 'Sorry, I couldn’t reply. Please try again.');
     } else {
-      const data = await resp.json();
-      let reply = data.reply || data.error || 'No response';
       reply = reply.replace(/<think>[\s\S]*?<\/think>/gi, '');
       reply = reply.replace(/Thinking Process:[\s\S]*?(?=\n\n|$)/gi, '');
       reply = reply.trim();
@@ -1,6 +1,7 @@
 let map; // Google Map instance
 let lastMarker = null; // last highlighted marker for nearest location
-let allMarkers = []; // all static markers on map
+let allMarkers = []; // markers for the current viewport (points and clusters)
+let viewportRequest = null; // AbortController of the in-flight /api/locations request
 let CONFIG = null; // configuration loaded from backend
 
 function colorHexFromCategory(color) {
@@ -65,6 +66,32 @@ function addLocationMarker(lat, lng, name, wqi, status, color) {
     allMarkers.push(marker); // keep track of marker
 }
 
+function addClusterMarker(cluster) {
+    const scale = Math.min(28, 12 + Math.log10(cluster.count) * 6); // bigger circle for bigger clusters
+    const icon = {
+        path: google.maps.SymbolPath.CIRCLE,
+        fillColor: colorHexFromCategory(cluster.color), // colored by mean WQI
+        fillOpacity: 0.85,
+        strokeColor: '#ffffff',
+        strokeWeight: 2,
+        scale
+    };
+    const label = { text: String(cluster.count), color: '#ffffff', fontSize: '12px', fontWeight: 'bold' };
+    const marker = new google.maps.Marker({ position: { lat: cluster.latitude, lng: cluster.longitude }, map, icon, label });
+    const fmt = (v) => (v === null || v === undefined) ? '-' : Number(v).toFixed(1);
+    marker.setTitle(`${cluster.count} locations · WQI min ${fmt(cluster.wqi_min)} / avg ${fmt(cluster.wqi_avg)} / max ${fmt(cluster.wqi_max)}`);
+    marker.addListener('click', () => { // zoom to the cluster's members
+        const [south, west, north, east] = cluster.bounds;
+        map.fitBounds(new google.maps.LatLngBounds({ lat: south, lng: west }, { lat: north, lng: east }));
+    });
+    allMarkers.push(marker);
+}
+
+function clearLocationMarkers() {
+    allMarkers.forEach(marker => marker.setMap(null));
+    allMarkers = [];
+}
+
 async function fetchWqi(lat, lng) {
     const url = `/api/wqi?lat=${lat}&lng=${lng}`; // ask server for nearest location's WQI
     const res = await fetch(url); // call API
@@ -75,10 +102,34 @@ async function fetchWqi(lat, lng) {
     return res.json(); // parse result JSON
 }
 
-async function fetchLocations() {
-    const res = await fetch('/api/locations'); // get all static/user locations and their WQI
+async function fetchLocations(bounds, zoom, signal) {
+    // clusters (low zoom) or individual locations (high zoom) inside the visible area
+    const sw = bounds.getSouthWest();
+    const ne = bounds.getNorthEast();
+    const bbox = [sw.lng(), sw.lat(), ne.lng(), ne.lat()].map(v => v.toFixed(5)).join(',');
+    const res = await fetch(`/api/locations?bbox=${bbox}&zoom=${zoom}`, { signal });
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
-    return res.json(); // parse list
+    return res.json(); // { zoom, clustered, count, items }
+}
+
+async function loadViewport() {
+    const bounds = map.getBounds();
+    if (!bounds) return;
+    if (viewportRequest) viewportRequest.abort(); // only the latest pan/zoom matters
+    viewportRequest = new AbortController();
+    try {
+        const result = await fetchLocations(bounds, map.getZoom(), viewportRequest.signal);
+        clearLocationMarkers();
+        result.items.forEach(item => {
+            if (item.type === 'cluster') {
+                addClusterMarker(item);
+            } else {
+                addLocationMarker(item.latitude, item.longitude, item.name, item.wqi, item.status, item.color);
+            }
+        });
+    } catch (e) {
+        // aborted by a newer request, or the server is unavailable: keep the current markers
+    }
 }
 
 async function initMap() {
@@ -97,13 +148,7 @@ async function initMap() {
         streetViewControl: false // hide street view
     });
 
-    fetchLocations()
-        .then(list => {
-            list.forEach(item => { // add markers for each location
-                addLocationMarker(item.latitude, item.longitude, item.name, item.wqi, item.status, item.color);
-            });
-        })
-        .catch(() => {});
+    map.addListener('idle', loadViewport); // fires after every pan/zoom settles, and once on load
 
     map.addListener('click', async (e) => { // when user clicks the map
         const lat = e.latLng.lat(); // clicked latitude
@@ -65,24 +65,30 @@ async function renderStats(item) {
   let wqi = null; // computed WQI result
   let status = '—'; // status text
   let color = 'secondary'; // bootstrap color name
-  try {
-    const payload = {
-      ph: item.ph != null ? Number(item.ph) : undefined,
-      turbidity: turb != null ? Number(turb) : undefined,
-      temperature: item.temperature_c != null ? Number(item.temperature_c) : undefined
-    };
-    const res = await fetch('/calculate', { // request backend to compute WQI from sensor values
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(payload)
-    });
-    if (res.ok) {
-      const out = await res.json(); // parse result
-      wqi = out.wqi; // numeric score
-      status = out.status; // status label text
-      color = out.color; // bootstrap color class
-    }
-  } catch (e) {}
+  if (item.status !== undefined) { // server already scored this reading (stream events)
+    wqi = item.wqi;
+    status = item.status;
+    color = item.color;
+  } else {
+    try {
+      const payload = {
+        ph: item.ph != null ? Number(item.ph) : undefined,
+        turbidity: turb != null ? Number(turb) : undefined,
+        temperature: item.temperature_c != null ? Number(item.temperature_c) : undefined
+      };
+      const res = await fetch('/calculate', { // request backend to compute WQI from sensor values
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload)
+      });
+      if (res.ok) {
+        const out = await res.json(); // parse result
+        wqi = out.wqi; // numeric score
+        status = out.status; // status label text
+        color = out.color; // bootstrap color class
+      }
+    } catch (e) {}
+  }
   statWqi.textContent = wqi != null ? Number(wqi).toFixed(2) : '—';
   badgeWqi.textContent = status;
   badgeWqi.className = `badge bg-${color}`;
@@ -157,6 +163,37 @@ async function renderStats(item) {
   }
 }
 
+function showReading(item) {
+  renderStats(item); // render stats from payload
+  containerEl.classList.remove('d-none'); // show content
+  lastUpdateEl.textContent = `Last update: ${formatLocalTimestamp(item.timestamp)}`; // human readable time
+}
+
+function startPolling() {
+  fetchLatest(); // get first datapoint
+  const interval = (CONFIG && CONFIG.wqi && CONFIG.wqi.poll_interval_ms) ? CONFIG.wqi.poll_interval_ms : 5000; // polling interval ms
+  setInterval(fetchLatest, interval); // start automatic polling
+}
+
+function startStream() {
+  let failures = 0; // consecutive connection errors
+  const source = new EventSource('/api/iot/stream'); // server-sent events with readings + WQI
+  source.onopen = () => { failures = 0; };
+  source.addEventListener('reading', (e) => {
+    failures = 0;
+    showReading(JSON.parse(e.data));
+  });
+  source.onerror = () => {
+    failures += 1;
+    // CLOSED: the server refused the stream (503 when its stream cap is reached) and the
+    // browser will not reconnect; otherwise give up after repeated failures (e.g. proxy buffering)
+    if (source.readyState === EventSource.CLOSED || failures >= 3) { // fall back to polling
+      source.close();
+      startPolling();
+    }
+  };
+}
+
 document.addEventListener('DOMContentLoaded', () => {
   (async () => {
     try {
@@ -165,8 +202,10 @@ document.addEventListener('DOMContentLoaded', () => {
     } catch (e) {
       CONFIG = {}; // fallback to defaults
     }
-    fetchLatest(); // get first datapoint
-    const interval = (CONFIG && CONFIG.wqi && CONFIG.wqi.poll_interval_ms) ? CONFIG.wqi.poll_interval_ms : 5000; // polling interval ms
-    setInterval(fetchLatest, interval); // start automatic polling
+    if (window.EventSource) {
+      startStream(); // push updates from the server
+    } else {
+      startPolling(); // older browsers: poll the latest reading
+    }
   })();
 });
@@ -0,0 +1,24 @@
+"""
+Shared fixtures. app.py is imported once per session against a scratch SQLite database and a
+scratch WQI_DATA_DIR, so tests never touch data/wqi.db or the runtime files next to it.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRATCH = tempfile.mkdtemp(prefix="wqi-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(SCRATCH, 'test.db')}"
+os.environ["WQI_DATA_DIR"] = SCRATCH
+sys.path.insert(0, ROOT)
+
+import app as app_module  # noqa: E402  (imported after the environment above is set)
+
+@pytest.fixture(scope="session")
+def wqi():
+    """The app module with a migrated scratch database."""
+    with app_module.app.app_context():
+        app_module.migrate_db()
+    return app_module
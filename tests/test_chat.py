@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class StubRouter(BaseHTTPRequestHandler):
+    """Chat completions endpoint: model "bad" fails, every other model answers once `gate` is set."""
+    calls = []
+    gate = threading.Event()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.calls.append((body["model"], body["messages"][1]["content"]))
+        if body["model"] == "bad":
+            out, status = b'{"error": "unavailable"}', 500
+        else:
+            self.gate.wait(10)
+            reply = f"<think>hidden</think>{body['model']} says hi"
+            out, status = json.dumps({"choices": [{"message": {"content": reply}, "finish_reason": "stop"}]}).encode(), 200
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+@pytest.fixture(scope="module")
+def router():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRouter)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+    server.shutdown()
+
+@pytest.fixture
+def chat(wqi, router, monkeypatch):
+    StubRouter.calls.clear()
+    StubRouter.gate.set()
+    monkeypatch.setattr(wqi, "CHAT_URL", router)
+    monkeypatch.setattr(wqi, "CHAT_CACHE", None)  # fresh in-memory cache per test
+    monkeypatch.setitem(wqi.CONFIG, "chat", {**wqi.CONFIG.get("chat", {}), "cache_backend": "memory"})
+    monkeypatch.setenv("HUGGING_FACE_API_TOKEN", "test-token")
+    monkeypatch.setenv("HF_CHAT_MODEL", "primary")
+
+    def ask(message):
+        resp = wqi.app.test_client().post("/chat", json={"message": message})
+        return resp.status_code, resp.headers.get("X-Cache"), resp.get_json()
+    return ask
+
+def test_identical_questions_share_one_upstream_call(chat):
+    StubRouter.gate.clear()  # hold the first upstream call until every request has arrived
+    questions = ["What is WQI?", "what is  wqi", "WHAT IS WQI!", "What is WQI"] * 2
+    results = [None] * len(questions)
+    threads = [threading.Thread(target=lambda i=i, q=q: results.__setitem__(i, chat(q))) for i, q in enumerate(questions)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while not StubRouter.calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.3)
+    StubRouter.gate.set()
+    for t in threads:
+        t.join(10)
+    assert [model for model, _ in StubRouter.calls] == ["primary"]
+    assert all(status == 200 and body == {"reply": "primary says hi"} for status, _, body in results)
+    assert chat("what is wqi?")[1] == "HIT"
+    assert len(StubRouter.calls) == 1
+
+def test_fallback_reply_is_cached_under_the_fallback_model(wqi, chat, monkeypatch):
+    monkeypatch.setenv("HF_CHAT_MODEL", "bad")
+    status, cache, body = chat("Is the river safe?")
+    assert (status, cache) == (200, "MISS")
+    assert body == {"reply": f"{wqi.CHAT_FALLBACK_MODEL} says hi"}
+    assert [model for model, _ in StubRouter.calls] == ["bad", wqi.CHAT_FALLBACK_MODEL]
+    # the primary model never answered, so asking it again goes upstream again
+    assert chat("Is the river safe?")[1] == "MISS"
+    assert len(StubRouter.calls) == 4
+    monkeypatch.setenv("HF_CHAT_MODEL", wqi.CHAT_FALLBACK_MODEL)
+    assert chat("is the river safe")[1] == "HIT"
+    assert len(StubRouter.calls) == 4
+
+def test_cache_key_normalizes_the_question_but_not_the_model(wqi):
+    key = wqi.chat_cache_key
+    assert key("m", "What is WQI?") == key("m", "  what   is wqi ")
+    assert key("m", "What is WQI?") != key("other", "What is WQI?")
+    assert key("m", "What is WQI?") != key("m", "What is pH?")
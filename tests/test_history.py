@@ -0,0 +1,77 @@
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app import HISTORY_MIN_WINDOW, rolling_stats
+
+def naive_rolling_stats(values, window):
+    # trailing mean including each point; z-score against the `window` points before it
+    ma, z = [], []
+    for i, v in enumerate(values):
+        recent = [x for x in values[max(0, i - window + 1):i + 1] if not math.isnan(x)]
+        ma.append(sum(recent) / len(recent) if recent else math.nan)
+        before = [x for x in values[max(0, i - window):i] if not math.isnan(x)]
+        if math.isnan(v) or len(before) < HISTORY_MIN_WINDOW:
+            z.append(math.nan)
+            continue
+        mean = sum(before) / len(before)
+        std = math.sqrt(sum((x - mean) ** 2 for x in before) / len(before))
+        z.append((v - mean) / std if std > 1e-9 else math.nan)
+    return np.array(ma), np.array(z)
+
+@pytest.mark.parametrize("window", [1, 3, 7, 50])
+def test_rolling_stats_match_naive(window):
+    rng = np.random.default_rng(window)
+    values = rng.normal(60, 15, 400)
+    values[rng.random(400) < 0.2] = np.nan  # unscored samples / empty buckets
+    values[100:110] = np.nan  # a long gap
+    ma, z = rolling_stats(values, window)
+    expected_ma, expected_z = naive_rolling_stats(values.tolist(), window)
+    np.testing.assert_allclose(ma, expected_ma, rtol=1e-9, atol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(z, expected_z, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+def test_flat_series_has_no_zscore():
+    ma, z = rolling_stats(np.full(20, 42.0), 7)
+    assert np.allclose(ma, 42.0)
+    assert np.isnan(z).all()
+
+@pytest.fixture(scope="module")
+def location(wqi):
+    start = datetime(2021, 3, 1)
+    wqis = [50.0, 52.0, 48.0, 51.0, 49.0, 50.0, 95.0, 50.0, None, 51.0] * 3
+    with wqi.app.app_context():
+        fingerprint = wqi.get_wqi_fingerprint()
+        loc = wqi.Location(latitude=10.0, longitude=20.0, name="history test")
+        wqi.db.session.add(loc)
+        wqi.db.session.flush()
+        wqi.db.session.add_all(
+            wqi.WaterSample(location_id=loc.id, wqi=w, wqi_config=fingerprint, timestamp=start + timedelta(hours=8 * i))
+            for i, w in enumerate(wqis))
+        wqi.db.session.commit()
+        return loc.id, start, wqis
+
+def test_raw_history_flags_the_spikes(wqi, location):
+    location_id, _, wqis = location
+    with wqi.app.app_context():
+        body = wqi.location_history(location_id, None, None, "raw", 5, 3.0)
+    assert [p["wqi"] for p in body["points"]] == wqis
+    _, z = naive_rolling_stats([math.nan if w is None else w for w in wqis], 5)
+    assert [a["wqi"] for a in body["anomalies"]] == [w for w, score in zip(wqis, z) if abs(score) >= 3.0]
+    assert [a["wqi"] for a in body["anomalies"]].count(95.0) == 3  # every spike is flagged
+    scored = [w for w in wqis if w is not None]
+    assert body["stats"]["scored"] == len(scored)
+    assert body["stats"]["wqi_mean"] == round(sum(scored) / len(scored), 2)
+
+def test_daily_buckets_average_each_day(wqi, location):
+    location_id, start, wqis = location
+    with wqi.app.app_context():
+        points = wqi.location_history(location_id, None, None, "1d", 7, 3.0)["points"]
+    days = [wqis[i:i + 3] for i in range(0, len(wqis), 3)]  # three samples 8 hours apart per day
+    assert [p["count"] for p in points] == [len(d) for d in days]
+    assert [p["t"] for p in points] == [(start + timedelta(days=i)).isoformat() for i in range(len(days))]
+    for point, day in zip(points, days):
+        scored = [w for w in day if w is not None]
+        assert point["wqi"] == round(sum(scored) / len(scored), 2)
+        assert (point["wqi_min"], point["wqi_max"]) == (min(scored), max(scored))
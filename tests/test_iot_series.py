@@ -0,0 +1,53 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+START = datetime(2020, 1, 1)
+END = START + timedelta(hours=2)
+
+@pytest.fixture(scope="module")
+def readings(wqi):
+    rng = random.Random(7)
+    with wqi.app.app_context():
+        wqi.db.session.add_all(
+            wqi.IoTReading(temperature_c=round(rng.uniform(15, 35), 1), turbidity_percent=round(rng.uniform(0, 100), 1),
+                           ph=round(rng.uniform(5, 9), 2) if rng.random() > 0.1 else None,
+                           timestamp=START + timedelta(seconds=rng.uniform(0, 7200)))
+            for _ in range(3000))
+        wqi.db.session.commit()
+        wqi.rebuild_iot_rollups()
+    return wqi
+
+def assert_same_series(got, expected):
+    assert [(p["t"], p["count"]) for p in got] == [(p["t"], p["count"]) for p in expected]
+    for g, e in zip(got, expected):
+        for field in ("temperature_c", "ph", "turbidity"):
+            for agg, value in e[field].items():
+                assert g[field][agg] == pytest.approx(value, abs=1e-3)
+
+@pytest.mark.parametrize("bucket", ["10s", "30s"])
+def test_sub_minute_buckets_are_bucketed_in_sql(readings, monkeypatch, bucket):
+    wqi = readings
+    monkeypatch.setattr(wqi, "iot_series_python", lambda *a: pytest.fail("SQLite should bucket in SQL"))
+    monkeypatch.setattr(wqi, "iot_series_rollup", lambda *a: pytest.fail("sub-minute buckets have no rollup"))
+    seconds = wqi.SERIES_BUCKETS[bucket]
+    with wqi.app.app_context():
+        got = wqi.iot_series(START, END, seconds, list(wqi.SERIES_AGGS))
+        monkeypatch.undo()
+        assert_same_series(got, wqi.iot_series_python(START, END, seconds, list(wqi.SERIES_AGGS)))
+
+@pytest.mark.parametrize("bucket", ["1m", "5m", "1h"])
+def test_rollup_buckets_match_raw_readings(readings, bucket):
+    wqi = readings
+    seconds = wqi.SERIES_BUCKETS[bucket]
+    with wqi.app.app_context():
+        assert_same_series(wqi.iot_series(START, END, seconds, list(wqi.SERIES_AGGS)),
+                           wqi.iot_series_python(START, END, seconds, list(wqi.SERIES_AGGS)))
+
+def test_api_keeps_sub_minute_bucket_for_short_windows(readings):
+    body = readings.app.test_client().get(
+        "/api/iot/series", query_string={"from": START.isoformat(), "to": (START + timedelta(hours=1)).isoformat(),
+                                         "bucket": "10s"}).get_json()
+    assert body["bucket"] == "10s"
+    assert sum(p["count"] for p in body["points"]) > 0
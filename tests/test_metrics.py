@@ -0,0 +1,30 @@
+import pytest
+
+def requests_counted(wqi, status):
+    key = ("wqi_http_requests_total", (("method", "GET"), ("route", "/api/locations"), ("status", status)))
+    return wqi.METRICS.values.get(key, 0)
+
+@pytest.fixture
+def failing_locations(wqi, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(wqi, "map_location_items", boom)
+    return wqi.app.test_client()
+
+def test_unhandled_exception_is_counted_once(wqi, failing_locations, monkeypatch):
+    monkeypatch.setitem(wqi.app.config, "PROPAGATE_EXCEPTIONS", False)
+    before = requests_counted(wqi, "500")
+    assert failing_locations.get("/api/locations").status_code == 500
+    assert requests_counted(wqi, "500") == before + 1
+
+def test_propagated_exception_is_counted(wqi, failing_locations, monkeypatch):
+    monkeypatch.setitem(wqi.app.config, "PROPAGATE_EXCEPTIONS", True)  # as in debug mode
+    before = requests_counted(wqi, "500")
+    with pytest.raises(RuntimeError):
+        failing_locations.get("/api/locations")
+    assert requests_counted(wqi, "500") == before + 1
+
+def test_successful_request_is_counted_once(wqi):
+    before = requests_counted(wqi, "200")
+    assert wqi.app.test_client().get("/api/locations").status_code == 200
+    assert requests_counted(wqi, "200") == before + 1
@@ -0,0 +1,24 @@
+import pytest
+
+def test_hot_queries_use_their_indexes(wqi):
+    with wqi.app.app_context():
+        results = wqi.check_query_plans()
+    assert {name for name, _, _, _ in results} == {name for name, _, _ in wqi.explain_checks()}
+    failed = {name: (index, plan) for name, index, plan, ok in results if not ok}
+    assert not failed
+
+def test_plans_ignore_table_statistics(wqi):
+    # with real stats on tiny tables SQLite would rather scan; the check must judge the index anyway
+    with wqi.app.app_context():
+        if wqi.db.engine.dialect.name != "sqlite":
+            pytest.skip("sqlite_stat1 is SQLite only")
+        with wqi.db.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        assert all(ok for _, _, _, ok in wqi.check_query_plans())
+        with wqi.db.engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT count(*) FROM sqlite_stat1").scalar() > 0  # restored afterwards
+
+def test_db_explain_command(wqi):
+    result = wqi.app.test_cli_runner().invoke(args=["db-explain"])
+    assert result.exit_code == 0, result.output
+    assert "All query plans use their indexes." in result.output
@@ -0,0 +1,62 @@
+import random
+import threading
+
+import pytest
+
+from app import SpatialIndex, haversine_distance
+
+def brute_force(points, lat, lng, k, radius_km):
+    hits = sorted((haversine_distance(lat, lng, plat, plng), key) for key, (plat, plng) in points.items())
+    if radius_km is not None:
+        hits = [hit for hit in hits if hit[0] <= radius_km]
+    return hits[:k]
+
+def nearest_with_timeout(index, *args, **kwargs):
+    # a ring walk that never terminates would otherwise hang the whole test run
+    out = []
+    worker = threading.Thread(target=lambda: out.append(index.nearest(*args, **kwargs)), daemon=True)
+    worker.start()
+    worker.join(10)
+    assert out, "nearest() did not return"
+    return out[0]
+
+def random_point(rng):
+    roll = rng.random()
+    if roll < 0.2:  # near a pole
+        return rng.choice([1, -1]) * rng.uniform(80, 90), rng.uniform(-180, 180)
+    if roll < 0.4:  # near the antimeridian
+        return rng.uniform(-60, 60), rng.choice([1, -1]) * rng.uniform(175, 180)
+    return rng.uniform(-90, 90), rng.uniform(-180, 180)
+
+def test_antipodal_single_point_terminates():
+    index = SpatialIndex()
+    index.add(("location", 1), 22.5, 88.3)
+    [(dist, key)] = nearest_with_timeout(index, 22.5, -91.5, k=1)
+    assert key == ("location", 1)
+    assert dist == pytest.approx(haversine_distance(22.5, -91.5, 22.5, 88.3))
+
+def test_fewer_points_than_k_returns_them_all():
+    index = SpatialIndex()
+    index.add(("location", 1), 89.5, 0.0)
+    index.add(("reference", 2), -89.5, 180.0)
+    assert [key for _, key in nearest_with_timeout(index, 0.0, 90.0, k=5)] in (
+        [("location", 1), ("reference", 2)], [("reference", 2), ("location", 1)])
+
+def test_matches_brute_force():
+    rng = random.Random(20240601)
+    for _ in range(400):
+        index = SpatialIndex(cell_deg=rng.choice([1.0, 5.0, 7.0]))
+        points = {}
+        for n in range(rng.choice([1, 3, 20, 200])):
+            points[("location", n)] = random_point(rng)
+            index.add(("location", n), *points[("location", n)])
+        if rng.random() < 0.3:  # antipode of a stored point
+            plat, plng = rng.choice(list(points.values()))
+            lat, lng = -plat, plng - 180 if plng >= 0 else plng + 180
+        else:
+            lat, lng = random_point(rng)
+        k = rng.choice([1, 3, 10, 500])
+        radius_km = rng.choice([None, None, 50, 2000, 20000])
+        got = nearest_with_timeout(index, lat, lng, k=k, radius_km=radius_km)
+        expected = brute_force(points, lat, lng, k, radius_km)
+        assert [round(d, 6) for d, _ in got] == [round(d, 6) for d, _ in expected], (lat, lng, k, radius_km)
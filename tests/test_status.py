@@ -0,0 +1,25 @@
+import math
+
+import pytest
+
+from app import NO_DATA_STATUS, StatusClassifier
+
+THRESHOLDS = [
+    {"max": 25, "status": "Excellent", "color": "success"},
+    {"max": 50, "status": "Good", "color": "info"},
+    {"max": 75, "status": "Poor", "color": "warning"},
+    {"max": None, "status": "Unsuitable", "color": "danger"},
+]
+
+@pytest.mark.parametrize("wqi", [None, math.nan, math.inf, -math.inf])
+def test_missing_values_are_no_data(wqi):
+    classifier = StatusClassifier(THRESHOLDS)
+    assert classifier.classify(wqi) == NO_DATA_STATUS
+    assert classifier.classify_many([wqi]) == [NO_DATA_STATUS]
+
+def test_classify_many_matches_classify():
+    classifier = StatusClassifier(THRESHOLDS)
+    values = [-5, 0, 25, 25.0001, 50, 60, 75, 75.5, 1000, None, math.nan]
+    assert classifier.classify_many(values) == [classifier.classify(v) for v in values]
+    assert classifier.classify(25) == ("Excellent", "success")  # bounds are inclusive
+    assert classifier.classify(75.5) == ("Unsuitable", "danger")
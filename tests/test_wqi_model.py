@@ -0,0 +1,59 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from app import DEFAULT_IDEAL, DEFAULT_STANDARD, WQIModel
+
+MODELS = {
+    "default": (DEFAULT_IDEAL, DEFAULT_STANDARD),
+    "ideal_equals_standard": ({**DEFAULT_IDEAL, "tds": 500}, {**DEFAULT_STANDARD, "tds": 500}),  # tds is skipped
+    "zero_standard": (DEFAULT_IDEAL, {**DEFAULT_STANDARD, "nitrate": 0}),  # every score is None
+}
+
+def random_value(rng, param):
+    roll = rng.random()
+    if roll < 0.1:
+        return None
+    if roll < 0.15:
+        return math.nan
+    if roll < 0.2:
+        return rng.choice(["7.25", "n/a", ""])  # form input arrives as strings
+    if roll < 0.25:
+        return rng.randint(0, 40)
+    return rng.uniform(-5, 2 * (DEFAULT_STANDARD.get(param) or 10))
+
+def random_rows(rng, n):
+    rows = []
+    for _ in range(n):
+        if rng.random() < 0.05:
+            rows.append(None)  # not a dict; scored as an empty reading
+            continue
+        rows.append({p: random_value(rng, p) for p in DEFAULT_STANDARD if rng.random() > 0.15})
+    return rows
+
+@pytest.mark.parametrize("name", MODELS)
+def test_batch_scoring_matches_score(name):
+    model = WQIModel(*MODELS[name])
+    rows = random_rows(random.Random(name), 2000)
+    expected = [model.score(r if isinstance(r, dict) else {}) for r in rows]
+    assert model.score_many(rows) == expected
+    dicts = [r if isinstance(r, dict) else {} for r in rows]
+    columns = {p: [r.get(p) for r in dicts] for p in DEFAULT_STANDARD}
+    assert model.score_columns(columns, len(rows)) == expected
+    assert model.score_columns(columns) == expected  # n inferred from the first column
+
+def test_float_array_columns_match_score():
+    model = WQIModel(DEFAULT_IDEAL, DEFAULT_STANDARD)
+    rng = np.random.default_rng(1)
+    columns = {p: rng.uniform(-1, 2 * v, 500) for p, v in DEFAULT_STANDARD.items()}
+    columns["ph"][::7] = np.nan  # NaN in a float array is a value, as float("nan") is for score
+    expected = [model.score({p: float(col[i]) for p, col in columns.items()}) for i in range(500)]
+    assert model.score_columns(columns) == expected
+
+def test_empty_input():
+    model = WQIModel(DEFAULT_IDEAL, DEFAULT_STANDARD)
+    assert model.score_many([]) == []
+    assert model.score_columns({}) == []
+    assert model.score_many([{}]) == [model.score({})] == [None]